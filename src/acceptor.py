@@ -0,0 +1,187 @@
+"""
+Accepting the peers connecting to us on the announced port.
+
+The `Acceptor` serves a listening socket for any number of torrents. A peer
+connecting has to send its handshake first, the torrent is found from the
+info hash in it and the connection is handed to that torrent's pool of peer
+connections, which answers the handshake.
+
+Connections are turned away as cheaply as possible, by resetting them
+before anything is read or allocated for them: when the connections open at
+once over all torrents are at their budget, when too many connections have
+not sent their handshake yet, when the handshake is not a BitTorrent one
+or is for a torrent we do not have, and when the torrent has no free peer
+connection. The number of connections accepted per event loop iteration is
+limited by the listen backlog, so a burst of connects does not hold up the
+loop.
+"""
+import asyncio
+import logging
+import socket
+
+from .protocol import Handshake, InboundPeer
+
+# The port peers connect to, announced to the trackers
+LISTEN_PORT = 6889
+# The listen backlog, also the most connections accepted in one go
+ACCEPT_BACKLOG = 128
+# Connections that did not send a handshake yet, and the seconds they get
+# to send it
+MAX_PENDING_HANDSHAKES = 64
+HANDSHAKE_TIMEOUT = 10
+
+_PROTOCOL_PREFIX = b'\x13BitTorrent protocol'
+
+
+def listen_socket(port: int = LISTEN_PORT,
+                  reuse_port: bool = False) -> socket.socket | None:
+    """
+    Bind a listening TCP socket on the port, that other processes can bind
+    too if `reuse_port` is set (`SO_REUSEPORT`)
+
+    :return: The socket, None if the port could not be bound
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('0.0.0.0', port))
+        sock.listen(ACCEPT_BACKLOG)
+        sock.setblocking(False)
+    except OSError as exc:
+        logging.warning('Unable to listen on port %d: %s', port, exc)
+        sock.close()
+        return None
+    return sock
+
+
+class HandshakeProtocol(asyncio.Protocol):
+    """
+    Reads the handshake of a peer that connected to us, then hands the
+    connection to the `Acceptor`
+    """
+    def __init__(self, acceptor: 'Acceptor'):
+        self.acceptor = acceptor
+        self.transport = None
+        self.buffer = bytearray()
+        self.pending = False
+        self._timeout = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.acceptor._admit():
+            transport.abort()
+            return
+        self.pending = True
+        self._timeout = asyncio.get_running_loop().call_later(
+            self.acceptor.handshake_timeout, self._timed_out)
+
+    def data_received(self, data: bytes):
+        if not self.pending:
+            return
+        self.buffer += data
+        if len(self.buffer) < Handshake.length:
+            return
+        self._done()
+        # The peer connection taking over resumes reading
+        self.transport.pause_reading()
+        self.acceptor._handshake_received(
+            self.transport, bytes(self.buffer[:Handshake.length]),
+            bytes(self.buffer[Handshake.length:]))
+
+    def _timed_out(self):
+        logging.debug('No handshake from %s',
+                      self.transport.get_extra_info('peername'))
+        self._done()
+        self.acceptor.rejected += 1
+        self.transport.abort()
+
+    def _done(self):
+        self.pending = False
+        self.acceptor.pending -= 1
+        if self._timeout is not None:
+            self._timeout.cancel()
+
+    def connection_lost(self, exc):
+        if self.pending:
+            self._done()
+
+
+class Acceptor:
+    """
+    Accepts peers for the torrents added to it, by info hash.
+
+    A torrent is represented by an object with an `accept(peer)` method
+    (i.e. a `TorrentClient`) that takes an `InboundPeer` and returns False
+    if it cannot take the connection.
+    """
+    def __init__(self, connection_budget: asyncio.Semaphore | None = None,
+                 max_pending: int = MAX_PENDING_HANDSHAKES,
+                 handshake_timeout: float = HANDSHAKE_TIMEOUT):
+        """
+        :param connection_budget: The connections open at once over all
+                                  torrents, none is accepted while it is
+                                  used up
+        """
+        self.connection_budget = connection_budget
+        self.max_pending = max_pending
+        self.handshake_timeout = handshake_timeout
+        self.torrents = {}
+        self.server = None
+        # Connections waiting for their handshake, and the connections
+        # handed to a torrent or turned away
+        self.pending = 0
+        self.accepted = 0
+        self.rejected = 0
+
+    def add(self, info_hash: bytes, torrent):
+        self.torrents[info_hash] = torrent
+
+    def remove(self, info_hash: bytes):
+        self.torrents.pop(info_hash, None)
+
+    async def start(self, sock: socket.socket):
+        """
+        Start accepting connections on a bound socket
+        """
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(
+            lambda: HandshakeProtocol(self), sock=sock,
+            backlog=ACCEPT_BACKLOG)
+        logging.info('Accepting peers on port %d', sock.getsockname()[1])
+
+    def _admit(self) -> bool:
+        """
+        Check there is room for a new connection, before reading from it
+        """
+        budget = self.connection_budget
+        if self.pending >= self.max_pending or \
+                (budget is not None and budget.locked()) or \
+                not self.torrents:
+            self.rejected += 1
+            return False
+        self.pending += 1
+        return True
+
+    def _handshake_received(self, transport: asyncio.Transport,
+                            data: bytes, rest: bytes):
+        handshake = Handshake.decode(data) \
+            if data.startswith(_PROTOCOL_PREFIX) else None
+        torrent = handshake and self.torrents.get(handshake.info_hash)
+        address = transport.get_extra_info('peername')
+        if torrent is None or not torrent.accept(
+                InboundPeer(address[:2], transport, data, rest)):
+            logging.debug('Turning away peer %s', address)
+            self.rejected += 1
+            transport.abort()
+            return
+        self.accepted += 1
+
+    def close(self):
+        """
+        Stop accepting, the accepted connections are left open
+        """
+        if self.server is not None:
+            self.server.close()
+            self.server = None
@@ -0,0 +1,78 @@
+"""
+When to announce to the trackers of a torrent.
+
+Trackers give an `interval` to re-announce at, and optionally a
+`min interval` not to announce more often than. The scheduler announces at
+the interval, moved by a random jitter so that clients started together do
+not keep announcing at the same moment, and early (but not before the min
+interval) when the client is running out of peers to connect to. Failed
+announces are retried with an exponential backoff.
+"""
+import random
+
+# Used until a tracker tells otherwise
+DEFAULT_INTERVAL = 30 * 60
+DEFAULT_MIN_INTERVAL = 60
+# Share of the interval an announce is randomly moved by
+JITTER = 0.1
+# Seconds before retrying a failed announce, doubled on each failure
+RETRY_DELAY = 15
+MAX_RETRY_DELAY = 30 * 60
+
+
+class AnnounceScheduler:
+    """
+    Decides when the next announce is due
+    """
+    def __init__(self, min_peers: int, jitter: float = JITTER,
+                 rng: random.Random | None = None):
+        """
+        :param min_peers: Announce early when fewer peers than this are
+                          connected or waiting to be connected to
+        """
+        self.min_peers = min_peers
+        self.jitter = jitter
+        self.random = rng or random.Random()
+        self.interval = DEFAULT_INTERVAL
+        self.min_interval = DEFAULT_MIN_INTERVAL
+        # Time of the last successful announce
+        self.last_announce = None
+        # Time the next announce is due, whatever the number of peers
+        self.next_announce = 0.0
+        # Failed announces since the last successful one
+        self.failures = 0
+
+    def announced(self, now: float, interval: int, min_interval: int = 0):
+        """
+        A tracker responded, with the intervals of its response (0 if
+        missing)
+        """
+        self.interval = interval or DEFAULT_INTERVAL
+        self.min_interval = min(min_interval or DEFAULT_MIN_INTERVAL,
+                                self.interval)
+        self.last_announce = now
+        self.failures = 0
+        spread = self.interval * self.random.uniform(-self.jitter, self.jitter)
+        self.next_announce = now + max(self.min_interval,
+                                       self.interval + spread)
+
+    def failed(self, now: float):
+        """
+        No tracker responded
+        """
+        delay = min(RETRY_DELAY * 2 ** self.failures, MAX_RETRY_DELAY)
+        self.failures += 1
+        self.next_announce = now + delay * self.random.uniform(
+            1 - self.jitter, 1 + self.jitter)
+
+    def due(self, now: float, peers: int) -> bool:
+        """
+        :param peers: The number of peers connected or waiting to be
+                      connected to
+        """
+        if now >= self.next_announce:
+            return True
+        # Short of peers, announce early if the tracker allows it
+        return peers < self.min_peers and not self.failures and \
+            self.last_announce is not None and \
+            now >= self.last_announce + self.min_interval
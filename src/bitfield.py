@@ -0,0 +1,118 @@
+"""
+Compact bitfields for keeping track of which pieces a peer (or we) have.
+
+The bits are stored in a `bytearray` using the same layout as the BitField
+message of the peer wire protocol: the high bit of the first byte is piece 0.
+Single bits are read and written directly in the bytearray, while the bulk
+operations (counting, comparing against another bitfield) convert the bytes
+to a Python `int` so that the work is done in C rather than bit by bit.
+"""
+
+# The positions of the set bits for every possible byte value, high bit first.
+_SET_BITS = [tuple(bit for bit in range(8) if value & (0x80 >> bit))
+             for value in range(256)]
+
+
+class CompactBitfield:
+    """
+    A fixed length bitfield, one bit per piece.
+
+    Bits past `length` (the padding of the last byte) are always kept clear,
+    so they never show up in counts or comparisons.
+    """
+    __slots__ = ('length', 'bits')
+
+    def __init__(self, length: int, data: bytes | None = None):
+        """
+        :param length: The number of bits (pieces)
+        :param data: The initial bits, as sent in a BitField message. Extra
+                     bytes and padding bits are dropped.
+        """
+        self.length = length
+        size = (length + 7) // 8
+        if data is None:
+            self.bits = bytearray(size)
+        else:
+            self.bits = bytearray(data[:size])
+            self.bits.extend(bytes(size - len(self.bits)))
+            if length % 8:
+                self.bits[-1] &= (0xFF << (8 - length % 8)) & 0xFF
+
+    @classmethod
+    def full(cls, length: int) -> 'CompactBitfield':
+        """
+        Create a bitfield with every bit set
+        """
+        return cls(length, b'\xff' * ((length + 7) // 8))
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index: int) -> bool:
+        if not 0 <= index < self.length:
+            raise IndexError('bitfield index out of range')
+        return bool(self.bits[index >> 3] & (0x80 >> (index & 7)))
+
+    def __setitem__(self, index: int, value):
+        if not 0 <= index < self.length:
+            raise IndexError('bitfield index out of range')
+        if value:
+            self.bits[index >> 3] |= 0x80 >> (index & 7)
+        else:
+            self.bits[index >> 3] &= ~(0x80 >> (index & 7)) & 0xFF
+
+    def __iter__(self):
+        """
+        Iterate over the indexes of the set bits
+        """
+        for position, value in enumerate(self.bits):
+            if value:
+                base = position << 3
+                for bit in _SET_BITS[value]:
+                    yield base + bit
+
+    def __eq__(self, other):
+        if not isinstance(other, CompactBitfield):
+            return NotImplemented
+        return self.length == other.length and self.bits == other.bits
+
+    def __bytes__(self):
+        return bytes(self.bits)
+
+    def resized(self, length: int) -> 'CompactBitfield':
+        """
+        Get a copy of this bitfield with the given length
+        """
+        return CompactBitfield(length, self.bits)
+
+    def as_int(self) -> int:
+        """
+        The bits as an integer, piece 0 being the most significant bit
+        """
+        return int.from_bytes(self.bits, 'big')
+
+    def count(self) -> int:
+        """
+        The number of set bits
+        """
+        return self.as_int().bit_count()
+
+    def all(self) -> bool:
+        """
+        Checks if every bit is set
+        """
+        return self.count() == self.length
+
+    def difference_count(self, other: 'CompactBitfield') -> int:
+        """
+        The number of bits set in this bitfield but not in the other one,
+        e.g. the number of pieces a peer has that we do not.
+        """
+        return (self.as_int() & ~other.as_int()).bit_count()
+
+    def has_any_not_in(self, other: 'CompactBitfield') -> bool:
+        """
+        Checks if there is any bit set in this bitfield that is not set in
+        the other one, e.g. if a peer has any piece we need.
+        """
+        return (self.as_int() & ~other.as_int()) != 0
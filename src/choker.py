@@ -0,0 +1,92 @@
+"""
+Which peers we upload to.
+
+Every `interval` seconds the interested peers are ranked, by the rate they
+send to us while we download, and by the rate they take from us once we
+seed. The best `slots` of them are unchoked and the others choked, so our
+upload goes to the peers that upload to us (tit-for-tat). One more peer is
+unchoked at random every `optimistic_interval` seconds, whatever its rate,
+to find better peers than the ones unchoked and to give new peers a first
+piece to trade with.
+
+Between the rounds a peer becoming interested is unchoked right away if a
+slot is free.
+"""
+import random
+import time
+
+# Peers unchoked for their rate, besides the optimistic unchoke
+UNCHOKE_SLOTS = 4
+# Seconds between choking rounds, and between optimistic unchokes
+CHOKE_INTERVAL = 10
+OPTIMISTIC_INTERVAL = 30
+
+
+class Choker:
+    """
+    Chokes and unchokes the `PeerConnection`s of a torrent
+    """
+    def __init__(self, slots: int = UNCHOKE_SLOTS,
+                 interval: float = CHOKE_INTERVAL,
+                 optimistic_interval: float = OPTIMISTIC_INTERVAL,
+                 rng: random.Random | None = None):
+        """
+        :param slots: The peers unchoked for their rate
+        """
+        self.slots = slots
+        self.interval = interval
+        self.optimistic_interval = optimistic_interval
+        self.random = rng or random.Random()
+        # The time of the last round
+        self.last_run = None
+        # The peer id of the peer optimistically unchoked, and since when
+        self.optimistic = None
+        self.optimistic_since = None
+
+    def due(self, now: float) -> bool:
+        """
+        If a round of choking is due
+        """
+        return self.last_run is None or now - self.last_run >= self.interval
+
+    def has_free_slot(self, peers: list) -> bool:
+        """
+        If one more peer can be unchoked before the next round
+        """
+        unchoked = sum(1 for peer in peers if not peer.am_choking)
+        return unchoked < self.slots + 1
+
+    def run(self, peers: list, seeding: bool,
+            now: float | None = None) -> list:
+        """
+        Unchoke the best interested peers and the optimistic unchoke, and
+        choke the others
+
+        :return: The peers unchoked
+        """
+        now = time.time() if now is None else now
+        self.last_run = now
+        interested = [peer for peer in peers if peer.remote_id is not None
+                      and 'interested' in peer.peer_state]
+        if seeding:
+            interested.sort(key=lambda peer: peer.upload_rate, reverse=True)
+        else:
+            interested.sort(key=lambda peer: peer.download_rate,
+                            reverse=True)
+        unchoked = interested[:self.slots]
+        others = {peer.remote_id: peer for peer in interested[self.slots:]}
+        if self.optimistic not in others or \
+                now - self.optimistic_since >= self.optimistic_interval:
+            # Rotate, or replace a peer that left, became uninterested or
+            # made it to the unchoked ones
+            self.optimistic = self.random.choice(list(others)) \
+                if others else None
+            self.optimistic_since = now
+        if self.optimistic is not None:
+            unchoked.append(others[self.optimistic])
+        for peer in peers:
+            if peer in unchoked:
+                peer.unchoke()
+            else:
+                peer.choke()
+        return unchoked
@@ -2,19 +2,93 @@ import asyncio
 import logging
 import math
 import os
+import threading
 import time
-from pathlib import Path
 
 from asyncio import Queue
-from collections import namedtuple, defaultdict
+from collections import deque, namedtuple
+from concurrent.futures import Executor
 from hashlib import sha1
 
-from .protocol import PeerConnection,REQUEST_SIZE
+from .announce import AnnounceScheduler
+from .bitfield import CompactBitfield
+from .choker import Choker, UNCHOKE_SLOTS
+from .disk import DiskIO
+from .ratelimit import limiter
+from .resume import FastResume
+from .storage import OutputPaths, ReadCache, Storage
+from .protocol import (InboundPeer, MAX_UPLOAD_REQUEST, PeerConnection,
+                       REQUEST_SIZE)
 from .tracker import Tracker
+from .verify import verify_pieces
 
 # Number of max peer connections per TorrentClient
 MAX_PEER_CONNECTIONS = 40
 
+# Announce early when fewer peers than this are connected or queued
+MIN_PEERS = 10
+
+# Seconds between writing the fast-resume file while downloading
+RESUME_INTERVAL = 60
+
+# Seconds between the checks of the download loop
+TICK = 1
+
+# The most peers a block is requested from at once in endgame mode
+ENDGAME_REQUESTS = 3
+
+
+class PeerQueue(Queue):
+    """
+    The queue of peers to connect to, where a peer is only queued once.
+
+    The peers that connected to us are queued ahead of the others, they are
+    waiting with an open connection.
+    """
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._peers = set()
+        # The number of queued peers that connected to us
+        self.inbound = 0
+
+    def add(self, peer):
+        """
+        Queue the (ip, port) of a peer unless it is queued already
+        """
+        if peer not in self._peers:
+            self._peers.add(peer)
+            self.put_nowait(peer)
+
+    def add_inbound(self, peer: InboundPeer):
+        """
+        Queue a peer that connected to us, ahead of the other peers
+        """
+        self.put_nowait(peer)
+
+    def drop_inbound(self):
+        """
+        Close the connections of the queued peers that connected to us
+        """
+        for peer in self._queue:
+            if isinstance(peer, InboundPeer):
+                peer.transport.abort()
+
+    def _put(self, peer):
+        if isinstance(peer, InboundPeer):
+            self.inbound += 1
+            self._queue.appendleft(peer)
+        else:
+            super()._put(peer)
+
+    def _get(self):
+        peer = super()._get()
+        if isinstance(peer, InboundPeer):
+            self.inbound -= 1
+        else:
+            self._peers.discard(peer)
+        return peer
+
+
 class TorrentClient:
     """
     The torrent client is the local peer that holds peer-to-peer
@@ -31,17 +105,60 @@ class TorrentClient:
     be waiting until there is a peer to consume in the queue.
     """
 
-    def __init__(self, torrent):
-        self.tracker = Tracker(torrent)
+    def __init__(self, torrent, use_protocol: bool = False, session=None,
+                 seed: bool = False, upload_slots: int = UNCHOKE_SLOTS,
+                 download_limit: float | None = None,
+                 upload_limit: float | None = None,
+                 peer_download_limit: float | None = None,
+                 peer_upload_limit: float | None = None):
+        """
+        :param session: The `Session` the client is part of, if any, whose
+                        disk workers, connection budget, rate limits and UDP
+                        tracker socket are shared with its other torrents
+        :param seed: Keep uploading to the peers once the torrent is
+                     downloaded, until stopped
+        :param upload_slots: The peers unchoked for their rate at once,
+                             besides the optimistic unchoke
+        :param download_limit: Bytes per second for the torrent, within the
+                               limit of the session, no limit if None
+        :param upload_limit: Bytes per second for the torrent, within the
+                             limit of the session, no limit if None
+        :param peer_download_limit: Bytes per second from each peer, no
+                                    limit if None
+        :param peer_upload_limit: Bytes per second to each peer, no limit
+                                  if None
+        """
+        self.session = session
+        self.seed = seed
+        self.tracker = Tracker(
+            torrent, udp=session.udp_tracker if session else None)
         # List of potential peers is the work queue
-        self.available_peers = Queue()
+        self.available_peers = PeerQueue()
         # The list of peers is the list of workers that *might* be connected
         # to a peer. Else they are waiting to consume new remote peers from
         # the `available_peers` queue. These are our workers!
         self.peers = []
         # The piece manager implements the strategy on which pieces to
         # request, as well as the logic to persist received pieces to disk.
-        self.piece_manager = PieceManager(torrent)
+        if session is not None:
+            self.piece_manager = PieceManager(
+                torrent, disk=session.disk,
+                hash_executor=session.hash_executor)
+        else:
+            self.piece_manager = PieceManager(torrent)
+        self.piece_manager.on_piece_verified = self._on_piece_verified
+        self.piece_manager.on_block_cancelled = self._on_block_cancelled
+        # Decides which of the interested peers we upload to
+        self.choker = Choker(upload_slots)
+        # The rate limits of the torrent, under the ones of the session
+        self.download_limiter = limiter(
+            download_limit, session and session.download_limiter)
+        self.upload_limiter = limiter(
+            upload_limit, session and session.upload_limiter)
+        self.peer_download_limit = peer_download_limit
+        self.peer_upload_limit = peer_upload_limit
+        # Use the asyncio.Protocol based transport for peer connections
+        self.use_protocol = use_protocol
         self.abort = False
         self._closed = False
 
@@ -53,25 +170,44 @@ class TorrentClient:
         peers to communicate with. Once the torrent is fully downloaded or
         if the download is aborted this method will complete.
         """
+        session = self.session
         self.peers = [PeerConnection(self.available_peers,
                                      self.tracker.torrent.info_hash,
                                      self.tracker.peer_id,
                                      self.piece_manager,
-                                     self._on_block_retrieved)
+                                     self._on_block_retrieved,
+                                     use_protocol=self.use_protocol,
+                                     on_interested=self._on_peer_interested,
+                                     connection_budget=session and session.connection_budget,
+                                     download_limiter=self.download_limiter,
+                                     upload_limiter=self.upload_limiter,
+                                     download_limit=self.peer_download_limit,
+                                     upload_limit=self.peer_upload_limit)
                                 # Creates peer connection workers(up to 40 connections)
                                 for _ in range(MAX_PEER_CONNECTIONS)]
-        # Last announce call timestamp
-        previous = None
-        # Default interval between announce calls
-        interval = 30*60
+        scheduler = AnnounceScheduler(min_peers=MIN_PEERS)
+        # The announce in progress, if any
+        announcing = None
+        # Only a download that completes while running sends completed
+        was_complete = self.piece_manager.complete
+        seeding = False
         last_progress_at = time.time()
-        last_downloaded = 0
+        last_downloaded = self.piece_manager.bytes_downloaded
+        last_resume_at = time.time()
 
         try:
             while True:
-                if self.piece_manager.complete:
+                if self.piece_manager.complete and not seeding:
                     logging.info('Torrent fully downloaded!')
-                    break
+                    if not was_complete:
+                        await self.tracker.notify(
+                            'completed',
+                            uploaded=self.piece_manager.bytes_uploaded,
+                            downloaded=self.piece_manager.bytes_downloaded)
+                    if not self.seed:
+                        break
+                    logging.info('Seeding until stopped')
+                    seeding = True
                 if self.abort:
                     logging.info('Aborting download...')
                     break
@@ -84,36 +220,149 @@ class TorrentClient:
                     speed_kib_s = (delta_bytes / delta_time) / 1024
                     total_size = max(1, self.tracker.torrent.total_size)
                     progress_pct = (downloaded / total_size) * 100
+                    disk = self.piece_manager.disk
                     logging.info(
-                        'Progress: %.2f%% (%d/%d bytes), speed %.2f KiB/s, queued peers=%d',
+                        'Progress: %.2f%% (%d/%d bytes), speed %.2f KiB/s, '
+                        'uploaded %d bytes, '
+                        'connected peers=%d, unchoked peers=%d, queued peers=%d, '
+                        'disk queue=%d (peak %d), disk latency %.1f ms (max %.1f ms), '
+                        'tracker connections reused %.0f%%',
                         progress_pct,
                         downloaded,
                         total_size,
                         speed_kib_s,
-                        self.available_peers.qsize()
+                        self.piece_manager.bytes_uploaded,
+                        self.connected_peers,
+                        sum(not peer.am_choking for peer in self.peers),
+                        self.available_peers.qsize(),
+                        disk.queued,
+                        disk.peak_queued,
+                        disk.latency * 1000,
+                        disk.max_latency * 1000,
+                        self.tracker.http.reuse_rate * 100
                     )
                     last_progress_at = current
                     last_downloaded = downloaded
 
-                if (not previous) or (previous + interval < current):
-                    response = await self.tracker.connect(
-                        first=previous is None,
-                        uploaded=self.piece_manager.bytes_uploaded,
-                        downloaded=self.piece_manager.bytes_downloaded)
-                    if response:
-                        previous = current
-                        interval = response.interval
-                        self._empty_queue()
-                        for peer in response.peers:
-                            self.available_peers.put_nowait(peer)
-
-                else:
-                    await asyncio.sleep(5)
+                self.piece_manager.flush_expired()
+                if current - last_resume_at >= RESUME_INTERVAL:
+                    self.piece_manager.save_resume()
+                    last_resume_at = current
+
+                if announcing is not None and announcing.done():
+                    # Raises if no tracker ever responded
+                    announcing.result()
+                    announcing = None
+                if self.choker.due(current):
+                    self.choker.run(self.peers, seeding, current)
+
+                peers = self.connected_peers + self.available_peers.qsize()
+                if announcing is None and scheduler.due(current, peers):
+                    announcing = asyncio.create_task(self._announce(scheduler))
+                await asyncio.sleep(TICK)
         finally:
+            if announcing is not None:
+                announcing.cancel()
             await self.close()
-    def _empty_queue(self):
-        while not self.available_peers.empty():
-            self.available_peers.get_nowait()
+
+    @property
+    def connected_peers(self) -> int:
+        """
+        The number of peers a handshake was done with
+        """
+        return sum(1 for peer in self.peers if peer.remote_id is not None)
+
+    async def _announce(self, scheduler: AnnounceScheduler):
+        """
+        Announce to the trackers and queue the peers they return
+        """
+        first = scheduler.last_announce is None
+        # Ask for enough peers to fill the free connections
+        num_want = max(0, MAX_PEER_CONNECTIONS - self.connected_peers -
+                       self.available_peers.qsize())
+        try:
+            response = await self.tracker.connect(
+                first=first,
+                uploaded=self.piece_manager.bytes_uploaded,
+                downloaded=self.piece_manager.bytes_downloaded,
+                on_response=self._add_peers,
+                num_want=num_want)
+        except ConnectionError as exc:
+            if first:
+                raise
+            logging.warning('Announce failed, retrying later: %s', exc)
+            scheduler.failed(time.time())
+            return
+        scheduler.announced(time.time(), response.interval,
+                            response.min_interval)
+        self._add_peers(response)
+
+    def peer_rates(self) -> dict:
+        """
+        The download and upload rates, in bytes per second, of the connected
+        peers by (ip, port)
+        """
+        return {peer.address: (peer.download_rate, peer.upload_rate)
+                for peer in self.peers if peer.remote_id is not None}
+
+    def _on_peer_interested(self, peer: PeerConnection):
+        """
+        Unchoke a peer becoming interested if an upload slot is free, else
+        it waits for the next choking round
+        """
+        if peer.am_choking and self.choker.has_free_slot(self.peers):
+            peer.unchoke()
+
+    def _on_block_cancelled(self, block: 'Block', peer_ids: list):
+        """
+        Cancel the requests of a block at the peers it was requested from,
+        besides the one it was received from
+        """
+        for peer in self.peers:
+            if peer.remote_id is not None and peer.remote_id in peer_ids:
+                peer.send_cancel(block.piece, block.offset, block.length)
+
+    def _on_piece_verified(self, index: int):
+        """
+        Let the connected peers know of a piece we downloaded
+        """
+        for peer in self.peers:
+            peer.send_have(index)
+
+    def _add_peers(self, response):
+        """
+        Queue the peers of a tracker response, skipping the ones already
+        queued or connected to (e.g. returned by another tracker)
+        """
+        try:
+            peers = response.peers
+        except RuntimeError as exc:
+            logging.warning('Ignoring tracker response: %s', exc)
+            return
+        connected = {peer.address for peer in self.peers}
+        for peer in peers:
+            if peer not in connected:
+                self.available_peers.add(peer)
+
+    def accept(self, peer: InboundPeer) -> bool:
+        """
+        Take a peer that connected to us, if a peer connection is free to
+        serve it
+
+        :return: False if the peer is turned away
+        """
+        if self.abort or (self.piece_manager.complete and not self.seed):
+            return False
+        peer_id = peer.handshake[-20:]
+        if peer_id == self.tracker.peer_id.encode('utf-8') or \
+                any(other.remote_id == peer_id for other in self.peers):
+            # Ourselves, or a peer we are connected to already
+            return False
+        idle = sum(1 for other in self.peers if other.address is None)
+        if idle <= self.available_peers.inbound:
+            return False
+        self.available_peers.add_inbound(peer)
+        return True
 
     def stop(self):
         """
@@ -122,6 +371,7 @@ class TorrentClient:
         self.abort = True
         for peer in self.peers:
             peer.stop()
+        self.available_peers.drop_inbound()
 
     async def close(self):
         """
@@ -131,7 +381,15 @@ class TorrentClient:
             return
 
         self.stop()
+        # The blocks received last are written, and the pieces they complete
+        # verified, before the files (and the disk workers unless shared)
+        # are closed
+        await self.piece_manager.drain()
         self.piece_manager.close()
+        await self.tracker.notify(
+            'stopped',
+            uploaded=self.piece_manager.bytes_uploaded,
+            downloaded=self.piece_manager.bytes_downloaded)
         await self.tracker.close()
         self._closed = True
 
@@ -166,7 +424,6 @@ class Block:
         self.offset = offset
         self.length = length
         self.status = Block.Missing
-        self.data = None
 
 class Piece:
     """
@@ -177,12 +434,39 @@ class Piece:
     data between peers a smaller unit is used - this smaller piece is refereed
     to as `Block` by the unofficial specification (the official specification
     uses piece for this one as well, which is slightly confusing).
+
+    The blocks are kept in offset order, so a block is found from its offset
+    directly. The missing blocks are tracked as a bitmap (bit N set when
+    block N is missing) and the retrieved ones as a counter, so none of the
+    operations need to look at every block.
+
+    The piece data is never assembled in memory. The received blocks are
+    written to disk as they arrive and fed to a running SHA1 in offset order.
+    A block arriving ahead of the blocks before it is kept until those are
+    hashed, up to `MAX_BUFFERED_BLOCKS` of them. Blocks not kept are read
+    back from disk when it is their turn to be hashed.
+
+    The hashing is done by the disk workers, possibly for several blocks of
+    the piece at once, so it is done holding the piece's lock. The block
+    states are only changed on the event loop.
     """
+    MAX_BUFFERED_BLOCKS = 16
 
     def __init__(self, index: int, blocks: list, hash_value):
         self.index = index
         self.blocks = blocks
         self.hash = hash_value
+        self.missing = (1 << len(blocks)) - 1
+        self.retrieved = 0
+        # The number of blocks submitted to the disk workers and not yet
+        # written and hashed
+        self.disk_jobs = 0
+        # The running hash of the first `hashed` blocks, and the data of
+        # the out of order blocks by block position
+        self._lock = threading.Lock()
+        self._hasher = sha1()
+        self.hashed = 0
+        self.buffered = {}
 
     def reset(self):
         """
@@ -190,31 +474,84 @@ class Piece:
         """
         for block in self.blocks:
             block.status = Block.Missing
+        self.missing = (1 << len(self.blocks)) - 1
+        self.retrieved = 0
+        self._hasher = sha1()
+        self.hashed = 0
+        self.buffered = {}
 
     def next_request(self) -> Block:
         """
         Get the next Block to be requested
         """
-        missing = [b for b in self.blocks if b.status is Block.Missing]
-        if missing:
-            missing[0].status = Block.Pending
-            return missing[0]
-        return None
+        if not self.missing:
+            return None
+        # Lowest set bit, i.e. the first missing block
+        lowest = self.missing & -self.missing
+        self.missing ^= lowest
+        block = self.blocks[lowest.bit_length() - 1]
+        block.status = Block.Pending
+        return block
+
+    def block_missing(self, block: Block):
+        """
+        Put a pending block back to missing (e.g. the request was dropped)
+        """
+        if block.status == Block.Pending:
+            block.status = Block.Missing
+            self.missing |= 1 << (block.offset // REQUEST_SIZE)
 
-    def block_received(self, offset: int, data: bytes):
+    def block_received(self, offset: int) -> bool:
         """
         Update block information that the given block is now received
 
         :param offset: The block offset (within the piece)
-        :param data: The block data
+        :return: True if the block was not already retrieved
         """
-        matches = [b for b in self.blocks if b.offset == offset]
-        block = matches[0] if matches else None
-        if block:
-            block.status = Block.Retrieved
-            block.data = data
-        else:
+        position, remainder = divmod(offset, REQUEST_SIZE)
+        if remainder or position >= len(self.blocks):
             logging.warning('Trying to complete a non-existing block %s', offset)
+            return False
+        block = self.blocks[position]
+        if block.status == Block.Retrieved:
+            return False
+        block.status = Block.Retrieved
+        self.missing &= ~(1 << position)
+        self.retrieved += 1
+        return True
+
+    def hash_block(self, offset: int, data: bytes):
+        """
+        Hash a received block if all blocks before it are hashed, else keep
+        it for later (if there is room).
+
+        The data is not referenced after this call unless the block has to
+        wait for the blocks before it (it is then copied).
+        """
+        position = offset // REQUEST_SIZE
+        with self._lock:
+            if position == self.hashed:
+                self._hasher.update(data)
+                self.hashed += 1
+                self._hash_buffered()
+            else:
+                self._buffer(position, data)
+
+    def _hash_buffered(self):
+        # Hash the kept blocks that are now next in order
+        while self.hashed in self.buffered:
+            self._hasher.update(self.buffered.pop(self.hashed))
+            self.hashed += 1
+
+    def _buffer(self, position: int, data: bytes):
+        if len(self.buffered) >= Piece.MAX_BUFFERED_BLOCKS:
+            # Keep the blocks that are hashed soonest, the others are read
+            # back from disk.
+            furthest = max(self.buffered)
+            if furthest < position:
+                return
+            del self.buffered[furthest]
+        self.buffered[position] = bytes(data)
 
     def is_complete(self) -> bool:
         """
@@ -222,33 +559,109 @@ class Piece:
 
         :return: True or False
         """
-        blocks = [b for b in self.blocks if b.status is not Block.Retrieved]
-        return len(blocks) == 0
+        return self.retrieved == len(self.blocks)
 
-    def is_hash_matching(self):
+    def is_hash_matching(self, read_block) -> bool:
         """
         Check if a SHA1 hash for all the received blocks match the piece hash
         from the torrent meta-info.
 
+        :param read_block: Called with a block that was not kept in memory
+                           to read its data back from disk.
         :return: True or False
         """
-        piece_hash = sha1(self.data).digest()
-        return self.hash == piece_hash
+        with self._lock:
+            while self.hashed < len(self.blocks):
+                if self.hashed in self.buffered:
+                    self._hash_buffered()
+                else:
+                    self._hasher.update(read_block(self.blocks[self.hashed]))
+                    self.hashed += 1
+            return self.hash == self._hasher.digest()
+
+# The type used for keeping track of pending request that can be re-issued
+PendingRequest = namedtuple('PendingRequest', ['block', 'added', 'peer_id'])
+
+class RequestWindow:
+    """
+    The number of requests that can be outstanding to a single peer.
+
+    Keeping several requests in flight to a peer (pipelining) is needed to
+    get more than a block per round trip out of it. The depth of the window
+    is sized from the measured download rate from the peer, so that the
+    requests in flight cover `QUEUE_TIME` seconds (or the round trip time
+    if that is longer) of downloading, similar to the request queue sizing
+    in libtorrent. A fast peer therefore gets a deep queue while a slow
+    peer does not hold on to blocks other peers could deliver.
+    """
+    INITIAL_DEPTH = 4
+    MIN_DEPTH = 2
+    MAX_DEPTH = 250
+    # Seconds worth of downloading the requests in flight should cover
+    QUEUE_TIME = 3
+    # Seconds between each download rate sample
+    RATE_INTERVAL = 1
+
+    def __init__(self):
+        self.depth = RequestWindow.INITIAL_DEPTH
+        self.outstanding = 0
+        # Download rate (bytes/s) and round trip time (s) moving averages
+        self.rate = 0.0
+        self.rtt = None
+        self._sample_start = time.monotonic()
+        self._sample_bytes = 0
 
     @property
-    def data(self):
+    def available(self) -> int:
+        """
+        The number of requests that can be sent right now
         """
-        Return the data for this piece (by concatenating all blocks in order)
+        return max(0, self.depth - self.outstanding)
 
-        NOTE: This method does not control that all blocks are valid or even
-        existing!
+    def request_sent(self):
+        self.outstanding += 1
+
+    def request_done(self, rtt: float | None = None):
+        """
+        A request is no longer outstanding, if it was answered `rtt` is the
+        time it took.
         """
-        retrieved = sorted(self.blocks, key=lambda b: b.offset)
-        blocks_data = [b.data for b in retrieved]
-        return b''.join(blocks_data)
+        self.outstanding = max(0, self.outstanding - 1)
+        if rtt is not None:
+            self.rtt = rtt if self.rtt is None else 0.875 * self.rtt + 0.125 * rtt
 
-# The type used for keeping track of pending request that can be re-issued
-PendingRequest = namedtuple('PendingRequest', ['block', 'added'])
+    def request_timed_out(self):
+        """
+        A request to this peer timed out and will be sent to someone else,
+        back off by halving the window.
+        """
+        self.outstanding = max(0, self.outstanding - 1)
+        self.depth = max(RequestWindow.MIN_DEPTH, self.depth // 2)
+
+    def reset(self):
+        """
+        All outstanding requests are dropped (e.g. we got choked)
+        """
+        self.outstanding = 0
+
+    def data_received(self, length: int):
+        """
+        Update the download rate and resize the window
+        """
+        self._sample_bytes += length
+        now = time.monotonic()
+        elapsed = now - self._sample_start
+        if elapsed < RequestWindow.RATE_INTERVAL:
+            return
+        sample = self._sample_bytes / elapsed
+        self.rate = sample if not self.rate else 0.5 * self.rate + 0.5 * sample
+        self._sample_start = now
+        self._sample_bytes = 0
+
+        queue_time = max(RequestWindow.QUEUE_TIME, self.rtt or 0)
+        depth = math.ceil(self.rate * queue_time / REQUEST_SIZE)
+        self.depth = min(RequestWindow.MAX_DEPTH,
+                         max(RequestWindow.MIN_DEPTH, depth))
 
 class PieceManager:
     """
@@ -258,59 +671,90 @@ class PieceManager:
 
     The strategy on which piece to request is made as simple as possible in
     this implementation.
+
+    Once every block left is requested (endgame mode), a peer with nothing
+    new to request is given a block requested from other peers already, up
+    to `ENDGAME_REQUESTS` peers per block. The first copy to arrive is kept
+    and the requests to the other peers are cancelled, so the last pieces
+    do not wait for the slowest peer.
     """
 
-    def __init__(self,torrent):
+    def __init__(self,torrent, disk: DiskIO | None = None,
+                 hash_executor: Executor | None = None):
+        """
+        :param disk: The disk workers to use, e.g. shared by several
+                     torrents, else the piece manager has its own
+        :param hash_executor: The pool to recheck existing files on, else a
+                              pool is created for the recheck
+        """
         self.torrent = torrent
+        # Writing and hashing of the received blocks is done by the disk
+        # workers, off the event loop
+        self.disk = disk if disk is not None else DiskIO()
+        self._owns_disk = disk is None
+        self.hash_executor = hash_executor
+        # Disk jobs of this torrent submitted and not yet completed, and set
+        # when there are none
+        self.outstanding_jobs = 0
+        self._disk_idle = None
         self.peers = {}
-        self.pending_blocks = []
-        self.missing_pieces = []
-        self.ongoing_pieces = []
-        self.have_pieces = []
+        # The request window of each peer, by peer id
+        self.windows = {}
+        # Pending requests by (piece index, block offset)
+        self.pending_blocks = {}
+        # The pending requests in the order they were requested, requests no
+        # longer in `pending_blocks` are dropped once they reach the front.
+        self.pending_order = deque()
+        # In endgame mode, the other peers a pending block is requested from
+        # and when, by (piece index, block offset)
+        self.endgame_requests = {}
+        # The keys of the pending blocks by the number of other peers they
+        # are requested from, to find the ones requested from the fewest
+        self.endgame_candidates = {}
+        # Called with a block received and the ids of the other peers it was
+        # requested from, to cancel those requests
+        self.on_block_cancelled = None
+        # The bytes of blocks received more than once
+        self.duplicate_bytes = 0
+        # Pieces by piece index. Once a piece is written to disk it is only
+        # kept as a bit in `have_pieces`.
+        self.missing_pieces = {}
+        self.ongoing_pieces = {}
+        # The ongoing pieces that still have blocks left to request
+        self.partial_pieces = {}
         self.max_pending_time = 300 * 1000 # 5 minutes
-        self.missing_pieces = self._initiate_pieces()
         self.total_pieces = len(torrent.pieces)
-        # File segments are tuples of (global_start, global_end, fd)
+        # File segments are tuples of (global_start, global_end, path)
         # used when writing pieces that may span multiple output files.
         self.file_segments = []
-        self.path_redirects = {}
+        self.output_paths = OutputPaths()
         self._open_output_files()
-
-    def _find_existing_file_parent(self, file_path: str) -> str | None:
-        path_obj = Path(file_path)
-        parts = path_obj.parts
-        for depth in range(1, len(parts)):
-            candidate = Path(*parts[:depth])
-            if candidate.is_file():
-                return str(candidate)
-        return None
-
-    def _allocate_redirect_directory(self, blocked_dir: str) -> str:
-        if blocked_dir in self.path_redirects:
-            return self.path_redirects[blocked_dir]
-
-        index = 0
-        while True:
-            suffix = '_files' if index == 0 else f'_files_{index}'
-            candidate = f'{blocked_dir}{suffix}'
-            if not os.path.exists(candidate) or os.path.isdir(candidate):
-                self.path_redirects[blocked_dir] = candidate
-                logging.warning(
-                    'Output path %r is a file; writing multi-file torrent data under %r instead.',
-                    blocked_dir,
-                    candidate
-                )
-                return candidate
-            index += 1
-
-    def _resolve_output_path(self, file_path: str) -> str:
-        blocked_parent = self._find_existing_file_parent(file_path)
-        if not blocked_parent:
-            return file_path
-
-        redirect_root = self._allocate_redirect_directory(blocked_parent)
-        relative_path = os.path.relpath(file_path, blocked_parent)
-        return os.path.join(redirect_root, relative_path)
+        self.storage = Storage(self.file_segments)
+        # The pieces already on disk are known from the resume file, or by
+        # rechecking the files
+        self.resume = FastResume(f'{torrent.output_file}.fastresume',
+                                 torrent.info_hash, self.file_segments)
+        self.have_pieces = self._existing_pieces()
+        # Called with the index of each piece downloaded and verified, e.g.
+        # to let the peers know
+        self.on_piece_verified = None
+        # The pieces read for uploading, the reads in progress by piece
+        # index and the bytes of blocks uploaded
+        self.read_cache = ReadCache()
+        self._reading = {}
+        self.uploaded = 0
+        self.missing_pieces = {piece.index: piece
+                               for piece in self._initiate_pieces()
+                               if not self.have_pieces[piece.index]}
+        # The number of peers having each piece, and the missing pieces
+        # bucketed by that number (i.e. rarity_buckets[2] are the missing
+        # pieces two peers have). Each bucket is a list, the position of a
+        # piece within its bucket is kept so it can be moved in O(1).
+        self.availability = [0] * self.total_pieces
+        self.rarity_buckets = [list(self.missing_pieces)]
+        self.bucket_positions = [0] * self.total_pieces
+        for position, index in enumerate(self.rarity_buckets[0]):
+            self.bucket_positions[index] = position
 
     def _open_output_files(self):
         """
@@ -318,7 +762,7 @@ class PieceManager:
         """
         offset = 0
         for torrent_file in self.torrent.files:
-            file_path = self._resolve_output_path(torrent_file.name)
+            file_path = self.output_paths.resolve(torrent_file.name)
             directory = os.path.dirname(file_path)
             if directory:
                 if os.path.isfile(directory):
@@ -332,10 +776,52 @@ class PieceManager:
                     f'Cannot open output file {file_path!r}: a directory exists at that path.'
                 )
 
-            fd = os.open(file_path, os.O_RDWR | os.O_CREAT)
-            self.file_segments.append((offset, offset + torrent_file.length, fd))
+            # Create the file, it is opened by the storage when used
+            os.close(os.open(file_path, os.O_RDWR | os.O_CREAT))
+            self.file_segments.append(
+                (offset, offset + torrent_file.length, file_path))
             offset += torrent_file.length
 
+    def _existing_pieces(self) -> CompactBitfield:
+        """
+        Find out which pieces are already downloaded, from the resume file if
+        it is up to date, else by hashing the pieces found in the files.
+        """
+        pieces = self.resume.load(self.total_pieces)
+        if pieces is not None:
+            have = CompactBitfield(self.total_pieces, pieces)
+            logging.info('Resuming with %d / %d pieces', have.count(),
+                         self.total_pieces)
+            return have
+
+        have = CompactBitfield(self.total_pieces)
+        if not any(os.path.getsize(path)
+                   for _, _, path in self.file_segments):
+            return have
+        logging.info('Rechecking the existing files...')
+        start = time.monotonic()
+        for index, match in verify_pieces(
+                self.file_segments, self.torrent.piece_length,
+                self.torrent.total_size, self.torrent.pieces,
+                executor=self.hash_executor):
+            if match:
+                have[index] = 1
+        logging.info('Recheck found %d / %d pieces in %.1f s', have.count(),
+                     self.total_pieces, time.monotonic() - start)
+        return have
+
+    def save_resume(self):
+        """
+        Have the disk workers write the resume file (after writing out the
+        cached blocks, the pieces in it must be on disk)
+        """
+        pieces = bytes(self.have_pieces)
+        self._submit(lambda _: None, self._write_resume, pieces)
+
+    def _write_resume(self, pieces: bytes):
+        self.storage.flush()
+        self.resume.save(pieces)
+
     def _initiate_pieces(self) -> list[Piece]:
         """
         Pre-construct the list of pieces and blocks based on the number of
@@ -344,39 +830,59 @@ class PieceManager:
         torrent = self.torrent
         pieces = []
         total_pieces = len(torrent.pieces)
-        std_piece_blocks = math.ceil(torrent.piece_length / REQUEST_SIZE)
 
         for index, hash_value in enumerate(torrent.pieces):
-            # The number of blocks for each piece can be calculated using the
-            # request size as divisor for the piece length.
-            # The final piece however, will most likely have fewer blocks
-            # than 'regular' pieces, and that final block might be smaller
-            # then the other blocks.
+            # Every piece has the same length except for the final one,
+            # which gets what is left of the torrent. Each piece is divided
+            # into blocks of the request size, where the final block of a
+            # piece might be smaller.
             if index < (total_pieces - 1):
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(std_piece_blocks)]
+                piece_length = torrent.piece_length
             else:
-                last_length = torrent.total_size % torrent.piece_length
-                num_blocks = math.ceil(last_length / REQUEST_SIZE)
-                blocks = [Block(index, offset * REQUEST_SIZE, REQUEST_SIZE)
-                          for offset in range(num_blocks)]
-
-                if last_length % REQUEST_SIZE > 0:
-                    # Last block of the last piece might be smaller than
-                    # the ordinary request size.
-                    last_block = blocks[-1]
-                    last_block.length = last_length % REQUEST_SIZE
-                    blocks[-1] = last_block
+                piece_length = (torrent.total_size -
+                                torrent.piece_length * (total_pieces - 1))
+            blocks = [Block(index, offset,
+                            min(REQUEST_SIZE, piece_length - offset))
+                      for offset in range(0, piece_length, REQUEST_SIZE)]
             pieces.append(Piece(index, blocks, hash_value))
         return pieces
 
+    def _submit(self, callback, fn, *args):
+        """
+        Submit a disk job, counted in `outstanding_jobs` until its callback ran
+        """
+        self.outstanding_jobs += 1
+
+        def done(result):
+            self.outstanding_jobs -= 1
+            callback(result)
+            if not self.outstanding_jobs and self._disk_idle is not None:
+                self._disk_idle.set()
+
+        self.disk.submit(done, fn, *args)
+
+    async def drain(self):
+        """
+        Wait for the disk jobs of this torrent to complete, i.e. until it can
+        be closed without closing disk workers shared with other torrents
+        """
+        if self._disk_idle is None:
+            self._disk_idle = asyncio.Event()
+        while self.outstanding_jobs:
+            self._disk_idle.clear()
+            await self._disk_idle.wait()
+
     def close(self):
         """
-        Close any resources used by the PieceManager (such as open files)
+        Close any resources used by the PieceManager (such as open files).
+
+        `drain()` must be awaited before, else the disk jobs not completed
+        yet are lost.
         """
-        for _, _, fd in self.file_segments:
-            os.close(fd)
-        self.file_segments = []
+        if self._owns_disk:
+            self.disk.close()
+        self.storage.close()
+        self.resume.save(bytes(self.have_pieces))
 
     @property
     def complete(self):
@@ -385,7 +891,7 @@ class PieceManager:
 
         :return: True if all pieces are fully downloaded else False
         """
-        return len(self.have_pieces) == self.total_pieces
+        return self.have_pieces.all()
 
     @property
     def bytes_downloaded(self) -> int:
@@ -393,36 +899,173 @@ class PieceManager:
         Get the number of bytes downloaded.
         This method only counts full, verified, pieces, not single blocks.
         """
-        return len(self.have_pieces) * self.torrent.piece_length
+        downloaded = self.have_pieces.count() * self.torrent.piece_length
+        last = self.total_pieces - 1
+        if self.have_pieces[last]:
+            # The final piece can be shorter
+            downloaded -= self.torrent.piece_length - self.piece_size(last)
+        return downloaded
 
     @property
     def bytes_uploaded(self) -> int:
         """
-        To be implemented later.
+        Get the number of bytes of blocks uploaded.
+        """
+        return self.uploaded
+
+    def piece_size(self, index: int) -> int:
+        """
+        The length of a piece, only the final piece can be shorter
         """
-        # TODO Add support for sending data
-        return 0
+        if index < self.total_pieces - 1:
+            return self.torrent.piece_length
+        return self.torrent.total_size - \
+            self.torrent.piece_length * (self.total_pieces - 1)
+
+    def can_upload(self, index: int, begin: int, length: int) -> bool:
+        """
+        Check that a block requested by a peer is one we can send
+        """
+        return 0 <= index < self.total_pieces and \
+            bool(self.have_pieces[index]) and \
+            0 < length <= MAX_UPLOAD_REQUEST and \
+            0 <= begin and begin + length <= self.piece_size(index)
+
+    def block_file_ranges(self, index: int, begin: int,
+                          length: int) -> list | None:
+        """
+        Where a block to upload is in the files, to send it straight from
+        them. None if the block is in the read cache or not written to the
+        files yet, it is then sent with `read_block`.
+        """
+        if index in self.read_cache.pieces:
+            return None
+        return self.storage.file_ranges(
+            index * self.torrent.piece_length + begin, length)
+
+    async def read_block(self, index: int, begin: int,
+                         length: int) -> memoryview:
+        """
+        Read a block to upload, from the read cache or else by having the
+        disk workers read (and cache) its whole piece
+
+        :raises OSError: If the piece could not be read
+        """
+        data = self.read_cache.get(index)
+        if data is None:
+            # Several peers often ask for blocks of the same piece
+            reading = self._reading.get(index)
+            if reading is None:
+                reading = asyncio.get_running_loop().create_future()
+                self._reading[index] = reading
+                self._submit(
+                    lambda data: self._piece_read(index, data),
+                    self.storage.read, index * self.torrent.piece_length,
+                    self.piece_size(index))
+            data = await asyncio.shield(reading)
+            if data is None:
+                raise OSError(f'Unable to read piece {index}')
+        return memoryview(data)[begin:begin + length]
+
+    def _piece_read(self, index: int, data: bytes | None):
+        if data is not None:
+            self.read_cache.put(index, data)
+        self._reading.pop(index).set_result(data)
+
+    def block_uploaded(self, length: int):
+        self.uploaded += length
 
     def add_peer(self,peer_id, bitfield):
         """
         Adds a peer and the bitfield representing the pieces the peer has.
         """
+        if peer_id in self.peers:
+            self._forget_pieces(self.peers[peer_id])
+        else:
+            self.windows[peer_id] = RequestWindow()
+        # Drop the padding bits the bitfield was received with
+        bitfield = bitfield.resized(self.total_pieces)
         self.peers[peer_id] = bitfield
+        for index in bitfield:
+            self._change_availability(index, 1)
 
     def update_peer(self, peer_id, index: int):
         """
         Updates the information about which pieces a peer has (reflects a Have
         message).
         """
-        if peer_id in self.peers:
-            self.peers[peer_id][index] = 1
+        if index >= self.total_pieces:
+            return
+        if peer_id not in self.peers:
+            # The bitfield message is optional for peers without pieces
+            self.add_peer(peer_id, CompactBitfield(self.total_pieces))
+        bitfield = self.peers[peer_id]
+        if not bitfield[index]:
+            bitfield[index] = 1
+            self._change_availability(index, 1)
 
     def remove_peer(self, peer_id):
         """
         Tries to remove a previously added peer(e.g, used if a peer connection is dropped)
         """
         if peer_id in self.peers:
-            del self.peers[peer_id]
+            self._forget_pieces(self.peers.pop(peer_id))
+            self.cancel_requests(peer_id)
+            del self.windows[peer_id]
+
+    def _forget_pieces(self, bitfield):
+        for index in bitfield:
+            self._change_availability(index, -1)
+
+    def is_interesting(self, peer_id) -> bool:
+        """
+        Checks if the given peer has any piece we do not have
+        """
+        bitfield = self.peers.get(peer_id)
+        return bitfield is not None and \
+            bitfield.has_any_not_in(self.have_pieces)
+
+    def request_window(self, peer_id) -> int:
+        """
+        Get the number of requests that can currently be sent to the given
+        peer.
+        """
+        window = self.windows.get(peer_id)
+        return window.available if window else 0
+
+    def cancel_requests(self, peer_id):
+        """
+        Forget about all requests pending for the given peer (e.g. the peer
+        choked us and therefore discarded them), the blocks are put back as
+        missing unless they are requested from other peers too.
+        """
+        for key in [key for key, others in self.endgame_requests.items()
+                    if peer_id in others]:
+            others = self.endgame_requests[key]
+            del others[peer_id]
+            if not others:
+                del self.endgame_requests[key]
+            self._index_candidate(key, len(others) + 1)
+        cancelled = [key for key, request in self.pending_blocks.items()
+                     if request.peer_id == peer_id]
+        for key in cancelled:
+            block = self.pending_blocks.pop(key).block
+            others = self.endgame_requests.pop(key, None)
+            if others:
+                # Pending for one of the other peers from now on
+                other_id, added = others.popitem()
+                self._add_pending(PendingRequest(block, added, other_id))
+                if others:
+                    self.endgame_requests[key] = others
+                self._index_candidate(key, len(others) + 1)
+                continue
+            self._index_candidate(key, 0)
+            piece = self.ongoing_pieces.get(block.piece)
+            if piece:
+                piece.block_missing(block)
+                self.partial_pieces[piece.index] = piece
+        if peer_id in self.windows:
+            self.windows[peer_id].reset()
 
     def next_request(self, peer_id) -> Block:
         """
@@ -431,24 +1074,28 @@ class PieceManager:
         If there are no more blocks left to retrieve or if this peer does not
         have any of the missing pieces None is returned
         """
-        # The algorithm implemented for which piece to retrieve is a simple
-        # one. This should preferably be replaced with an implementation of
-        # "rarest-piece-first" algorithm instead.
-        #
-        # The algorithm tries to download the pieces in sequence and will try
-        # to finish started pieces before starting with new pieces.
+        # The algorithm will try to finish started pieces before starting
+        # with new pieces, new pieces are picked "rarest-piece-first".
         #
         # 1. Check any pending blocks to see if any request should be reissued
         #    due to timeout
         # 2. Check the ongoing pieces to get the next block to request
-        # 3. Check if this peer have any of the missing pieces not yet started
+        # 3. Start the rarest of the missing pieces that this peer have
         if peer_id not in self.peers:
             return None
         block = self._expired_requests(peer_id)
         if not block:
             block = self._next_ongoing(peer_id)
             if not block:
-                block = self._get_rarest_piece(peer_id).next_request()
+                block = self._get_rarest_piece(peer_id)
+            if block:
+                self._add_pending(PendingRequest(
+                    block, int(round(time.time() * 1000)), peer_id))
+                self._index_candidate((block.piece, block.offset), None)
+            elif self.endgame:
+                block = self._endgame_request(peer_id)
+        if block:
+            self.windows[peer_id].request_sent()
         return block
 
     def block_received(self, peer_id, piece_index, block_offset,data):
@@ -456,42 +1103,91 @@ class PieceManager:
         This method must be called when a block has successfully been retrieved
         by a peer.
 
-        Once a full piece have been retrieved, a SHA1 hash control is made. If
-        the check fails all the pieces blocks are put back in missing state to
-        be fetched again. If the hash succeeds the partial piece is written to
-        disk and the piece is indicated as Have.
+        The block is written to disk and hashed by the disk workers. Once a
+        full piece have been retrieved and all its blocks are written, a SHA1
+        hash control is made (also by the disk workers). If the check fails
+        all the pieces blocks are put back in missing state to be fetched
+        again (and are overwritten on disk). If the hash succeeds the piece is
+        indicated as Have.
         """
         logging.debug('Received block %s for piece %s from peer %s:',
                       block_offset, piece_index, peer_id)
 
-        # Remove from pending requests
-        for index, request in enumerate(self.pending_blocks):
-            if request.block.piece == piece_index and \
-            request.block.offset == block_offset:
-                del self.pending_blocks[index]
-                break
-
-        pieces = [p for p in self.ongoing_pieces if p.index == piece_index]
-        piece = pieces[0] if pieces else None
+        # Remove from pending requests, the block may be requested from
+        # other peers too (in endgame mode, or re-requested once expired)
+        key = (piece_index, block_offset)
+        request = self.pending_blocks.pop(key, None)
+        requesters = self.endgame_requests.pop(key, None) or {}
+        if request is not None:
+            self._index_candidate(key, len(requesters))
+            requesters[request.peer_id] = request.added
+        added = requesters.pop(peer_id, None)
+        if added is not None and peer_id in self.windows:
+            self.windows[peer_id].request_done(time.time() - added / 1000)
+        if requesters:
+            for other in requesters:
+                if other in self.windows:
+                    self.windows[other].request_done()
+            if self.on_block_cancelled is not None:
+                self.on_block_cancelled(request.block, list(requesters))
+        if peer_id in self.windows:
+            self.windows[peer_id].data_received(len(data))
+
+        piece = self.ongoing_pieces.get(piece_index)
         if piece:
-            piece.block_received(block_offset, data)
+            if not piece.block_received(block_offset):
+                # A copy of a block received from another peer already
+                self.duplicate_bytes += len(data)
+                return
             if piece.is_complete():
-                if piece.is_hash_matching():
-                    self._write(piece)
-                    self.ongoing_pieces.remove(piece)
-                    self.have_pieces.append(piece)
-                    complete = (self.total_pieces-
-                                len(self.missing_pieces) -
-                                len(self.ongoing_pieces))
-                    logging.info(
-                        '%d / %d pieces downloaded %.3f %%',
-                        complete, self.total_pieces, (complete/self.total_pieces)*100
-                    )
-                else:
-                    logging.info('Discarding corrupt piece %s', piece.index)
-                    piece.reset()
-            else:
-                logging.warning('Trying to update piece that is not ongoing!')
+                self.partial_pieces.pop(piece_index, None)
+            piece.disk_jobs += 1
+            self._submit(lambda _: self._block_stored(piece),
+                         self._store_block, piece, block_offset, data)
+        elif piece_index < self.total_pieces and \
+                self.have_pieces[piece_index]:
+            # A copy of a block of a piece verified since
+            self.duplicate_bytes += len(data)
+        else:
+            logging.warning('Trying to update piece that is not ongoing!')
+
+    def _store_block(self, piece: Piece, offset: int, data):
+        """
+        Write and hash a received block, run by the disk workers
+        """
+        self._write_block(piece.index, offset, data)
+        piece.hash_block(offset, data)
+
+    def _block_stored(self, piece: Piece):
+        """
+        Called once a block is written and hashed, verifies the piece once
+        all its blocks are.
+        """
+        piece.disk_jobs -= 1
+        if piece.is_complete() and not piece.disk_jobs:
+            self._submit(lambda match: self._piece_verified(piece, match),
+                         piece.is_hash_matching, self._read_block)
+
+    def _piece_verified(self, piece: Piece, match: bool):
+        """
+        Called with the result of the hash control of a complete piece
+        """
+        if match:
+            del self.ongoing_pieces[piece.index]
+            self.have_pieces[piece.index] = 1
+            piece.reset()
+            complete = self.total_pieces - len(self.missing_pieces) \
+                - len(self.ongoing_pieces)
+            logging.info(
+                '%d / %d pieces downloaded %.3f %%',
+                complete, self.total_pieces, (complete/self.total_pieces)*100
+            )
+            if self.on_piece_verified is not None:
+                self.on_piece_verified(piece.index)
+        else:
+            logging.info('Discarding corrupt piece %s', piece.index)
+            piece.reset()
+            self.partial_pieces[piece.index] = piece
 
     def _expired_requests(self, peer_id) -> Block:
         """
@@ -502,86 +1198,177 @@ class PieceManager:
         If no pending blocks exist, None is returned
         """
         current = int(round(time.time() * 1000))
-        for request in self.pending_blocks:
-            if self.peers[peer_id][request.block.piece]:
-                if request.added + self.max_pending_time < current:
-                    logging.info('Re-requesting block %s for piece %s',
-                                 request.block.offset, request.block.piece)
-                    # Reset expiration timer
-                    request.added = current
-                    return request.block
+        order = self.pending_order
+        while order and not self._is_pending(order[0]):
+            order.popleft()
+        # The requests are in the order they were requested, so only the
+        # expired ones at the front need to be looked at.
+        for request in order:
+            if request.added + self.max_pending_time >= current:
+                break
+            if self._is_pending(request) and \
+                    self.peers[peer_id][request.block.piece] and \
+                    peer_id not in self.endgame_requests.get(
+                        (request.block.piece, request.block.offset), ()):
+                logging.info('Re-requesting block %s for piece %s',
+                             request.block.offset, request.block.piece)
+                if request.peer_id in self.windows:
+                    self.windows[request.peer_id].request_timed_out()
+                # Reset expiration timer, now pending for this peer
+                self._add_pending(request._replace(added=current,
+                                                   peer_id=peer_id))
+                return request.block
         return None
+
+    @property
+    def endgame(self) -> bool:
+        """
+        If every block left that any peer has is requested already
+        """
+        return bool(self.pending_blocks) and not self.partial_pieces and \
+            len(self.missing_pieces) == len(self.rarity_buckets[0])
+
+    def _endgame_request(self, peer_id) -> Block:
+        """
+        Pick a pending block the peer has and is not requested from it, the
+        one requested from the fewest peers, to request it again
+
+        :return: The block, None if there is none
+        """
+        bitfield = self.peers[peer_id]
+        best = None
+        for count in range(ENDGAME_REQUESTS - 1):
+            for key in self.endgame_candidates.get(count, ()):
+                if self.pending_blocks[key].peer_id != peer_id and \
+                        bitfield[key[0]] and \
+                        peer_id not in self.endgame_requests.get(key, ()):
+                    best = key
+                    break
+            if best is not None:
+                break
+        if best is None:
+            return None
+        self.endgame_requests.setdefault(best, {})[peer_id] = \
+            int(round(time.time() * 1000))
+        self._index_candidate(best, count)
+        return self.pending_blocks[best].block
+
+    def _index_candidate(self, key, count: int | None):
+        """
+        Move a block in `endgame_candidates` once the number of other peers
+        it is requested from changed from `count` (None if it was not
+        pending), or once it is no longer pending
+        """
+        if count is not None:
+            bucket = self.endgame_candidates[count]
+            del bucket[key]
+            if not bucket:
+                del self.endgame_candidates[count]
+        if key in self.pending_blocks:
+            count = len(self.endgame_requests.get(key, ()))
+            self.endgame_candidates.setdefault(count, {})[key] = None
+
+    def _add_pending(self, request: PendingRequest):
+        self.pending_blocks[(request.block.piece, request.block.offset)] = request
+        self.pending_order.append(request)
+
+    def _is_pending(self, request: PendingRequest) -> bool:
+        key = (request.block.piece, request.block.offset)
+        return self.pending_blocks.get(key) is request
     def _next_ongoing(self, peer_id) -> Block:
         """
         Go through the ongoing pieces and reutrn the next block to be
         requested or None if no block is left to be requested.
         """
-        for piece in self.ongoing_pieces:
+        for piece in self.partial_pieces.values():
             if self.peers[peer_id][piece.index]:
-                #Is there any blocks left to request in this piece?
                 block = piece.next_request()
-                if block:
-                    self.pending_blocks.append(
-                        PendingRequest(block, int(round(time.time()* 1000))))
-                    return block
+                if not piece.missing:
+                    # Every block of the piece is now requested
+                    del self.partial_pieces[piece.index]
+                return block
         return None
 
-    def _get_rarest_piece(self, peer_id):
+    def _get_rarest_piece(self, peer_id) -> Block:
         """
         Given the current list of missing pieces, get the
         rarest one first (i.e. a piece which fewest of its
-        neighboring peers have)
-        """
-        piece_count = defaultdict(int)
-        for piece in self.missing_pieces:
-            if not self.peers[peer_id][piece.index]:
-                continue
-            for p, bitfield in self.peers.items():
-                if bitfield[p.index]:
-                    piece_count[piece] += 1
-
-        rarest_piece = min(piece_count, key=lambda p: piece_count[p])
-        self.missing_pieces.remove(rarest_piece)
-        self.ongoing_pieces.append(rarest_piece)
-        return rarest_piece
+        neighboring peers have) and return its first block.
 
-    def _next_missing(self, peer_id) -> Block:
-        """
-        Go through the missing pieces and return the next block to request
-        or None if no block is left to be requested.
-        
-        This will change the state of the piece from missing to ongoing - thus
-        the next call to this function will not continue with the blocks for 
-        that piece, rather get the next missing piece.
+        This will change the state of the piece from missing to ongoing.
         """
-        for index, piece in enumerate(self.missing_pieces):
-            if self.peers[peer_id][piece.index]:
-                #Move this peice from missing to ongoing
-                piece = self.missing_pieces.pop(index)
-                self.ongoing_pieces.append(piece)
-                # The missing pieces does not have any previously requested
-                # blocks (then it is ongoing)
-                return piece.next_request()
+        bitfield = self.peers[peer_id]
+        # The missing pieces are bucketed by availability, so the rarest
+        # pieces are looked at first. Bucket 0 holds the pieces no peer has.
+        for bucket in self.rarity_buckets[1:]:
+            for position in range(len(bucket) - 1, -1, -1):
+                index = bucket[position]
+                if bitfield[index]:
+                    return self._start_piece(index)
         return None
 
-    def _write(self,piece):
+    def _start_piece(self, index: int) -> Block:
         """
-        Write the given piece to disk
+        Move a piece from missing to ongoing and return its first block
         """
-        piece_data = piece.data
-        piece_start = piece.index * self.torrent.piece_length
-        piece_end = piece_start + len(piece_data)
+        self._remove_from_bucket(index)
+        piece = self.missing_pieces.pop(index)
+        self.ongoing_pieces[index] = piece
+        # The missing pieces does not have any previously requested
+        # blocks (then it is ongoing)
+        block = piece.next_request()
+        if piece.missing:
+            self.partial_pieces[index] = piece
+        return block
 
-        for file_start, file_end, fd in self.file_segments:
-            overlap_start = max(piece_start, file_start)
-            overlap_end = min(piece_end, file_end)
-            if overlap_start >= overlap_end:
-                continue
+    def _change_availability(self, index: int, delta: int):
+        """
+        Update the number of peers having the given piece, moving the piece
+        to its new bucket if it is still missing.
+        """
+        if index in self.missing_pieces:
+            self._remove_from_bucket(index)
+            self.availability[index] += delta
+            self._add_to_bucket(index)
+        else:
+            self.availability[index] += delta
+
+    def _add_to_bucket(self, index: int):
+        count = self.availability[index]
+        while len(self.rarity_buckets) <= count:
+            self.rarity_buckets.append([])
+        bucket = self.rarity_buckets[count]
+        self.bucket_positions[index] = len(bucket)
+        bucket.append(index)
+
+    def _remove_from_bucket(self, index: int):
+        # Swap the last piece of the bucket into the removed position
+        bucket = self.rarity_buckets[self.availability[index]]
+        position = self.bucket_positions[index]
+        last = bucket.pop()
+        if last != index:
+            bucket[position] = last
+            self.bucket_positions[last] = position
+
+    def flush_expired(self):
+        """
+        Have the disk workers write out the cached blocks if they have been
+        cached for too long
+        """
+        if self.storage.expired:
+            self._submit(lambda _: None, self.storage.flush)
 
-            data_offset = overlap_start - piece_start
-            chunk_length = overlap_end - overlap_start
-            chunk = piece_data[data_offset:data_offset + chunk_length]
+    def _write_block(self, piece_index: int, offset: int, data):
+        """
+        Write a received block to its place on disk
+        """
+        self.storage.write(
+            piece_index * self.torrent.piece_length + offset, data)
 
-            file_offset = overlap_start - file_start
-            os.lseek(fd, file_offset, os.SEEK_SET)
-            os.write(fd, chunk)
+    def _read_block(self, block: Block) -> bytes:
+        """
+        Read a previously written block back from disk
+        """
+        return self.storage.read(
+            block.piece * self.torrent.piece_length + block.offset,
+            block.length)
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DiskIO:
+    """
+    Runs the disk writes and piece hashing off the event loop, on a pool of
+    threads (hashlib and file I/O release the GIL, so the work does run in
+    parallel with the event loop and with each other).
+
+    Jobs are submitted from the event loop together with a callback that is
+    called back on the event loop with the result of the job. The jobs
+    submitted during one iteration of the event loop are handed to a worker
+    as one batch, and their results come back together, since handing over
+    single block sized jobs costs about as much as doing them. The number of
+    jobs queued or running is limited by `max_queued`: the submitter checks
+    `backlogged` and waits for room before taking on more work (i.e. the
+    peer connections stop reading). The limit is soft, a job submitted while
+    backlogged is still run.
+
+    With no workers the jobs are run right away in the calling thread, which
+    is useful when there is no event loop (e.g. in benchmarks).
+    """
+    WORKERS = 4
+    MAX_QUEUED = 64
+
+    def __init__(self, workers: int = WORKERS, max_queued: int = MAX_QUEUED):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.executor = ThreadPoolExecutor(
+            workers, thread_name_prefix='disk') if workers else None
+        self._loop = None
+        self._room = None
+        # Jobs not yet handed to a worker
+        self._batch = []
+        # Jobs submitted and not yet completed, and the most seen at once
+        self.queued = 0
+        self.peak_queued = 0
+        self.completed = 0
+        # Seconds from submitting a job until its result is back on the
+        # event loop, moving average and max
+        self.latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def backlogged(self) -> bool:
+        """
+        True if no more jobs should be submitted for now
+        """
+        return self.queued >= self.max_queued
+
+    async def wait_for_room(self):
+        """
+        Wait until the queue is below its limit
+        """
+        if self._room is None:
+            self._room = asyncio.Event()
+        while self.backlogged:
+            self._room.clear()
+            await self._room.wait()
+
+    def submit(self, callback, fn, *args):
+        """
+        Run `fn(*args)` on a worker and call `callback` with its result on
+        the event loop. If the job fails the error is logged and `callback`
+        is called with None.
+        """
+        self.queued += 1
+        self.peak_queued = max(self.peak_queued, self.queued)
+        submitted = time.monotonic()
+        if self.executor is None:
+            self._job_done(callback, submitted, self._run(fn, args))
+            return
+        if not self._batch:
+            if self._loop is None:
+                self._loop = asyncio.get_running_loop()
+            self._loop.call_soon(self._dispatch)
+        self._batch.append((callback, submitted, fn, args))
+
+    def _dispatch(self):
+        batch, self._batch = self._batch, []
+        if batch:
+            # Else handed over already, by `close`
+            self.executor.submit(self._run_batch, batch)
+
+    def _run_batch(self, batch: list):
+        results = [(callback, submitted, self._run(fn, args))
+                   for callback, submitted, fn, args in batch]
+        self._loop.call_soon_threadsafe(self._batch_done, results)
+
+    def _run(self, fn, args):
+        try:
+            return fn(*args)
+        except Exception:
+            logging.exception('Disk job failed')
+            return None
+
+    def _batch_done(self, results: list):
+        for callback, submitted, result in results:
+            self._job_done(callback, submitted, result)
+
+    def _job_done(self, callback, submitted: float, result):
+        self.queued -= 1
+        self.completed += 1
+        latency = time.monotonic() - submitted
+        self.latency = 0.9 * self.latency + 0.1 * latency
+        self.max_latency = max(self.max_latency, latency)
+        if self._room is not None and not self.backlogged:
+            self._room.set()
+        callback(result)
+
+    def close(self):
+        """
+        Wait for the submitted jobs to finish and stop the workers. The
+        jobs not handed to a worker yet are run first; their callbacks still
+        come back on the event loop, so the submitters wait for them (e.g.
+        `PieceManager.drain`) before closing what the callbacks use.
+        """
+        if self.executor is not None:
+            # The jobs submitted during this iteration of the event loop
+            self._dispatch()
+            self.executor.shutdown(wait=True)
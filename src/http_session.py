@@ -0,0 +1,109 @@
+"""
+The HTTP session shared by the trackers of all torrents.
+
+A single `aiohttp.ClientSession` keeps the connections to the trackers
+alive between announces and caches the DNS lookups of their host names, so
+a re-announce (or an announce for another torrent on the same tracker) does
+not pay for a new lookup and TCP/TLS handshake. The connections per host
+are limited so many torrents on the same tracker do not flood it.
+"""
+import asyncio
+
+import aiohttp
+
+# Connections open at once, in total and per tracker host
+CONNECTION_LIMIT = 100
+CONNECTION_LIMIT_PER_HOST = 4
+# Seconds a DNS lookup is cached for
+DNS_CACHE_TTL = 300
+# Seconds an idle connection is kept open for
+KEEPALIVE_TIMEOUT = 60
+# Seconds to connect to a tracker, to wait for data from it, and for the
+# whole request
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 20
+TOTAL_TIMEOUT = 30
+
+
+class HTTPSessionManager:
+    """
+    Hands out the shared `aiohttp.ClientSession`, created on first use (in
+    the running event loop) and counts how often its connections and DNS
+    lookups are reused.
+    """
+    def __init__(self):
+        self._session = None
+        self._loop = None
+        # Requests sent, connections opened and reused, DNS cache hits and
+        # misses (lookups)
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+
+    @property
+    def reuse_rate(self) -> float:
+        """
+        The share of the requests sent on a kept alive connection
+        """
+        total = self.connections_created + self.connections_reused
+        return self.connections_reused / total if total else 0.0
+
+    def session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or \
+                self._loop is not loop:
+            # A session can only be used in the loop it was created in
+            self._loop = loop
+            self._session = self._create_session()
+        return self._session
+
+    def get(self, url: str):
+        """
+        Send a GET request, used as `async with manager.get(url) as response`
+        """
+        self.requests += 1
+        return self.session().get(url)
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=CONNECTION_LIMIT,
+            limit_per_host=CONNECTION_LIMIT_PER_HOST,
+            use_dns_cache=True,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(total=TOTAL_TIMEOUT,
+                                        sock_connect=CONNECT_TIMEOUT,
+                                        sock_read=READ_TIMEOUT)
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._connection_created)
+        trace.on_connection_reuseconn.append(self._connection_reused)
+        trace.on_dns_cache_hit.append(self._dns_hit)
+        trace.on_dns_cache_miss.append(self._dns_miss)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout,
+                                     trace_configs=[trace])
+
+    async def _connection_created(self, session, context, params):
+        self.connections_created += 1
+
+    async def _connection_reused(self, session, context, params):
+        self.connections_reused += 1
+
+    async def _dns_hit(self, session, context, params):
+        self.dns_hits += 1
+
+    async def _dns_miss(self, session, context, params):
+        self.dns_misses += 1
+
+    async def close(self):
+        if self._session is not None:
+            if not self._session.closed and \
+                    self._loop is asyncio.get_running_loop():
+                await self._session.close()
+            self._session = None
+            self._loop = None
+
+
+# The session manager of the process, shared by all trackers
+http_sessions = HTTPSessionManager()
@@ -2,10 +2,22 @@ import argparse
 import asyncio
 import signal
 import logging
+import time
 
+from .acceptor import Acceptor, listen_socket
+from .choker import UNCHOKE_SLOTS
 from .torrent import Torrent
 from .client import TorrentClient
+from .http_session import http_sessions
+from .session import MAX_CONNECTIONS, Session
+from .storage import OutputPaths
+from .supervisor import Supervisor
 from .tracker import Tracker
+from .verify import file_segments, verify_pieces
+
+
+# Seconds between logging the counters of a session
+SESSION_REPORT_INTERVAL = 15
 
 
 def _log_torrent_summary(torrent: Torrent):
@@ -15,25 +27,221 @@ def _log_torrent_summary(torrent: Torrent):
     logging.info('Trackers: %d', len(torrent.announce_urls))
 
 
+def _format_ranges(indexes: list[int]) -> str:
+    """
+    Format sorted piece indexes as ranges, e.g. "3-7, 12"
+    """
+    ranges = []
+    for index in indexes:
+        if ranges and ranges[-1][1] == index - 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ', '.join(str(first) if first == last else f'{first}-{last}'
+                     for first, last in ranges)
+
+
+def _rate(kib_s: float | None) -> float | None:
+    """
+    A rate limit given in KiB/s in bytes per second, None if not given
+    """
+    return kib_s * 1024 if kib_s else None
+
+
+def _check(torrent: Torrent) -> int:
+    """
+    Verify the downloaded files of the torrent against its piece hashes,
+    found where the download writes them
+    """
+    total_pieces = len(torrent.pieces)
+    bad = []
+    start = time.monotonic()
+    reported = start
+    for index, match in verify_pieces(
+            file_segments(torrent.files, OutputPaths().resolve),
+            torrent.piece_length,
+            torrent.total_size, torrent.pieces):
+        if not match:
+            bad.append(index)
+        now = time.monotonic()
+        if now - reported >= 5:
+            logging.info('Checked %d / %d pieces', index + 1, total_pieces)
+            reported = now
+    elapsed = max(time.monotonic() - start, 1e-9)
+
+    print(f'Checked {total_pieces} pieces ({torrent.total_size} bytes) in '
+          f'{elapsed:.1f} s, {torrent.total_size / elapsed / 2**30:.2f} GB/s')
+    if bad:
+        print(f'{len(bad)} bad pieces: {_format_ranges(bad)}')
+        return 1
+    print('All pieces are good')
+    return 0
+
+
+async def _scrape(torrent: Torrent) -> int:
+    """
+    Scrape every tracker of the torrent and print its numbers of peers
+    """
+    tracker = Tracker(torrent)
+    urls = [url for tier in torrent.announce_tiers for url in tier]
+    try:
+        results = await asyncio.gather(
+            *(tracker.scrape_tracker(url, [torrent.info_hash]) for url in urls),
+            return_exceptions=True)
+    finally:
+        await tracker.close()
+    scraped = 0
+    for url, result in zip(urls, results):
+        if isinstance(result, ConnectionError):
+            print(f'{url}: {result}')
+        elif isinstance(result, BaseException):
+            raise result
+        elif torrent.info_hash not in result:
+            print(f'{url}: torrent not known to tracker')
+        else:
+            stats = result[torrent.info_hash]
+            print(f'{url}: seeders={stats.complete} leechers={stats.incomplete} '
+                  f'downloaded={stats.downloaded}')
+            scraped += 1
+    return 0 if scraped else 1
+
+
+async def _run_session(args) -> int:
+    """
+    Download the given torrents, and those put in the watched directory, in
+    one `Session`, or sharded over worker processes with `--processes`
+    """
+    options = dict(
+        max_connections=args.max_connections,
+        download_limit=_rate(args.download_limit),
+        upload_limit=_rate(args.upload_limit),
+        torrent_download_limit=_rate(args.torrent_download_limit),
+        torrent_upload_limit=_rate(args.torrent_upload_limit),
+        peer_download_limit=_rate(args.peer_download_limit),
+        peer_upload_limit=_rate(args.peer_upload_limit),
+        use_protocol=args.use_protocol,
+        seed=args.seed,
+        upload_slots=args.upload_slots)
+    if args.processes > 1:
+        session = Supervisor(args.processes, **options)
+        session.start()
+    else:
+        session = Session(listen_socket=listen_socket(), **options)
+    stopping = asyncio.Event()
+
+    def signal_handler(*_):
+        logging.info('Exiting, please wait untill everything is shutdown...')
+        stopping.set()
+
+    signal.signal(signal.SIGINT, signal_handler)
+
+    for path in args.torrent:
+        await session.add_file(path)
+    if args.watch:
+        # Runs until interrupted
+        waiting = asyncio.create_task(session.watch(args.watch))
+    else:
+        waiting = asyncio.create_task(session.wait())
+    stop = asyncio.create_task(stopping.wait())
+    try:
+        while not waiting.done() and not stop.done():
+            await asyncio.wait([waiting, stop], timeout=SESSION_REPORT_INTERVAL)
+            # A supervisor has no counters until the workers sent them
+            stats = session.stats()
+            logging.info('Session: %d torrents downloading, %d completed, '
+                         '%d failed, %d peers connected, %d bytes downloaded',
+                         stats.get('torrents', 0), stats.get('completed', 0),
+                         stats.get('failed', 0), stats.get('connections', 0),
+                         stats.get('downloaded', 0))
+    finally:
+        waiting.cancel()
+        stop.cancel()
+        await session.close()
+    return 1 if session.stats().get('failed') else 0
+
+
 async def async_main():
+    try:
+        return await _async_main()
+    finally:
+        # The HTTP session shared by the trackers
+        await http_sessions.close()
+
+
+async def _async_main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('torrent', help='the .torrent to download')
+    parser.add_argument('torrent', nargs='*',
+                        help='the .torrent file(s) to download')
     parser.add_argument("-v","--verbose",action='store_true', help ='enable verbose output')
     parser.add_argument('--show-trackers', action='store_true',
                         help='print announce URLs and exit')
     parser.add_argument('--probe-trackers', action='store_true',
                         help='announce once to tracker(s) and exit')
+    parser.add_argument('--scrape', action='store_true',
+                        help='print the numbers of seeders and leechers '
+                             'reported by each tracker and exit')
+    parser.add_argument('--use-protocol', action='store_true',
+                        help='use the asyncio.Protocol based peer transport')
+    parser.add_argument('--check', action='store_true',
+                        help='verify the downloaded files against the piece '
+                             'hashes and exit')
+    parser.add_argument('--seed', action='store_true',
+                        help='keep uploading once downloaded, until '
+                             'interrupted')
+    parser.add_argument('--upload-slots', type=int, default=UNCHOKE_SLOTS,
+                        metavar='N',
+                        help='peers of each torrent uploaded to for their '
+                             'rate, besides one optimistic unchoke '
+                             '(default %(default)s)')
+    parser.add_argument('--watch', metavar='DIR',
+                        help='also download the .torrent files put in DIR, '
+                             'until interrupted')
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help='peer connections open at once over all torrents '
+                             '(default %(default)s)')
+    parser.add_argument('--processes', type=int, default=1, metavar='N',
+                        help='download in N worker processes, e.g. one per '
+                             'core (default %(default)s)')
+    parser.add_argument('--download-limit', type=float, metavar='KIB_S',
+                        help='download rate limit over all torrents, in KiB/s')
+    parser.add_argument('--upload-limit', type=float, metavar='KIB_S',
+                        help='upload rate limit over all torrents, in KiB/s')
+    parser.add_argument('--torrent-download-limit', type=float,
+                        metavar='KIB_S',
+                        help='download rate limit of each torrent, in KiB/s')
+    parser.add_argument('--torrent-upload-limit', type=float, metavar='KIB_S',
+                        help='upload rate limit of each torrent, in KiB/s')
+    parser.add_argument('--peer-download-limit', type=float, metavar='KIB_S',
+                        help='download rate limit from each peer, in KiB/s')
+    parser.add_argument('--peer-upload-limit', type=float, metavar='KIB_S',
+                        help='upload rate limit to each peer, in KiB/s')
     args = parser.parse_args()
     if args.verbose:
         logging.basicConfig(level=logging.INFO)
 
-    torrent = Torrent(args.torrent)
+    if not args.torrent and not args.watch:
+        parser.error('a .torrent file or --watch is required')
+    if len(args.torrent) > 1 or args.watch or args.download_limit or \
+            args.upload_limit or args.processes > 1:
+        if args.show_trackers or args.check or args.scrape or \
+                args.probe_trackers:
+            parser.error('--show-trackers, --check, --scrape and '
+                         '--probe-trackers take a single .torrent file')
+        return await _run_session(args)
+
+    torrent = Torrent(args.torrent[0])
 
     if args.show_trackers:
         for idx, url in enumerate(torrent.announce_urls, start=1):
             print(f'{idx}. {url}')
         return 0
 
+    if args.check:
+        return _check(torrent)
+
+    if args.scrape:
+        return await _scrape(torrent)
+
     if args.probe_trackers:
         tracker = Tracker(torrent)
         try:
@@ -50,11 +258,21 @@ async def async_main():
     _log_torrent_summary(torrent)
 
     try:
-        client = TorrentClient(torrent)
+        client = TorrentClient(torrent, use_protocol=args.use_protocol,
+                               seed=args.seed, upload_slots=args.upload_slots,
+                               download_limit=_rate(args.torrent_download_limit),
+                               upload_limit=_rate(args.torrent_upload_limit),
+                               peer_download_limit=_rate(args.peer_download_limit),
+                               peer_upload_limit=_rate(args.peer_upload_limit))
     except (RuntimeError, OSError, ValueError) as exc:
         logging.error(str(exc))
         return 1
 
+    acceptor = Acceptor()
+    sock = listen_socket()
+    if sock is not None:
+        await acceptor.start(sock)
+        acceptor.add(torrent.info_hash, client)
     task = asyncio.create_task(client.start())
 
     def signal_handler(*_):
@@ -74,6 +292,9 @@ async def async_main():
         logging.error(str(exc))
         return 1
     finally:
+        acceptor.close()
+        if sock is not None:
+            sock.close()
         await client.close()
 
 
@@ -1,118 +1,567 @@
 import asyncio
 import logging
+import os
 import struct
 from asyncio import Queue
+from collections import deque, namedtuple
 from concurrent.futures import CancelledError
 
-import bitstring
+from .bitfield import CompactBitfield
+from .ratelimit import RateMeter, TokenBucket, limiter
 
 
 REQUEST_SIZE = 2**14
+# Seconds to wait for a connection to a peer to be opened
+CONNECT_TIMEOUT = 10
+
+# Send the uploaded blocks straight from the files (zero-copy) where the
+# transport allows it, else they are read through the read cache
+SENDFILE = hasattr(os, 'sendfile')
+# The smallest block sent with sendfile. A block is sent with `os.sendfile`
+# while the transport has nothing buffered, only the rest waits on
+# `loop.sendfile` (which waits for the buffer to empty and pauses reading):
+# from 16 KiB blocks on par with the read cache (testing/upload_bench.py).
+SENDFILE_MIN_LENGTH = REQUEST_SIZE
+# Requests of a peer queued at once, the ones beyond are dropped
+MAX_UPLOAD_QUEUE = 256
+# Requests for larger blocks than this are not served
+MAX_UPLOAD_REQUEST = 2**17
+# The longest message accepted from a peer, unless its bitfield is longer:
+# a Piece message (id, index and begin) with the largest block served
+MAX_MESSAGE_LENGTH = 9 + MAX_UPLOAD_REQUEST
+
+# A peer that connected to us: its (ip, port), the transport (not reading),
+# its handshake and the data received after it
+InboundPeer = namedtuple('InboundPeer',
+                         ['address', 'transport', 'handshake', 'data'])
+
+def max_message_length(pieces: int) -> int:
+    """
+    The longest message accepted from a peer of a torrent of `pieces`
+    pieces, a Piece message or its BitField message
+    """
+    return max(MAX_MESSAGE_LENGTH, 1 + (pieces + 7) // 8)
 
 class ProtocolError(BaseException):
     # TODO: implemnt protocol error class.
     pass
 
 class PeerConnection:
+    """
+    A peer connection used to download and upload pieces.
+
+    The peer connection will consume one available peer from the given queue.
+    Based on the peer details the PeerConnection will try to open a connection
+    and perform a BitTorrent handshake.
+
+    A peer taken from the queue is either an (ip, port) to connect to, or
+    an `InboundPeer` that connected to us (see `acceptor.py`), whose
+    connection is taken over.
+
+    The connection either uses asyncio streams together with a
+    `PeerStreamIterator` (default) or, if `use_protocol` is set, a
+    `PeerProtocol` where messages are parsed and handled directly as data is
+    received without any coroutine switches.
+
+    Once interested the peer is unchoked, or if `on_interested` is given
+    (i.e. a `Choker`) left to it. The requests of an unchoked peer for the
+    pieces we have are queued and sent one at a time by an upload task (so a Cancel
+    drops the requests not sent yet). A block is sent from the files with
+    `os.sendfile` / `loop.sendfile` when it is on disk and the transport
+    supports it, else it is read through the read cache of the piece
+    manager.
+    """
     def __init__(self,queue:Queue, info_hash,
-                peer_id, piece_manager, on_block_cb = None ):
+                peer_id, piece_manager, on_block_cb = None,
+                use_protocol: bool = False,
+                on_interested = None,
+                connection_budget: asyncio.Semaphore | None = None,
+                download_limiter: TokenBucket | None = None,
+                upload_limiter: TokenBucket | None = None,
+                download_limit: float | None = None,
+                upload_limit: float | None = None):
         self.my_state = []
         self.peer_state = []
         self.queue = queue
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.remote_id = None
+        # The (ip, port) of the peer this connection was assigned
+        self.address = None
         self.writer = None
         self.reader = None
+        # The transport written to, also in stream mode, and the protocol
+        # in protocol mode
+        self.transport = None
+        self._protocol = None
         self.piece_manager = piece_manager
+        self.max_message_length = max_message_length(
+            piece_manager.total_pieces)
         self.on_block_cb = on_block_cb
+        self.use_protocol = use_protocol
+        # Called with the connection when the peer becomes interested
+        self.on_interested = on_interested
+        # The rates of the blocks received from and sent to the peer
+        self.download_meter = RateMeter()
+        self.upload_meter = RateMeter()
+        # Connections open at once, shared with the connections of other
+        # torrents
+        self.connection_budget = connection_budget
+        # The download rate limit, and the bytes of blocks received since
+        # it was last applied. The limiters given are the ones of the
+        # torrent (or session), the limits are per peer and nest under them
+        self.download_limiter = limiter(download_limit, download_limiter)
+        self._downloaded = 0
+        self.upload_limiter = limiter(upload_limit, upload_limiter)
+        # If we choke the peer, the (index, begin, length) of its requests
+        # to send, and the task sending them
+        self.am_choking = True
+        self._uploads = deque()
+        self._uploading = None
+        self._sendfile = SENDFILE
+        # Messages written while a block is sent from a file, a transport
+        # cannot be written to then
+        self._held = None
         self.future= asyncio.ensure_future(self._start())
-    
+
     async def _start(self):
         while 'stopped' not in self.my_state:
-            ip,port = await self.queue.get()
+            peer = await self.queue.get()
+            inbound = peer if isinstance(peer, InboundPeer) else None
+            ip, port = self.address = inbound.address if inbound else peer
             logging.info('Got assigned peer with:{ip}'.format(ip=ip))
 
+            if self.connection_budget is not None:
+                await self.connection_budget.acquire()
             try:
-                #TODO's: Fix second loop not starting
-                # Add support for sending data
-                self.reader, self.writer = await asyncio.open_connection(
-                    ip,port)
-                logging.info('Connection open to peer: {ip}'.format(ip=ip))
-
-                buffer = await self._handshake()
-                # default state for a connection
-                self.my_state.append('choked')
-
-                # Lets the peer know of interest
-                await self._send_interested()
-                self.my_state.append('interested')
-
-                #Start reading responses as a stream of messages as
-                # long as the connection is open and data is transmitted 
-                async for message in PeerStreamIterator(self.reader,buffer):
-                    if 'stopped' in self.my_state:
-                        break
-                    if type(message) is BitField:
-                        self.piece_manager.add_peer(self.remote_id,
-                                                    message.bitfield)
-                    elif type(message) is Interested:
-                        self.peer_state.append('interested')
-                    elif type(message) is NotInterested:
-                        if 'interested' in self.peer_state:
-                            self.peer_state.remove('interested')
-                    elif type(message) is Choke:
-                        self.my_state.append('choked')
-                    elif type(message) is Unchoke:
-                        if 'choked' in self.my_state:
-                            self.my_state.remove('choked')
-                    elif type(message) is Have:
-                        self.piece_manager.update_peer(self.remote_id,
-                                                       message.index)
-                    elif type(message) is KeepAlive:
-                        pass
-                    elif type(message) is Piece:
-                        self.my_state.remove('pending_request')
-                        self.on_block_cb(
-                            peer_id=self.remote_id,
-                            piece_index=message.index,
-                            block_offset=message.begin,
-                            data=message.block)
-                    elif type(message) is Request:
-                        # TODO support for sending data
-                        logging.info('Ignoring the received Request message.')
-                    elif type(message) is Cancel:
-                        # TODO support for sending data
-                        logging.info('Ignoring the reeived Cancel Message.')
-                    
-                    # TODO maybe find a cleaner way to rewrite this section.
-                    # it might be the best way to do it but pretty ugly.
-                    if 'choked' not in self.my_state:
-                        if 'interested' in self.my_state:
-                            if 'pending_request' not in self.my_state:
-                                self.my_state.append('pending_request')
-                                await self._request_piece()
+                if inbound:
+                    await self._run_inbound(inbound)
+                elif self.use_protocol:
+                    await self._run_protocol(ip, port)
+                else:
+                    await self._run_stream(ip, port)
             except ProtocolError:
                 logging.exception('Protocol error')
-            except (ConnectionRefusedError, TimeoutError):
-                logging.warning('Unable to connect to peer')
             except (ConnectionResetError, CancelledError):
                 logging.warning('Connection closed')
+            except OSError as e:
+                # Refused, unreachable or timed out: on to the next peer
+                logging.warning('Unable to connect to peer: %r', e)
             except Exception as e:
                 logging.exception('An error occurred')
                 self.cancel()
                 raise e
+            finally:
+                if self.connection_budget is not None:
+                    self.connection_budget.release()
             self.cancel()
+
+    async def _run_stream(self, ip, port):
+        """
+        Download from the peer using asyncio streams
+        """
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(ip, port), CONNECT_TIMEOUT)
+        self.transport = self.writer.transport
+        logging.info('Connection open to peer: {ip}'.format(ip=ip))
+
+        buffer = await self._handshake()
+        self._on_handshake()
+        await self._stream_messages(buffer)
+
+    async def _stream_messages(self, buffer: bytes):
+        """
+        Handle the messages read from the stream, the handshakes are done
+        """
+        #Start reading responses as a stream of messages as
+        # long as the connection is open and data is transmitted
+        async for message in PeerStreamIterator(
+                self.reader, buffer, self.max_message_length,
+                self._wait_to_read):
+            if 'stopped' in self.my_state:
+                break
+            self._handle_message(message)
+            if self._request_piece():
+                await self.writer.drain()
+
+    async def _wait_to_read(self):
+        """
+        Stop reading from the peer while the disk is behind, or while over
+        the download rate limit with the messages handled since the last read
+        """
+        disk = self.piece_manager.disk
+        delay = self.read_delay()
+        if not disk.backlogged and not delay:
+            return
+        # Unless the reader already paused it for its buffer being full
+        pause = self.transport.is_reading()
+        if pause:
+            self.transport.pause_reading()
+        try:
+            if delay:
+                await asyncio.sleep(delay)
+            await disk.wait_for_room()
+        finally:
+            if pause and not self.transport.is_closing():
+                self.transport.resume_reading()
+
+    async def _run_protocol(self, ip, port):
+        """
+        Download from the peer using a `PeerProtocol`, the messages are
+        handled by the protocol as they are received.
+        """
+        loop = asyncio.get_running_loop()
+        transport, protocol = await asyncio.wait_for(
+            loop.create_connection(lambda: PeerProtocol(self), ip, port),
+            CONNECT_TIMEOUT)
+        self.writer = self.transport = transport
+        self._protocol = protocol
+        logging.info('Connection open to peer: {ip}'.format(ip=ip))
+
+        self.writer.write(Handshake(self.info_hash,self.peer_id).encode())
+        await protocol.closed
+
+    async def _run_inbound(self, peer: InboundPeer):
+        """
+        Take over the connection of a peer that connected to us, and answer
+        its handshake
+        """
+        transport = peer.transport
+        try:
+            self._validate_handshake(peer.handshake)
+        except ProtocolError:
+            transport.abort()
+            raise
+        if transport.is_closing():
+            return
+        handshake = Handshake(self.info_hash, self.peer_id).encode()
+        if self.use_protocol:
+            protocol = PeerProtocol(self)
+            protocol.handshaked = True
+            transport.set_protocol(protocol)
+            protocol.connection_made(transport)
+            self.writer = self.transport = transport
+            self._protocol = protocol
+            self.writer.write(handshake)
+            self._on_handshake()
+            if peer.data:
+                protocol.framer.feed(peer.data)
+                protocol.buffer_updated(0)
+            transport.resume_reading()
+            await protocol.closed
+        else:
+            loop = asyncio.get_running_loop()
+            self.reader = asyncio.StreamReader()
+            protocol = asyncio.StreamReaderProtocol(self.reader)
+            transport.set_protocol(protocol)
+            protocol.connection_made(transport)
+            self.writer = asyncio.StreamWriter(transport, protocol,
+                                               self.reader, loop)
+            self.transport = transport
+            self.writer.write(handshake)
+            self._on_handshake()
+            transport.resume_reading()
+            await self._stream_messages(peer.data)
+
+    def _on_handshake(self):
+        """
+        Called once the handshake is completed
+        """
+        # default state for a connection, we let the peer know of our
+        # interest once we know which pieces it has.
+        self.my_state.append('choked')
+        have = self.piece_manager.have_pieces
+        if have.count():
+            self._send(BitField(have).encode())
+
+    def _update_interest(self):
+        """
+        Let the peer know if we are interested or not, depending on if it has
+        any piece we do not have.
+        """
+        interested = self.piece_manager.is_interesting(self.remote_id)
+        if interested and 'interested' not in self.my_state:
+            self._send(Interested().encode())
+            self.my_state.append('interested')
+        elif not interested and 'interested' in self.my_state:
+            self._send(NotInterested().encode())
+            self.my_state.remove('interested')
+
+    def _handle_message(self, message):
+        """
+        Update the connection state and the piece manager from a message
+        received from the remote peer.
+        """
+        if type(message) is BitField:
+            self.piece_manager.add_peer(self.remote_id,
+                                        message.bitfield)
+            self._update_interest()
+        elif type(message) is Interested:
+            if 'interested' not in self.peer_state:
+                self.peer_state.append('interested')
+            if self.on_interested is None:
+                self.unchoke()
+            else:
+                self.on_interested(self)
+        elif type(message) is NotInterested:
+            if 'interested' in self.peer_state:
+                self.peer_state.remove('interested')
+        elif type(message) is Choke:
+            self.my_state.append('choked')
+            # The peer discards our requests when choking us
+            self.piece_manager.cancel_requests(self.remote_id)
+        elif type(message) is Unchoke:
+            if 'choked' in self.my_state:
+                self.my_state.remove('choked')
+        elif type(message) is Have:
+            self.piece_manager.update_peer(self.remote_id,
+                                           message.index)
+            if 'interested' not in self.my_state:
+                self._update_interest()
+        elif type(message) is KeepAlive:
+            pass
+        elif type(message) is Piece:
+            self._downloaded += len(message.block)
+            self.download_meter.add(len(message.block))
+            self.on_block_cb(
+                peer_id=self.remote_id,
+                piece_index=message.index,
+                block_offset=message.begin,
+                data=message.block)
+        elif type(message) is Request:
+            self._queue_upload(message)
+        elif type(message) is Cancel:
+            try:
+                self._uploads.remove(
+                    (message.index, message.begin, message.length))
+            except ValueError:
+                # Sent already (or never queued)
+                pass
+
+    @property
+    def download_rate(self) -> float:
+        """
+        Bytes per second received from the peer, recently
+        """
+        return self.download_meter.rate
+
+    @property
+    def upload_rate(self) -> float:
+        """
+        Bytes per second sent to the peer, recently
+        """
+        return self.upload_meter.rate
+
+    def read_delay(self) -> float:
+        """
+        The seconds to stop reading for, to keep to the download rate limit
+        with the blocks received since the last call
+        """
+        if self.download_limiter is None or not self._downloaded:
+            return 0.0
+        downloaded, self._downloaded = self._downloaded, 0
+        return self.download_limiter.consume(downloaded)
+
+    def _send(self, data: bytes):
+        """
+        Write a message to the peer, after the block being sent from a file
+        if there is one
+        """
+        if self._held is not None:
+            self._held.append(data)
+        else:
+            self.writer.write(data)
+
+    def unchoke(self):
+        """
+        Let the peer request blocks from us
+        """
+        if self.am_choking and self.writer is not None:
+            self.am_choking = False
+            self._send(Unchoke().encode())
+
+    def choke(self):
+        """
+        Stop serving the peer, its queued requests are dropped
+        """
+        if not self.am_choking and self.writer is not None:
+            self.am_choking = True
+            self._uploads.clear()
+            self._send(Choke().encode())
+
+    def send_cancel(self, index: int, begin: int, length: int):
+        """
+        Let the peer know we no longer want a block we requested
+        """
+        if self.writer is not None:
+            self._send(Cancel(index, begin, length).encode())
+
+    def send_have(self, index: int):
+        """
+        Let the peer know we have a new piece, unless it has it too
+        """
+        if self.remote_id is None or self.writer is None:
+            return
+        bitfield = self.piece_manager.peers.get(self.remote_id)
+        if bitfield is None or not bitfield[index]:
+            self._send(Have(index).encode())
+
+    def _queue_upload(self, request: 'Request'):
+        """
+        Queue a block requested by the peer to be sent, if we serve it
+        """
+        if self.am_choking or len(self._uploads) >= MAX_UPLOAD_QUEUE or \
+                not self.piece_manager.can_upload(
+                    request.index, request.begin, request.length):
+            logging.debug('Ignoring request for block %s of piece %s',
+                          request.begin, request.index)
+            return
+        self._uploads.append((request.index, request.begin, request.length))
+        if self._uploading is None:
+            self._uploading = asyncio.ensure_future(self._upload())
+
+    async def _upload(self):
+        """
+        Send the queued blocks, one at a time, until the queue is empty
+        """
+        try:
+            while self._uploads and self.transport is not None and \
+                    not self.transport.is_closing():
+                index, begin, length = self._uploads.popleft()
+                await self._send_block(index, begin, length)
+                self.piece_manager.block_uploaded(length)
+                self.upload_meter.add(length)
+                await self._drain()
+                delay = self.upload_delay(length)
+                if delay:
+                    await asyncio.sleep(delay)
+        except (OSError, RuntimeError) as exc:
+            # The connection is closed, or closing
+            logging.debug('Stopped uploading to peer: %s', exc)
+        finally:
+            if self._uploading is asyncio.current_task():
+                self._uploading = None
+
+    async def _send_block(self, index: int, begin: int, length: int):
+        """
+        Send a Piece message with a block, from the files if possible
+        """
+        header = struct.pack('>IbII', Piece.length + length,
+                             PeerMessage.Piece, index, begin)
+        ranges = self.piece_manager.block_file_ranges(index, begin, length) \
+            if self._sendfile and length >= SENDFILE_MIN_LENGTH else None
+        socket = self._sendfile_socket() if ranges is not None else None
+        if socket is None:
+            block = await self.piece_manager.read_block(index, begin, length)
+            self.transport.writelines((header, block))
+            return
+
+        files = self.piece_manager.storage.files
+        self.transport.write(header)
+        sent = 0
+        if not self.transport.get_write_buffer_size():
+            # The header is sent, the socket is ours until we write again:
+            # send what it takes right away, without waiting on the loop
+            for path, offset, count in ranges:
+                with files.open(path) as fd:
+                    try:
+                        count_sent = os.sendfile(socket, fd, offset, count)
+                    except (BlockingIOError, InterruptedError):
+                        count_sent = 0
+                sent += count_sent
+                if count_sent < count:
+                    break
+        if sent == length:
+            return
+        # The rest once the socket has room, other messages are held until
+        # the block is sent
+        loop = asyncio.get_running_loop()
+        self._held = []
+        try:
+            try:
+                skip = sent
+                for path, offset, count in ranges:
+                    if skip >= count:
+                        skip -= count
+                        continue
+                    with files.open(path) as fd, \
+                            open(fd, 'rb', closefd=False) as file:
+                        await loop.sendfile(self.transport, file,
+                                            offset + skip, count - skip,
+                                            fallback=False)
+                    sent += count - skip
+                    skip = 0
+            except asyncio.SendfileNotAvailableError:
+                # e.g. a TLS transport, read the blocks from now on
+                self._sendfile = False
+            if sent < length:
+                block = await self.piece_manager.read_block(
+                    index, begin, length)
+                self.transport.write(memoryview(block)[sent:])
+        finally:
+            held, self._held = self._held, None
+            if held and self.transport is not None:
+                self.transport.writelines(held)
+
+    def _sendfile_socket(self) -> int | None:
+        """
+        The file descriptor of the socket to send a block to with
+        `os.sendfile`, None if the transport has data buffered (it would
+        be sent first) or is not a plain socket (e.g. TLS)
+        """
+        if self.transport.get_write_buffer_size():
+            return None
+        socket = self.transport.get_extra_info('socket')
+        if socket is None or \
+                self.transport.get_extra_info('sslcontext') is not None:
+            self._sendfile = False
+            return None
+        return socket.fileno()
+
+    async def _drain(self):
+        """
+        Wait until the data written to the peer is mostly sent
+        """
+        if self._protocol is not None:
+            await self._protocol.drain()
+        elif self.writer is not None:
+            await self.writer.drain()
+
+    def upload_delay(self, uploaded: int) -> float:
+        """
+        The seconds to wait before sending more, to keep to the upload rate
+        limit
+        """
+        if self.upload_limiter is None:
+            return 0.0
+        return self.upload_limiter.consume(uploaded)
+
     def cancel(self):
         """
         Sends cancel message to the remote peer and closes the connection
         """
 
         logging.info('Closing peer {id}'.format(id=self.remote_id))
-        if not self.future.done():
-            self.future.cancel()
+        if self._uploading is not None:
+            self._uploading.cancel()
+            self._uploading = None
+        self._uploads.clear()
+        self._held = None
+        self.am_choking = True
         if self.writer:
             self.writer.close()
+            self.writer = None
+        self.transport = None
+        self._protocol = None
+        if self.remote_id is not None:
+            self.piece_manager.remove_peer(self.remote_id)
+            self.remote_id = None
+        self.address = None
+        # Reset the state for the next peer (but keep if we are stopped)
+        self.my_state = [s for s in self.my_state if s == 'stopped']
+        self.peer_state = []
+        self.download_meter = RateMeter()
+        self.upload_meter = RateMeter()
 
         self.queue.task_done()
     
@@ -122,13 +571,29 @@ class PeerConnection:
         new connections
         """
         self.my_state.append('stopped')
+        if self.writer:
+            self.writer.close()
         if not self.future.done():
             self.future.cancel()
 
-    async def _request_piece(self):
-        block = self.piece_manager.next_request(self.remote_id)
-        if block:
-            message = Request(block.piece, block.offset, block.length).encode()
+    def _request_piece(self) -> bool:
+        """
+        Fill the request window the piece manager gives us for this peer,
+        i.e. keep that many requests outstanding (pipelined) at once.
+
+        :return: True if any request was written
+        """
+        if 'choked' in self.my_state or \
+                'interested' not in self.my_state:
+            return False
+
+        messages = []
+        for _ in range(self.piece_manager.request_window(self.remote_id)):
+            block = self.piece_manager.next_request(self.remote_id)
+            if not block:
+                break
+            messages.append(
+                Request(block.piece, block.offset, block.length).encode())
 
             logging.debug('Requesting block %s for piece %s '
                           'of %s bytes from peer %s',
@@ -136,35 +601,156 @@ class PeerConnection:
                           block.piece,
                           block.length,
                           self.remote_id)
-            
-            self.writer.write(message)
-            await self.writer.drain()
-                        
+
+        if not messages:
+            if self.piece_manager.request_window(self.remote_id):
+                # Nothing to request, maybe we are no longer interested
+                self._update_interest()
+            return False
+        self._send(b''.join(messages))
+        return True
+
     async def _handshake(self):
         """
         Sends the initial handshake to the remote peer and wait for
         the peer to respond with its handshake
         """
-        self.writer.write(HandShake(self.info_hash,self.peer_id).encode())
-        await self.writer.drait()
+        self.writer.write(Handshake(self.info_hash,self.peer_id).encode())
+        await self.writer.drain()
 
         buf = b""
         tries = 1 
         while len(buf) < Handshake.length and tries < 10:
             tries += 1 
-            buf = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
-        
-        response = Handshake.decode(buf[:Handshake.length])
+            buf += await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
+
+        self._validate_handshake(buf[:Handshake.length])
+        return buf[Handshake.length:]
+
+    def _validate_handshake(self, data: bytes):
+        """
+        Parse and validate the handshake received from the remote peer
+        """
+        response = Handshake.decode(data)
         if not response:
             raise ProtocolError('Unable to recieve and parse a handshake')
         if not response.info_hash == self.info_hash:
             raise ProtocolError('Handshake with invalid info_hash')
-        
+        peer_id = self.peer_id
+        if isinstance(peer_id, str):
+            peer_id = peer_id.encode('utf-8')
+        if response.peer_id == peer_id:
+            # The tracker handed out our own address
+            raise ProtocolError('Handshake with ourselves')
+
         #TODO: Validate that the peer_id received from the peer matches tracker
         self.remote_id = response.peer_id
         logging.info('Handshake with peer was successful')
 
-        return buf[Handshake.length:]
+class PeerProtocol(asyncio.BufferedProtocol):
+    """
+    Low-level transport for a `PeerConnection`.
+
+    Received data is read straight into the buffer of a `MessageFramer`, and
+    every complete message is handled by the `PeerConnection` from within
+    `buffer_updated`. Compared to the stream based transport this avoids a
+    coroutine switch per message and a `drain()` per request.
+    """
+    def __init__(self, connection: PeerConnection):
+        self.connection = connection
+        self.framer = MessageFramer(
+            max_length=connection.max_message_length)
+        self.transport = None
+        self.handshaked = False
+        # Completed once the connection is lost
+        self.closed = asyncio.get_running_loop().create_future()
+        # Cleared while the transport has too much data to send
+        self._writable = asyncio.Event()
+        self._writable.set()
+        # Resumes reading once paused, cancelled if the connection is lost
+        self._resuming = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.framer.get_buffer(sizehint)
+
+    def buffer_updated(self, nbytes: int):
+        self.framer.buffer_updated(nbytes)
+        try:
+            if not self.handshaked:
+                data = self.framer.take(Handshake.length)
+                if data is None:
+                    return
+                self.connection._validate_handshake(data)
+                self.handshaked = True
+                self.connection._on_handshake()
+
+            while True:
+                message = self.framer.next_message()
+                if not message:
+                    break
+                if 'stopped' in self.connection.my_state:
+                    self.transport.close()
+                    return
+                self.connection._handle_message(message)
+            self.connection._request_piece()
+            disk = self.connection.piece_manager.disk
+            delay = self.connection.read_delay()
+            if disk.backlogged or delay:
+                # Stop reading while the disk is behind, or while over the
+                # download rate limit
+                self.transport.pause_reading()
+                self._resuming = asyncio.ensure_future(
+                    self._resume_reading(disk, delay))
+        except ProtocolError as e:
+            # ProtocolError is not an Exception, so it is raised from the
+            # `PeerConnection` instead of within the event loop.
+            self._close(e)
+        except Exception as e:
+            logging.exception('Error when handling received data!')
+            self._close(e)
+
+    async def _resume_reading(self, disk, delay: float = 0.0):
+        if delay:
+            await asyncio.sleep(delay)
+        await disk.wait_for_room()
+        if not self.transport.is_closing():
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        self._writable.clear()
+
+    def resume_writing(self):
+        self._writable.set()
+
+    async def drain(self):
+        """
+        Wait until the transport is below its write buffer limit
+        """
+        await self._writable.wait()
+
+    def eof_received(self):
+        logging.debug('No data read from stream')
+        return False
+
+    def connection_lost(self, exc):
+        self._close(exc)
+
+    def _close(self, exc):
+        if self.transport:
+            self.transport.close()
+        if self._resuming is not None:
+            self._resuming.cancel()
+            self._resuming = None
+        self._writable.set()
+        if self.closed.done():
+            return
+        if exc is None or isinstance(exc, ConnectionResetError):
+            self.closed.set_result(None)
+        else:
+            self.closed.set_exception(exc)
 
 class PeerStreamIterator:
     """
@@ -172,46 +758,187 @@ class PeerStreamIterator:
     the given stream reader and tries to parse valid BitTorrent messages from
     off that stream of bytes.
 
+    The bytes read are handed to a `MessageFramer`, which owns the receive
+    buffer and does the actual message framing.
+
     If the connection is dropped, something fails the iterator will abort by
     raising the `StopAsyncIteration` error ending the calling iteration.
+
+    `before_read`, if given, is awaited before each read from the stream
+    (once the messages already buffered are handed out).
     """
-    CHUNK_SIZE = 10*1024
+    CHUNK_SIZE = 64*1024
 
-    def __init__(self, reader, initial:bytes = None):
+    def __init__(self, reader, initial:bytes = None,
+                 max_length: int = MAX_MESSAGE_LENGTH, before_read = None):
         self.reader = reader
-        self.buffer = initial if initial else b''
+        self.before_read = before_read
+        self.framer = MessageFramer(max_length=max_length)
+        if initial:
+            self.framer.feed(initial)
 
-    async def __aiter__(self):
+    def __aiter__(self):
         return self
-    
+
     async def __anext__(self):
-        # Read data from the socket. When we have enough data to parse, parse
-        # it and return the message. Until then keep reading from stream
+        # Parse any message already buffered before reading from the socket,
+        # a single read often contains several messages.
         while True:
+            message = self.framer.next_message()
+            if message:
+                return message
             try:
+                if self.before_read is not None:
+                    await self.before_read()
                 data = await self.reader.read(PeerStreamIterator.CHUNK_SIZE)
-                if data:
-                    self.buffer += data
-                    message = self.parse()
-                    if message:
-                        return message
-                else:
-                    logging.debug('No data read from stream')
-                    if self.buffer:
-                        message = self.parse()
-                        if message:
-                            return message 
-                    raise StopAsyncIteration()
             except ConnectionResetError:
                 logging.debug('Connection closed by peer')
                 raise StopAsyncIteration()
             except CancelledError:
                 raise StopAsyncIteration()
-            except StopAsyncIteration as e:
-                raise e 
-            except Exception:
-                logging.exception('Error when iterating over stream!')
-        raise StopAsyncIteration()  
+            if not data:
+                logging.debug('No data read from stream')
+                raise StopAsyncIteration()
+            self.framer.feed(data)
+
+class MessageFramer:
+    """
+    Splits a stream of bytes into BitTorrent messages.
+
+    Incoming data is copied once into a reusable `bytearray`, messages are
+    then parsed in place using offsets into that buffer. The block payload of
+    a `Piece` message is handed out as a `memoryview` into the buffer rather
+    than as a new `bytes` object.
+
+    Since a handed out block still references the buffer, the buffer is never
+    resized or overwritten once a block has been handed out from it. Instead
+    a new buffer is allocated the next time we run out of space, the old one
+    is released once all the blocks referencing it are dropped.
+
+    A message longer than `max_length` raises a `ProtocolError` as soon as
+    its length is read, before any room is made for it, and so does a
+    message too short or too long for its id once it is received.
+    """
+    BUFFER_SIZE = 256*1024
+
+    def __init__(self, size: int = BUFFER_SIZE,
+                 max_length: int = MAX_MESSAGE_LENGTH):
+        self.size = size
+        self.max_length = max_length
+        self.buffer = bytearray(size)
+        # The unparsed data is buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # Set when a view into the current buffer has been handed out
+        self.exported = False
+
+    def __len__(self):
+        return self.end - self.start
+
+    def get_buffer(self, sizehint: int = -1) -> memoryview:
+        """
+        Get a writable view of the free space at the end of the buffer, this
+        lets a transport read directly into the buffer.
+
+        The number of bytes written must be reported with `buffer_updated`.
+        """
+        self._reserve(sizehint if sizehint > 0 else 1)
+        return memoryview(self.buffer)[self.end:]
+
+    def buffer_updated(self, nbytes: int):
+        """
+        Report that `nbytes` were written into the view from `get_buffer`
+        """
+        self.end += nbytes
+
+    def take(self, length: int) -> bytes | None:
+        """
+        Remove and return the next `length` bytes that are not part of a
+        length prefixed message (i.e. the handshake).
+
+        :return: The data or None if not yet received
+        """
+        if self.end - self.start < length:
+            self._reserve(length - (self.end - self.start))
+            return None
+        data = bytes(self.buffer[self.start:self.start + length])
+        self.start += length
+        return data
+
+    def feed(self, data: bytes):
+        """
+        Append received data to the buffer
+        """
+        length = len(data)
+        self._reserve(length)
+        self.buffer[self.end:self.end + length] = data
+        self.end += length
+
+    def next_message(self):
+        """
+        Parse the next complete message in the buffer.
+
+        :return: The parsed message or None if more data is needed
+        """
+        # Unsupported messages are skipped
+        while True:
+            available = self.end - self.start
+            if available < 4:
+                return None
+            start = self.start
+            length = struct.unpack_from('>I', self.buffer, start)[0]
+            if length == 0:
+                self.start += 4
+                return KeepAlive()
+            if length > self.max_length:
+                raise ProtocolError(f'Message of {length} bytes')
+            if available < 4 + length:
+                # Make sure the entire message will fit once received
+                self._reserve(4 + length - available)
+                return None
+
+            self.start += 4 + length
+            end = start + 4 + length
+            message_id = self.buffer[start + 4]
+            expected = _MESSAGE_LENGTHS.get(message_id)
+            if expected is not None and length != expected or \
+                    message_id == PeerMessage.Piece and length < Piece.length:
+                raise ProtocolError(
+                    f'Message with id {message_id} of {length} bytes')
+            if message_id == PeerMessage.Piece:
+                self.exported = True
+                return Piece.decode(memoryview(self.buffer)[start:end])
+
+            message_type = _MESSAGE_TYPES.get(message_id)
+            if message_type is None:
+                logging.info('Unsupported message with id: %s', message_id)
+                continue
+            if length == 1:
+                return message_type()
+            return message_type.decode(bytes(self.buffer[start:end]))
+
+    def _reserve(self, length: int):
+        """
+        Make sure there are at least `length` free bytes after the unparsed
+        data.
+        """
+        if len(self.buffer) - self.end >= length:
+            return
+        unparsed = self.end - self.start
+        required = unparsed + length
+        if self.exported or required > len(self.buffer):
+            # A block might still be referencing the current buffer, the
+            # unparsed data is moved into a new buffer instead.
+            buffer = bytearray(max(self.size, required))
+            buffer[:unparsed] = memoryview(self.buffer)[self.start:self.end]
+            self.buffer = buffer
+            self.exported = False
+        else:
+            view = memoryview(self.buffer)
+            view[:unparsed] = view[self.start:self.end]
+            view.release()
+        self.start = 0
+        self.end = unparsed
 
 class PeerMessage:
     """
@@ -344,18 +1071,20 @@ class BitField(PeerMessage):
     """
 
     def __init__(self,data):
-        self.bitfield = bitstring.BitArray(bytes=data)
+        if isinstance(data, CompactBitfield):
+            self.bitfield = data
+        else:
+            # The number of pieces is not known here, the padding bits
+            # are included.
+            self.bitfield = CompactBitfield(len(data) * 8, data)
     
     def encode(self) -> bytes:
         """
         Encodes this object instance to the raw bytes representing the entire
         message (ready to be transmitted).
         """
-        bits_length = len(self.bitfield)
-        return struct.pack('>Ib' + str(bits_length) + 's',
-                           1 + bits_length,
-                           PeerMessage.BitField,
-                           self.bitfield)
+        bits = bytes(self.bitfield)
+        return struct.pack('>Ib', 1 + len(bits), PeerMessage.BitField) + bits
     @classmethod
     def decode(cls, data:bytes):
         message_length = struct.unpack('>I', data[:4])[0]
@@ -399,7 +1128,12 @@ class NotInterested(PeerMessage):
     Message format:
         <len=0001><id=3>
     """
-     
+
+    def encode(self) -> bytes:
+        return struct.pack('>Ib',
+                           1,  # Message length
+                           PeerMessage.NotInterested)
+
     def __str__(self):
         return 'NotInterested'
     
@@ -411,6 +1145,11 @@ class Choke(PeerMessage):
     Message format:
         <len=0001><id=0>
     """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib',
+                           1,  # Message length
+                           PeerMessage.Choke)
+
     def __str__(self):
         return 'Choke'
 
@@ -422,6 +1161,11 @@ class Unchoke(PeerMessage):
     Message format:
         <len=0001><id=1>
     """
+    def encode(self) -> bytes:
+        return struct.pack('>Ib',
+                           1,  # Message length
+                           PeerMessage.Unchoke)
+
     def __str__(self):
         return 'Unchoke'
 
@@ -471,19 +1215,19 @@ class Request(PeerMessage):
         self.begin = begin
         self.length = length
 
-        def encode(self):
-            return struct.pack('>IbIII',
+    def encode(self):
+        return struct.pack('>IbIII',
                            13,
                            PeerMessage.Request,
                            self.index,
                            self.begin,
                            self.length)
-        
-        @classmethod
-        def decode(cls, data:bytes):
-            logging.debug('Decoding Have of length: %s', len(data))
-        index = struct.unpack('>IbI', data)[2]
-        return cls(index)
+
+    @classmethod
+    def decode(cls, data:bytes):
+        logging.debug('Decoding Request of length: %s', len(data))
+        parts = struct.unpack('>IbIII', data)
+        return cls(parts[2], parts[3], parts[4])
 
     def __str__(self):
         return 'Request'
@@ -503,7 +1247,7 @@ class Piece(PeerMessage):
     # Message length without the block data
     length = 9
 
-    def __init__(self,index: int, begin: int, block: bytes):
+    def __init__(self,index: int, begin: int, block: bytes | memoryview):
         """
         Constructs the Piece message.
 
@@ -516,19 +1260,21 @@ class Piece(PeerMessage):
         self.block = block
     def encode(self):
         message_length = Piece.length + len(self.block)
-        return struct.pack('>IbII' + str(len(self.block)) + 's',
-                           message_length,
-                           PeerMessage.Piece,
-                           self.index,
-                           self.begin,
-                           self.block)
+        return b''.join((struct.pack('>IbII',
+                                     message_length,
+                                     PeerMessage.Piece,
+                                     self.index,
+                                     self.begin),
+                         self.block))
     @classmethod
-    def decode(cls,data: bytes):
+    def decode(cls,data: bytes | memoryview):
+        """
+        Decodes a Piece message, the block is returned as a `memoryview` of
+        the given data so the (large) block payload is not copied.
+        """
         logging.debug('Decoding Piece of length: %s', len(data))
-        length = struct.unpack('>I',data[:4])[0]
-        parts = struct.unpack('>IbII' + str(length - Piece.length) + "s",
-                              data[:length+4])
-        return cls(parts[2], parts[3], parts[4])
+        length, _, index, begin = struct.unpack_from('>IbII', data)
+        return cls(index, begin, memoryview(data)[13:length + 4])
     
     def __str__(self):
         return 'Piece'
@@ -558,10 +1304,32 @@ class Cancel(PeerMessage):
     @classmethod 
     def decode(cls,data: bytes):
         logging.debug('Decoding Cancel of length: %s', len(data))
-        parts = struct.unpack('IbIII',data)
+        parts = struct.unpack('>IbIII',data)
         return cls(parts[2], parts[3], parts[4])
     
     def __str__(self):
         return 'Cancel'
 
-
+# Message types that can be received after the handshake, by message id.
+_MESSAGE_TYPES = {
+    PeerMessage.Choke: Choke,
+    PeerMessage.Unchoke: Unchoke,
+    PeerMessage.Interested: Interested,
+    PeerMessage.NotInterested: NotInterested,
+    PeerMessage.Have: Have,
+    PeerMessage.BitField: BitField,
+    PeerMessage.Request: Request,
+    PeerMessage.Piece: Piece,
+    PeerMessage.Cancel: Cancel,
+}
+
+# The length (id and payload) of the messages of a fixed length, by message id
+_MESSAGE_LENGTHS = {
+    PeerMessage.Choke: 1,
+    PeerMessage.Unchoke: 1,
+    PeerMessage.Interested: 1,
+    PeerMessage.NotInterested: 1,
+    PeerMessage.Have: 5,
+    PeerMessage.Request: 13,
+    PeerMessage.Cancel: 13,
+}
@@ -0,0 +1,106 @@
+"""
+Token buckets limiting the download and upload rates, and meters measuring
+them.
+
+A bucket fills with `rate` tokens (bytes) per second up to `burst`.
+Transferring data takes its size in tokens, and may take the bucket into
+debt: instead of waiting for tokens before each message, the connection
+goes on and then stops reading for as long as it takes the bucket to get
+out of debt.
+
+Buckets nest: the bucket of a peer has the bucket of its torrent as parent,
+which has the bucket of the session (all torrents) as parent. Data taken
+from a bucket is taken from its parents too, and the connection waits for
+the one deepest in debt.
+
+A meter keeps an exponential moving average of a rate, which costs the same
+for every message whatever the window.
+"""
+import math
+import time
+
+# Seconds the rates measured are averaged over, about
+RATE_WINDOW = 20
+
+
+class TokenBucket:
+    """
+    A token bucket of `rate` bytes per second
+    """
+    def __init__(self, rate: float, burst: float | None = None,
+                 parent: 'TokenBucket | None' = None):
+        """
+        :param rate: Bytes per second
+        :param burst: The most bytes that can be transferred at once after
+                      being idle, a second worth of the rate by default
+        :param parent: The bucket of a wider limit the data is taken from
+                       too, if any
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.parent = parent
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def consume(self, amount: int) -> float:
+        """
+        Take the tokens for `amount` bytes, from this bucket and its parents
+
+        :return: The seconds until the buckets are out of debt, 0 if none
+                 is in debt
+        """
+        now = time.monotonic()
+        delay = 0.0
+        bucket = self
+        while bucket is not None:
+            bucket._refill(now)
+            bucket.tokens -= amount
+            if bucket.tokens < 0:
+                delay = max(delay, -bucket.tokens / bucket.rate)
+            bucket = bucket.parent
+        return delay
+
+
+def limiter(rate: float | None,
+            parent: TokenBucket | None = None) -> TokenBucket | None:
+    """
+    A bucket of `rate` bytes per second under `parent`, or `parent` itself
+    if there is no rate to keep to
+    """
+    return TokenBucket(rate, parent=parent) if rate else parent
+
+
+class RateMeter:
+    """
+    The rate of bytes transferred, averaged over about `window` seconds
+    """
+    def __init__(self, window: float = RATE_WINDOW):
+        self.window = window
+        self.total = 0
+        self._rate = 0.0
+        self.updated = time.monotonic()
+
+    def _decay(self, now: float):
+        self._rate *= math.exp((self.updated - now) / self.window)
+        self.updated = now
+
+    def add(self, amount: int):
+        """
+        Count `amount` bytes transferred now
+        """
+        self._decay(time.monotonic())
+        self._rate += amount / self.window
+        self.total += amount
+
+    @property
+    def rate(self) -> float:
+        """
+        Bytes per second
+        """
+        self._decay(time.monotonic())
+        return self._rate
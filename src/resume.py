@@ -0,0 +1,84 @@
+"""
+Fast-resume data, which pieces of a torrent were downloaded and verified,
+so a restarted download does not start from zero.
+
+The resume file is a bencoded dictionary holding the info hash, the have
+bitfield and the size and modification time of every output file. It is
+only trusted if all of these still match, else the files are rechecked.
+"""
+import logging
+import os
+
+from bencodepy import decode, encode, DecodingError
+
+
+class FastResume:
+    """
+    Reads and writes the resume file of a torrent
+    """
+    def __init__(self, path: str, info_hash: bytes, file_segments: list):
+        """
+        :param path: The resume file
+        :param file_segments: Tuples of (global_start, global_end, path) for
+                              each output file
+        """
+        self.path = path
+        self.info_hash = info_hash
+        self.file_segments = file_segments
+
+    def _file_stats(self) -> list | None:
+        stats = []
+        for _, _, path in self.file_segments:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            stats.append([stat.st_size, stat.st_mtime_ns])
+        return stats
+
+    def load(self, total_pieces: int) -> bytes | None:
+        """
+        Get the have bitfield of the resume file
+
+        :return: The bitfield (as sent in a BitField message), or None if
+                 there is no resume file or the files changed since it was
+                 written
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = decode(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, DecodingError) as e:
+            logging.warning('Unable to read resume file %s: %s', self.path, e)
+            return None
+
+        if not isinstance(data, dict):
+            data = {}
+        pieces = data.get(b'pieces')
+        if data.get(b'info-hash') != self.info_hash or \
+                not isinstance(pieces, bytes) or \
+                len(pieces) != (total_pieces + 7) // 8:
+            logging.warning('Resume file %s is not for this torrent', self.path)
+            return None
+        if data.get(b'files') != self._file_stats():
+            logging.info('Files changed since resume file %s was written',
+                         self.path)
+            return None
+        return pieces
+
+    def save(self, pieces: bytes):
+        """
+        Write the resume file, the data of the given pieces must be written
+        to the files already.
+        """
+        stats = self._file_stats()
+        if stats is None:
+            return
+        data = encode({b'info-hash': self.info_hash,
+                       b'pieces': pieces,
+                       b'files': stats})
+        partial = self.path + '.part'
+        with open(partial, 'wb') as f:
+            f.write(data)
+        os.replace(partial, self.path)
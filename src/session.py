@@ -0,0 +1,233 @@
+"""
+Many torrents downloaded by one process, in one event loop.
+
+Each torrent has its own `TorrentClient` (tracker, peer queue, workers and
+piece manager), while the expensive parts are shared by all torrents of the
+`Session`: the disk workers, the pool rechecking existing files, the UDP
+tracker socket, a budget of open peer connections, the rate limits and the
+`Acceptor` taking the peers that connect to us.
+Torrents can be added while the session runs, e.g. from a watched
+directory.
+"""
+import asyncio
+import logging
+import os
+import socket
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .acceptor import Acceptor
+from .choker import UNCHOKE_SLOTS
+from .client import TorrentClient
+from .disk import DiskIO
+from .ratelimit import TokenBucket
+from .torrent import Torrent
+from .udp_tracker import UDPTrackerClient
+
+# Peer connections open at once over all torrents
+MAX_CONNECTIONS = 500
+# Seconds between looking for new .torrent files in a watched directory
+WATCH_INTERVAL = 5
+
+
+class Session:
+    """
+    Runs the `TorrentClient`s of many torrents in the event loop
+    """
+    def __init__(self, max_connections: int = MAX_CONNECTIONS,
+                 download_limit: float | None = None,
+                 upload_limit: float | None = None,
+                 use_protocol: bool = False,
+                 disk_workers: int = DiskIO.WORKERS,
+                 listen_socket: socket.socket | None = None,
+                 seed: bool = False,
+                 upload_slots: int = UNCHOKE_SLOTS,
+                 torrent_download_limit: float | None = None,
+                 torrent_upload_limit: float | None = None,
+                 peer_download_limit: float | None = None,
+                 peer_upload_limit: float | None = None):
+        """
+        :param download_limit: Bytes per second over all torrents, no limit
+                               if None
+        :param upload_limit: Bytes per second over all torrents, no limit
+                             if None
+        :param listen_socket: The bound socket the session accepts peers on,
+                              closed with the session
+        :param seed: Keep uploading the torrents once downloaded, until
+                     stopped
+        :param upload_slots: The peers of each torrent unchoked for their
+                             rate
+        :param torrent_download_limit: Bytes per second for each torrent,
+                                       within `download_limit`
+        :param torrent_upload_limit: Bytes per second for each torrent,
+                                     within `upload_limit`
+        :param peer_download_limit: Bytes per second from each peer
+        :param peer_upload_limit: Bytes per second to each peer
+        """
+        self.use_protocol = use_protocol
+        self.seed = seed
+        # The options of the clients of the torrents
+        self.client_options = {
+            'upload_slots': upload_slots,
+            'download_limit': torrent_download_limit,
+            'upload_limit': torrent_upload_limit,
+            'peer_download_limit': peer_download_limit,
+            'peer_upload_limit': peer_upload_limit,
+        }
+        # The disk workers get a queue that grows with the torrents
+        self.disk = DiskIO(disk_workers,
+                           max_queued=DiskIO.MAX_QUEUED * disk_workers)
+        self.hash_executor = ThreadPoolExecutor(
+            os.cpu_count() or 1, thread_name_prefix='hash')
+        self.max_connections = max_connections
+        self.connection_budget = asyncio.Semaphore(max_connections)
+        self.download_limiter = TokenBucket(download_limit) \
+            if download_limit else None
+        self.upload_limiter = TokenBucket(upload_limit) \
+            if upload_limit else None
+        self.udp_tracker = UDPTrackerClient()
+        self.listen_socket = listen_socket
+        self.acceptor = Acceptor(self.connection_budget)
+        # The clients and their download tasks by info hash
+        self.clients = {}
+        self.tasks = {}
+        # The .torrent files added, not to add them again
+        self.torrent_files = set()
+        self.completed = 0
+        self.failed = 0
+        # Bytes of the torrents no longer in the session
+        self._downloaded = 0
+        self._uploaded = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._closed = False
+
+    async def add(self, torrent: Torrent) -> TorrentClient | None:
+        """
+        Start downloading a torrent, unless it is in the session already
+
+        :return: The client of the torrent, None if it was in the session
+        """
+        if torrent.info_hash in self.clients:
+            logging.warning('Torrent %s is already in the session',
+                            torrent.output_file)
+            return None
+        # Setting up the piece manager can recheck the existing files, keep
+        # that off the event loop
+        client = await asyncio.to_thread(
+            TorrentClient, torrent, self.use_protocol, self, self.seed,
+            **self.client_options)
+        if torrent.info_hash in self.clients:
+            client.piece_manager.close()
+            return None
+        self.clients[torrent.info_hash] = client
+        if self.listen_socket is not None and self.acceptor.server is None:
+            await self.acceptor.start(self.listen_socket)
+        self.acceptor.add(torrent.info_hash, client)
+        task = asyncio.create_task(client.start())
+        self.tasks[torrent.info_hash] = task
+        task.add_done_callback(
+            lambda done: self._torrent_done(torrent, done))
+        self._idle.clear()
+        logging.info('Added torrent %s (%d in the session)',
+                     torrent.output_file, len(self.clients))
+        return client
+
+    async def add_file(self, path: str) -> TorrentClient | None:
+        """
+        Start downloading the torrent of a .torrent file, once per file
+        """
+        path = os.path.abspath(path)
+        if path in self.torrent_files:
+            return None
+        self.torrent_files.add(path)
+        try:
+            torrent = Torrent(path)
+            return await self.add(torrent)
+        except (RuntimeError, OSError, ValueError, KeyError) as exc:
+            logging.error('Unable to add torrent %s: %s', path, exc)
+            self.failed += 1
+            return None
+
+    def _torrent_done(self, torrent: Torrent, task: asyncio.Task):
+        client = self.clients.pop(torrent.info_hash)
+        self.tasks.pop(torrent.info_hash)
+        self.acceptor.remove(torrent.info_hash)
+        self._downloaded += client.piece_manager.bytes_downloaded
+        self._uploaded += client.piece_manager.bytes_uploaded
+        if task.cancelled():
+            logging.info('Torrent %s cancelled', torrent.output_file)
+        elif task.exception() is not None:
+            logging.error('Torrent %s failed: %s', torrent.output_file,
+                          task.exception())
+            self.failed += 1
+        else:
+            logging.info('Torrent %s done', torrent.output_file)
+            self.completed += 1
+        if not self.tasks:
+            self._idle.set()
+
+    async def watch(self, directory: str, interval: float = WATCH_INTERVAL):
+        """
+        Add the .torrent files of a directory, and those added to it later,
+        until cancelled
+        """
+        while not self._closed:
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError as exc:
+                logging.error('Unable to watch %s: %s', directory, exc)
+                names = []
+            for name in names:
+                if name.endswith('.torrent'):
+                    await self.add_file(os.path.join(directory, name))
+            await asyncio.sleep(interval)
+
+    async def wait(self):
+        """
+        Wait until no torrent of the session is downloading
+        """
+        await self._idle.wait()
+
+    def stats(self) -> dict:
+        """
+        Counters of the session, e.g. for reporting
+        """
+        clients = list(self.clients.values())
+        return {
+            'torrents': len(clients),
+            'completed': self.completed,
+            'failed': self.failed,
+            'connections': sum(client.connected_peers for client in clients),
+            'accepted': self.acceptor.accepted,
+            'rejected': self.acceptor.rejected,
+            'downloaded': self._downloaded + sum(
+                client.piece_manager.bytes_downloaded for client in clients),
+            'uploaded': self._uploaded + sum(
+                client.piece_manager.bytes_uploaded for client in clients),
+            'disk_queued': self.disk.queued,
+        }
+
+    def stop(self):
+        """
+        Stop downloading all torrents
+        """
+        for client in self.clients.values():
+            client.stop()
+
+    async def close(self):
+        """
+        Stop all torrents and release the shared resources
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self.acceptor.close()
+        self.stop()
+        # The clients close themselves once stopped
+        await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        self.udp_tracker.close()
+        if self.listen_socket is not None:
+            self.listen_socket.close()
+        self.disk.close()
+        self.hash_executor.shutdown(wait=True)
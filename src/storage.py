@@ -0,0 +1,413 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_right
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+
+# The most buffers a single pwritev call takes on most systems
+IOV_MAX = 1024
+
+
+class OutputPaths:
+    """
+    The paths the files of a torrent are written to: the paths in the
+    torrent, unless a parent directory of a file is an existing file (e.g.
+    a single file download of the same name). The files under it are then
+    written to a `<file>_files` directory instead.
+    """
+    def __init__(self):
+        # The redirect directory of each blocking file
+        self.redirects = {}
+
+    def resolve(self, file_path: str) -> str:
+        blocked_parent = self._find_existing_file_parent(file_path)
+        if not blocked_parent:
+            return file_path
+
+        redirect_root = self._allocate_redirect_directory(blocked_parent)
+        relative_path = os.path.relpath(file_path, blocked_parent)
+        return os.path.join(redirect_root, relative_path)
+
+    def _find_existing_file_parent(self, file_path: str) -> str | None:
+        path_obj = Path(file_path)
+        parts = path_obj.parts
+        for depth in range(1, len(parts)):
+            candidate = Path(*parts[:depth])
+            if candidate.is_file():
+                return str(candidate)
+        return None
+
+    def _allocate_redirect_directory(self, blocked_dir: str) -> str:
+        if blocked_dir in self.redirects:
+            return self.redirects[blocked_dir]
+
+        index = 0
+        while True:
+            suffix = '_files' if index == 0 else f'_files_{index}'
+            candidate = f'{blocked_dir}{suffix}'
+            if not os.path.exists(candidate) or os.path.isdir(candidate):
+                self.redirects[blocked_dir] = candidate
+                logging.warning(
+                    'Output path %r is a file; multi-file torrent data is under %r instead.',
+                    blocked_dir,
+                    candidate
+                )
+                return candidate
+            index += 1
+
+
+class FileCache:
+    """
+    The open file descriptors of the output files.
+
+    A file is opened when first used, and once more than `max_open` files
+    are open the least recently used ones are closed, so a torrent with a
+    lot of files does not run out of file descriptors. A file in use (by a
+    disk worker or an upload) is not closed until it is released, even by
+    `close`.
+    """
+    MAX_OPEN = 128
+
+    def __init__(self, max_open: int = MAX_OPEN):
+        self.max_open = max_open
+        self.lock = threading.Lock()
+        # File descriptors by path, least recently used first, and the
+        # number of users of the paths in use
+        self.fds = OrderedDict()
+        self.users = {}
+        # The paths in use when closed, closed once released
+        self.closing = set()
+
+    @contextmanager
+    def open(self, path: str):
+        """
+        Get the file descriptor of the given file, opening it if needed
+        """
+        with self.lock:
+            fd = self.fds.get(path)
+            if fd is None:
+                fd = os.open(path, os.O_RDWR | os.O_CREAT)
+                self.fds[path] = fd
+                self._close_unused()
+            else:
+                self.fds.move_to_end(path)
+                self.closing.discard(path)
+            self.users[path] = self.users.get(path, 0) + 1
+        try:
+            yield fd
+        finally:
+            with self.lock:
+                self.users[path] -= 1
+                if not self.users[path]:
+                    del self.users[path]
+                    if path in self.closing:
+                        self.closing.remove(path)
+                        os.close(self.fds.pop(path))
+
+    def _close_unused(self):
+        excess = len(self.fds) - self.max_open
+        if excess <= 0:
+            return
+        for path in [path for path in self.fds if path not in self.users]:
+            os.close(self.fds.pop(path))
+            excess -= 1
+            if not excess:
+                break
+
+    def close(self):
+        """
+        Close all open files, the ones in use once released
+        """
+        with self.lock:
+            for path in list(self.fds):
+                if path in self.users:
+                    self.closing.add(path)
+                else:
+                    os.close(self.fds.pop(path))
+
+
+class ReadCache:
+    """
+    The most recently uploaded pieces, so a piece requested block by block
+    (and by several peers) is read from disk once.
+
+    Whole pieces are cached, up to `size` bytes; the least recently used
+    ones are dropped first. Only verified pieces are cached, their data does
+    not change. Used on the event loop only.
+    """
+    SIZE = 32 * 2**20
+
+    def __init__(self, size: int = SIZE):
+        self.size = size
+        self.pieces = OrderedDict()
+        self.cached = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, index: int) -> bytes | None:
+        data = self.pieces.get(index)
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.pieces.move_to_end(index)
+        return data
+
+    def put(self, index: int, data: bytes):
+        previous = self.pieces.pop(index, None)
+        if previous is not None:
+            self.cached -= len(previous)
+        self.pieces[index] = data
+        self.cached += len(data)
+        while self.cached > self.size and len(self.pieces) > 1:
+            _, dropped = self.pieces.popitem(last=False)
+            self.cached -= len(dropped)
+
+
+class Storage:
+    """
+    Reads and writes the torrent data as one range of bytes spread over the
+    output files, using positional I/O so no file offset is shared between
+    the disk workers.
+
+    Writes go to a write-back cache. Written blocks are kept until the cache
+    holds `cache_size` bytes or the oldest block has been cached for
+    `flush_interval` seconds, then the adjacent blocks are written together
+    with a single `pwritev` per file (so mostly large sequential writes
+    instead of one write per block).
+
+    Blocks are always written at the same offsets (the block boundaries of
+    the torrent) so the cache is a dict by offset, and writing a block again
+    replaces it in the cache.
+
+    The files a range of the torrent spans are found by bisecting the start
+    offsets of the files, so a lookup is O(log n + k) for k files in the
+    range even for torrents with a huge number of files.
+    """
+    CACHE_SIZE = 8 * 2**20
+    FLUSH_INTERVAL = 5
+
+    def __init__(self, file_segments: list, cache_size: int = CACHE_SIZE,
+                 flush_interval: float = FLUSH_INTERVAL,
+                 max_open: int = FileCache.MAX_OPEN):
+        """
+        :param file_segments: Tuples of (global_start, global_end, path) for
+                              each output file, in torrent order
+        """
+        self.file_segments = file_segments
+        self.segment_starts = [start for start, _, _ in file_segments]
+        self.files = FileCache(max_open)
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # The cached blocks by global offset, the number of bytes cached and
+        # when the first of them was cached
+        self.cache = {}
+        self.cached = 0
+        self.cached_since = None
+        # Number of write calls made and bytes written, for statistics
+        self.writes = 0
+        self.bytes_written = 0
+
+    @property
+    def expired(self) -> bool:
+        """
+        True if the cache holds blocks older than the flush interval
+        """
+        since = self.cached_since
+        return since is not None and \
+            time.monotonic() - since >= self.flush_interval
+
+    def write(self, offset: int, data):
+        """
+        Write the data at the given offset of the torrent (the data is
+        copied into the cache, unless it is written out right away)
+        """
+        with self.lock:
+            if not self.cache and len(data) >= self.cache_size:
+                # Nothing cached to write out with it
+                self._write_run(offset, [data])
+                return
+            previous = self.cache.get(offset)
+            if previous is not None:
+                self.cached -= len(previous)
+            elif not self.cache:
+                self.cached_since = time.monotonic()
+            self.cached += len(data)
+            if self.cached >= self.cache_size or self.expired:
+                self.cache[offset] = data
+                self._flush()
+            else:
+                self.cache[offset] = bytes(data)
+
+    def read(self, offset: int, length: int) -> bytes:
+        """
+        Read the data at the given offset of the torrent, including the
+        blocks in the cache not written out yet
+        """
+        # The cached blocks are taken before reading the files: a block
+        # flushed in between is then in the files and taken, while a block
+        # taken after could be flushed and dropped before it is laid over
+        with self.lock:
+            data = self.cache.get(offset)
+            if data is not None and len(data) == length:
+                return data
+            cached = self._cached_blocks(offset, length)
+        chunks = []
+        for path, file_offset, _, chunk_length in \
+                self._file_ranges(offset, length):
+            with self.files.open(path) as fd:
+                chunk = _pread(fd, chunk_length, file_offset)
+            # Past the end of a file not written that far yet
+            chunks.append(chunk.ljust(chunk_length, b'\0'))
+        data = b''.join(chunks)
+        if not cached:
+            return data
+        # Lay the cached blocks over what was read from the files
+        data = bytearray(data)
+        for start, block in cached:
+            first = max(start, offset)
+            last = min(start + len(block), offset + length)
+            data[first - offset:last - offset] = \
+                block[first - start:last - start]
+        return bytes(data)
+
+    def file_ranges(self, offset: int, length: int) -> list | None:
+        """
+        Find where the given range of the torrent is in the output files,
+        e.g. to send it straight from the files
+
+        :return: Tuples of (path, file_offset, length), None if a part of the
+                 range is only in the cache
+        """
+        with self.lock:
+            if self._cached_blocks(offset, length):
+                return None
+        return [(path, file_offset, chunk_length)
+                for path, file_offset, _, chunk_length in
+                self._file_ranges(offset, length)]
+
+    def _cached_blocks(self, offset: int, length: int) -> list:
+        """
+        The cached blocks overlapping the given range, holding the lock
+        """
+        if not self.cache:
+            return []
+        end = offset + length
+        return [(start, block) for start, block in self.cache.items()
+                if start < end and start + len(block) > offset]
+
+    def flush(self):
+        """
+        Write all cached blocks to disk
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.cache:
+            return
+        offsets = sorted(self.cache)
+        run_start = offsets[0]
+        run = []
+        run_end = run_start
+        for offset in offsets:
+            if offset != run_end:
+                self._write_run(run_start, run)
+                run_start = offset
+                run = []
+            data = self.cache[offset]
+            run.append(data)
+            run_end = offset + len(data)
+        self._write_run(run_start, run)
+        logging.debug('Flushed %d bytes cached in %.1f s', self.cached,
+                      time.monotonic() - self.cached_since)
+        self.cache = {}
+        self.cached = 0
+        self.cached_since = None
+
+    def _write_run(self, start: int, buffers: list):
+        """
+        Write adjacent buffers starting at the given offset of the torrent,
+        split by the files they span.
+        """
+        views = [memoryview(buffer) for buffer in buffers]
+        views.reverse()
+        length = sum(len(view) for view in views)
+        for path, file_offset, _, chunk_length in \
+                self._file_ranges(start, length):
+            chunk = []
+            while chunk_length:
+                view = views.pop()
+                if len(view) > chunk_length:
+                    views.append(view[chunk_length:])
+                    view = view[:chunk_length]
+                chunk.append(view)
+                chunk_length -= len(view)
+            with self.files.open(path) as fd:
+                self._pwritev(fd, chunk, file_offset)
+
+    def _pwritev(self, fd: int, buffers: list, offset: int):
+        while buffers:
+            written = _pwritev(fd, buffers[:IOV_MAX], offset)
+            self.writes += 1
+            self.bytes_written += written
+            offset += written
+            # Drop what was written, a write might be partial
+            while written:
+                if len(buffers[0]) <= written:
+                    written -= len(buffers.pop(0))
+                else:
+                    buffers[0] = buffers[0][written:]
+                    written = 0
+
+    def _file_ranges(self, start: int, length: int):
+        """
+        Split the given range of the torrent (global byte offsets) by the
+        output files it spans.
+
+        :return: Tuples of (path, file_offset, data_offset, chunk_length)
+                 where data_offset is relative to `start`
+        """
+        end = start + length
+        segments = self.file_segments
+        position = max(0, bisect_right(self.segment_starts, start) - 1)
+        while position < len(segments):
+            file_start, file_end, path = segments[position]
+            if file_start >= end:
+                break
+            position += 1
+            overlap_start = max(start, file_start)
+            overlap_end = min(end, file_end)
+            if overlap_start >= overlap_end:
+                continue
+            yield (path, overlap_start - file_start, overlap_start - start,
+                   overlap_end - overlap_start)
+
+    def close(self):
+        """
+        Write out the cached blocks and close the files
+        """
+        self.flush()
+        self.files.close()
+
+if hasattr(os, 'pwritev'):
+    _pwritev = os.pwritev
+    _pread = os.pread
+else:
+    # No positional I/O (i.e. Windows), seek and read/write holding a lock
+    # so the file offset is not moved in between.
+    _seek_lock = threading.Lock()
+
+    def _pwritev(fd: int, buffers: list, offset: int) -> int:
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, b''.join(buffers))
+
+    def _pread(fd: int, length: int, offset: int) -> bytes:
+        with _seek_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, length)
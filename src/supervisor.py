@@ -0,0 +1,295 @@
+"""
+Torrents sharded across worker processes.
+
+One event loop runs on one core: past a few hundred MB/s the hashing,
+message parsing and piece picking of a single process is the limit, however
+many torrents it has. The `Supervisor` starts a number of worker processes,
+each running a `Session` in its own event loop, and hands every torrent
+added to the worker with the least bytes to download. The workers all bind
+the listening port with `SO_REUSEPORT`, so the kernel spreads the incoming
+connections over them, and send the counters of their session back to the
+supervisor, which adds them up.
+
+The connection budget and the rate limits are split evenly between the
+workers.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import socket
+
+from .acceptor import LISTEN_PORT, listen_socket
+from .http_session import http_sessions
+from .choker import UNCHOKE_SLOTS
+from .session import MAX_CONNECTIONS, WATCH_INTERVAL, Session
+from .torrent import Torrent
+
+# Seconds between the counters sent by a worker
+STATS_INTERVAL = 2
+# Seconds to wait for a worker to exit before terminating it
+STOP_TIMEOUT = 30
+
+
+def _worker(index: int, options: dict, port: int | None, log_level: int,
+            commands: multiprocessing.Queue, results: multiprocessing.Queue):
+    """
+    The entry point of a worker process
+    """
+    # The supervisor handles the interrupts and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.basicConfig(level=log_level,
+                        format=f'[worker {index}] %(levelname)s %(message)s')
+    asyncio.run(_run_worker(index, options, port, commands, results))
+
+
+async def _run_worker(index: int, options: dict, port: int | None,
+                      commands: multiprocessing.Queue,
+                      results: multiprocessing.Queue):
+    """
+    Add the torrents sent by the supervisor to a `Session`, and send back its
+    counters, until told to stop
+    """
+    sock = None
+    if port is not None:
+        # Without SO_REUSEPORT only the first worker can listen
+        reuse_port = hasattr(socket, 'SO_REUSEPORT')
+        if reuse_port or index == 0:
+            sock = listen_socket(port, reuse_port)
+    session = Session(listen_socket=sock, **options)
+
+    def report(final: bool = False):
+        results.put((index, session.stats(), final))
+
+    async def report_periodically():
+        while True:
+            await asyncio.sleep(STATS_INTERVAL)
+            report()
+
+    reporting = asyncio.create_task(report_periodically())
+    try:
+        while True:
+            command, torrent = await asyncio.to_thread(commands.get)
+            if command == 'stop':
+                break
+            try:
+                client = await session.add(torrent)
+            except (RuntimeError, OSError, ValueError, KeyError) as exc:
+                logging.error('Unable to add torrent %s: %s',
+                              torrent.output_file, exc)
+                session.failed += 1
+                report()
+                continue
+            if client is not None:
+                # Runs after the session counted the torrent as done
+                session.tasks[torrent.info_hash].add_done_callback(
+                    lambda _: report())
+    finally:
+        reporting.cancel()
+        await session.close()
+        await http_sessions.close()
+        report(final=True)
+
+
+class Supervisor:
+    """
+    Runs the torrents in `processes` worker processes, each with a `Session`
+    """
+    def __init__(self, processes: int | None = None,
+                 port: int | None = LISTEN_PORT,
+                 max_connections: int = MAX_CONNECTIONS,
+                 download_limit: float | None = None,
+                 upload_limit: float | None = None,
+                 use_protocol: bool = False,
+                 seed: bool = False,
+                 upload_slots: int = UNCHOKE_SLOTS,
+                 torrent_download_limit: float | None = None,
+                 torrent_upload_limit: float | None = None,
+                 peer_download_limit: float | None = None,
+                 peer_upload_limit: float | None = None):
+        """
+        :param processes: The number of workers, one per core by default
+        :param port: The port the workers listen on, not listening if None
+        :param max_connections: Peer connections open at once over all
+                                workers
+        :param download_limit: Bytes per second over all workers, no limit
+                               if None
+        :param upload_limit: Bytes per second over all workers, no limit
+                             if None
+        :param upload_slots: The peers of each torrent unchoked for their
+                             rate
+
+        The limits of each torrent and peer are not split, a torrent and its
+        peers are in one worker.
+        """
+        self.processes = processes or os.cpu_count() or 1
+        self.port = port
+        self.options = {
+            'max_connections': max(1, max_connections // self.processes),
+            'download_limit': download_limit / self.processes
+            if download_limit else None,
+            'upload_limit': upload_limit / self.processes
+            if upload_limit else None,
+            'use_protocol': use_protocol,
+            'seed': seed,
+            'upload_slots': upload_slots,
+            'torrent_download_limit': torrent_download_limit,
+            'torrent_upload_limit': torrent_upload_limit,
+            'peer_download_limit': peer_download_limit,
+            'peer_upload_limit': peer_upload_limit,
+        }
+        # Forking a process that runs threads (e.g. the disk workers) is not
+        # safe, the workers start from a fresh interpreter
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = []
+        self._commands = []
+        self._results = self._context.Queue()
+        # The torrents handed to each worker, and the bytes they have
+        self.assigned = []
+        self.assigned_bytes = []
+        self.info_hashes = set()
+        self.torrent_files = set()
+        # The .torrent files that could not be read
+        self.failed = 0
+        # The last counters sent by each worker
+        self.worker_stats = []
+        self._finished = []
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._receiving = None
+        self._closed = False
+
+    def start(self):
+        """
+        Start the worker processes
+        """
+        log_level = logging.getLogger().getEffectiveLevel()
+        for index in range(self.processes):
+            commands = self._context.Queue()
+            worker = self._context.Process(
+                target=_worker, name=f'torrent-worker-{index}', daemon=True,
+                args=(index, self.options, self.port, log_level, commands,
+                      self._results))
+            worker.start()
+            self._workers.append(worker)
+            self._commands.append(commands)
+            self.assigned.append(0)
+            self.assigned_bytes.append(0)
+            self.worker_stats.append({})
+            self._finished.append(False)
+        self._receiving = asyncio.create_task(self._receive())
+        logging.info('Started %d worker processes', self.processes)
+
+    async def add(self, torrent) -> int | None:
+        """
+        Hand a torrent to the worker with the least bytes to download
+
+        :return: The index of the worker, None if the torrent was added
+                 already
+        """
+        if torrent.info_hash in self.info_hashes:
+            logging.warning('Torrent %s is already in the session',
+                            torrent.output_file)
+            return None
+        self.info_hashes.add(torrent.info_hash)
+        index = min(range(self.processes),
+                    key=lambda i: (self.assigned_bytes[i], i))
+        self.assigned[index] += 1
+        self.assigned_bytes[index] += torrent.total_size
+        self._idle.clear()
+        # Pickling the torrent can take a while for large ones
+        await asyncio.to_thread(self._commands[index].put, ('add', torrent))
+        logging.info('Torrent %s handed to worker %d', torrent.output_file,
+                     index)
+        return index
+
+    async def add_file(self, path: str) -> int | None:
+        """
+        Hand the torrent of a .torrent file to a worker, once per file
+        """
+        path = os.path.abspath(path)
+        if path in self.torrent_files:
+            return None
+        self.torrent_files.add(path)
+        try:
+            torrent = Torrent(path)
+        except (RuntimeError, OSError, ValueError, KeyError) as exc:
+            logging.error('Unable to add torrent %s: %s', path, exc)
+            self.failed += 1
+            return None
+        return await self.add(torrent)
+
+    async def watch(self, directory: str, interval: float = WATCH_INTERVAL):
+        """
+        Add the .torrent files of a directory, and those added to it later,
+        until cancelled
+        """
+        while not self._closed:
+            try:
+                names = sorted(os.listdir(directory))
+            except OSError as exc:
+                logging.error('Unable to watch %s: %s', directory, exc)
+                names = []
+            for name in names:
+                if name.endswith('.torrent'):
+                    await self.add_file(os.path.join(directory, name))
+            await asyncio.sleep(interval)
+
+    async def _receive(self):
+        """
+        Keep the counters sent by the workers, until all of them exited
+        """
+        while not all(self._finished):
+            try:
+                index, stats, final = await asyncio.to_thread(
+                    self._results.get, timeout=STATS_INTERVAL)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in self._workers):
+                    break
+                continue
+            self.worker_stats[index] = stats
+            self._finished[index] = final
+            if self._all_done():
+                self._idle.set()
+
+    def _all_done(self) -> bool:
+        return all(stats.get('completed', 0) + stats.get('failed', 0) >=
+                   assigned and not stats.get('torrents', 0)
+                   for stats, assigned in zip(self.worker_stats, self.assigned))
+
+    async def wait(self):
+        """
+        Wait until no torrent handed to the workers is downloading
+        """
+        await self._idle.wait()
+
+    def stats(self) -> dict:
+        """
+        The counters of the sessions of all workers added up
+        """
+        total = {'processes': self.processes, 'failed': self.failed}
+        for stats in self.worker_stats:
+            for key, value in stats.items():
+                total[key] = total.get(key, 0) + value
+        return total
+
+    async def close(self):
+        """
+        Stop the workers, waiting for them to close their torrents
+        """
+        if self._closed:
+            return
+        self._closed = True
+        for commands in self._commands:
+            commands.put(('stop', None))
+        # The results must be read for the workers to exit
+        if self._receiving is not None:
+            await self._receiving
+        for worker in self._workers:
+            await asyncio.to_thread(worker.join, STOP_TIMEOUT)
+            if worker.is_alive():
+                logging.warning('Terminating %s', worker.name)
+                worker.terminate()
+        self._idle.set()
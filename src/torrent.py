@@ -137,6 +137,42 @@ class Torrent:
             return urls
         raise RuntimeError("No valid announce URL found in torrent.")
 
+    @property
+    def announce_tiers(self) -> list[list[str]]:
+        """
+        Returns the announce URLs grouped in tiers (BEP 12), in the order of
+        the torrent meta-info.
+
+        The `announce` URL is added as a last tier if it is not part of the
+        announce-list. Only HTTP(S) and UDP URLs are kept.
+        """
+        tiers = []
+        seen = set()
+
+        def _add_tier(raw_urls):
+            tier = []
+            for raw_url in raw_urls:
+                if isinstance(raw_url, bytes):
+                    url = raw_url.decode('utf-8', errors='ignore')
+                else:
+                    url = str(raw_url)
+                if url in seen or not url.startswith(('http://', 'https://', 'udp://')):
+                    continue
+                seen.add(url)
+                tier.append(url)
+            if tier:
+                tiers.append(tier)
+
+        for tier in self.meta_info.get(b'announce-list', []):
+            if isinstance(tier, list):
+                _add_tier(tier)
+        announce = self.meta_info.get(b'announce')
+        if announce:
+            _add_tier([announce])
+        if tiers:
+            return tiers
+        raise RuntimeError("No valid announce URL found in torrent.")
+
     @property
     def announce(self) -> str:
         """
@@ -5,7 +5,9 @@ This module provides classes for interacting with BitTorrent trackers.
     This class provides convenient access to fields in the tracker's bencoded response,
     such as the failure reason, announce interval, number of seeders (complete),
     number of leechers (incomplete), and the list of peers. It supports both binary
-    and dictionary peer models (though only binary is implemented).
+    (IPv4 and IPv6) and dictionary peer models.
+
+- TrackerHealth: Keeps track of how well a tracker responds to announces.
 
 - Tracker: Manages communication with a tracker for a given torrent, 
     including announcing, peer discovery, and session management.
@@ -13,18 +15,125 @@ This module provides classes for interacting with BitTorrent trackers.
 Designed for use in a BitTorrent client implementation.
 """
 # Standard library imports
-from contextlib import suppress
+import asyncio
+from collections import namedtuple
 import logging
 import random
 import socket
-from struct import unpack
+import time
+from struct import iter_unpack, unpack
 from typing import Any, cast
 from urllib.parse import urlencode, quote_from_bytes
 
 # Third-party imports
 import aiohttp
-from bencodepy import decode
+from bencodepy import decode, DecodingError
+
+# Local imports
+from .acceptor import LISTEN_PORT
+from .http_session import HTTPSessionManager, http_sessions
+from .udp_tracker import (UDPTrackerClient, UDPTrackerError, EVENT_NONE,
+                          EVENT_COMPLETED, EVENT_STARTED, EVENT_STOPPED)
+
+# UDP tracker events by the event parameter of HTTP announces
+UDP_EVENTS = {'started': EVENT_STARTED,
+              'completed': EVENT_COMPLETED,
+              'stopped': EVENT_STOPPED}
+
+# Info hashes scraped in one request, as many as fit in a UDP scrape packet
+SCRAPE_BATCH = 74
+
+# The numbers of seeders (complete), completed downloads (downloaded) and
+# leechers (incomplete) of a torrent, as scraped from a tracker
+ScrapeStats = namedtuple('ScrapeStats', ['complete', 'downloaded', 'incomplete'])
+
+
+def http_scrape_url(announce_url: str) -> str | None:
+    """
+    The scrape URL of a HTTP tracker, from its announce URL by the usual
+    convention of replacing the last `announce` of the path with `scrape`.
+
+    :return: The URL, or None if the tracker does not support scrape
+    """
+    base, _, last = announce_url.rpartition('/')
+    if not last.startswith('announce'):
+        return None
+    return f'{base}/scrape{last[len("announce"):]}'
+
 
+class ScrapeCache:
+    """
+    Scraped stats by tracker and info hash, kept for `ttl` seconds so
+    repeated scrapes do not hit the trackers again.
+    """
+    TTL = 300
+    MAX_ENTRIES = 4096
+
+    def __init__(self, ttl: float = TTL, max_entries: int = MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # (expiry time, ScrapeStats) by (tracker URL, info hash), oldest first
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, url: str, info_hash: bytes) -> ScrapeStats | None:
+        entry = self.entries.get((url, info_hash))
+        if entry is None or entry[0] < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def put(self, url: str, info_hash: bytes, stats: ScrapeStats):
+        key = (url, info_hash)
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttl, stats)
+        while len(self.entries) > self.max_entries:
+            del self.entries[next(iter(self.entries))]
+
+
+# Shared by all trackers, e.g. for scraping many torrents
+scrape_cache = ScrapeCache()
+
+
+def decode_compact_peers(data: bytes) -> list[tuple[str, int]]:
+    """
+    Decode the compact (binary model) IPv4 peers, 6 bytes per peer. A
+    trailing partial entry is ignored.
+    """
+    view = memoryview(data)[:len(data) - len(data) % 6]
+    ntoa = socket.inet_ntoa
+    return [(ntoa(ip), port) for ip, port in iter_unpack('>4sH', view)]
+
+
+def decode_compact_peers6(data: bytes) -> list[tuple[str, int]]:
+    """
+    Decode the compact IPv6 peers of `peers6`, 18 bytes per peer.
+    """
+    view = memoryview(data)[:len(data) - len(data) % 18]
+    ntop = socket.inet_ntop
+    return [(ntop(socket.AF_INET6, ip), port)
+            for ip, port in iter_unpack('>16sH', view)]
+
+
+def decode_dict_peers(peers: list) -> list[tuple[str, int]]:
+    """
+    Decode the dictionary model peers, a dict with the `ip` (an IPv4 or IPv6
+    address, or a host name) and `port` of each peer. Invalid entries are
+    skipped.
+    """
+    decoded = []
+    for peer in peers:
+        if not isinstance(peer, dict):
+            continue
+        ip = peer.get(b'ip')
+        port = peer.get(b'port')
+        if not isinstance(ip, bytes) or not isinstance(port, int) or \
+                not 0 < port < 65536:
+            continue
+        decoded.append((ip.decode('utf-8', errors='replace'), port))
+    return decoded
 
 
 class TrackerResponse:
@@ -34,7 +143,7 @@ class TrackerResponse:
     This class provides convenient access to fields in the tracker's bencoded response,
     such as the failure reason, announce interval, number of seeders (complete),
     number of leechers (incomplete), and the list of peers. It supports both binary
-    and dictionary peer models (though only binary is implemented).
+    (IPv4 and IPv6) and dictionary peer models.
 
     Attributes:
         response (dict): The decoded bencoded response from the tracker.
@@ -48,6 +157,8 @@ class TrackerResponse:
     """
     def __init__(self, response: dict[bytes, Any]):
         self.response = response
+        # The decoded peers, once asked for
+        self._peers = None
     @property
     def failure(self):
         # b'' means that it is a bytes literal, meaning it contains raw byte data.
@@ -58,6 +169,12 @@ class TrackerResponse:
     def interval(self) -> int:
         return self.response.get(b'interval',0)
     @property
+    def min_interval(self) -> int:
+        """
+        Seconds not to re-announce before, 0 if the tracker did not say.
+        """
+        return self.response.get(b'min interval',0)
+    @property
     def complete(self) -> int:
         return self.response.get(b'complete',0)
 
@@ -70,23 +187,27 @@ class TrackerResponse:
     @property
     def peers(self):
         """
-        a list of tuples for each peer (ip,port)
+        a list of tuples for each peer (ip,port), the IPv4 peers of `peers`
+        first, then the IPv6 peers of `peers6` (BEP 7)
         """
         if b'failure reason' in self.response:
             reason = self.response[b'failure reason'].decode('utf-8')
             raise RuntimeError(f"Tracker failure: {reason}")
-        if b'peers' not in self.response:
+        if b'peers' not in self.response and b'peers6' not in self.response:
             raise RuntimeError("No peers returned by tracker. "
                                "The tracker may be overloaded, down, or your request was invalid.")
-        peers = self.response[b'peers']
-        if isinstance(peers, list):
-            logging.debug('Dictionary model peers are returned by tracker')
-            raise NotImplementedError
-        else:
-            logging.debug('Binary model peers are returned by tracker')
-            peers = [peers[i:i+6] for i in range(0, len(peers), 6)]
-            return [(socket.inet_ntoa(p[:4]), self.decode_port(p[4:]))
-                    for p in peers]
+        if self._peers is None:
+            peers = self.response.get(b'peers', b'')
+            if isinstance(peers, list):
+                logging.debug('Dictionary model peers are returned by tracker')
+                self._peers = decode_dict_peers(peers)
+            else:
+                logging.debug('Binary model peers are returned by tracker')
+                self._peers = decode_compact_peers(peers)
+            peers6 = self.response.get(b'peers6', b'')
+            if isinstance(peers6, bytes):
+                self._peers += decode_compact_peers6(peers6)
+        return self._peers
     def decode_port(self, port):
         return unpack(">H", port)[0]
 
@@ -99,97 +220,379 @@ class TrackerResponse:
         )
 
 
+class TrackerHealth:
+    """
+    How well a tracker has been answering announces. Trackers that failed,
+    or are slow to respond, are announced to after the others.
+    """
+    # Weight of the latest response time in the average
+    ALPHA = 0.3
+
+    def __init__(self):
+        self.successes = 0
+        # Failed announces since the last successful one
+        self.failures = 0
+        # Moving average of the seconds taken to respond (or fail)
+        self.latency = 0.0
+
+    def record(self, elapsed: float, success: bool):
+        if self.successes or self.failures:
+            self.latency += self.ALPHA * (elapsed - self.latency)
+        else:
+            self.latency = elapsed
+        if success:
+            self.successes += 1
+            self.failures = 0
+        else:
+            self.failures += 1
+
+
 class Tracker:
     """
     Connection to a tracker for a given torrent that is either under download or seeding state.
+
+    Announces go out to several trackers at once, following the tiers of
+    the torrent (BEP 12): trackers of the first tier are tried first, the
+    trackers within a tier in random order. Trackers that failed or are slow
+    move down their tier on later announces.
     """
+    # Announces in flight to different trackers at once
+    MAX_CONCURRENT_ANNOUNCES = 4
+    # Seconds to wait for a tracker to respond to an announce
+    ANNOUNCE_TIMEOUT = 60
+    # Seconds to wait for the trackers to acknowledge a completed or
+    # stopped event
+    NOTIFY_TIMEOUT = 5
 
-    def __init__(self, torrent):
+    def __init__(self, torrent, http: HTTPSessionManager | None = None,
+                 udp: UDPTrackerClient | None = None):
+        """
+        :param http: The HTTP session manager to send the HTTP requests
+                     with, the one shared by all trackers by default
+        :param udp: The UDP tracker client to use (e.g. shared by the
+                    torrents of a session), else one is created when needed
+        """
         self.torrent = torrent
         self.peer_id = self.generate_peer_id()
-        self.http_client = None  # Don't create session here
+        self.http = http or http_sessions
+        self.udp_client = udp
+        self._owns_udp_client = udp is None
+        self.max_concurrent_announces = self.MAX_CONCURRENT_ANNOUNCES
+        self.announce_timeout = self.ANNOUNCE_TIMEOUT
+        self.tiers = [random.sample(tier, len(tier))
+                      for tier in torrent.announce_tiers]
+        self.health = {url: TrackerHealth()
+                       for tier in self.tiers for url in tier}
+        # Announces still running after `connect` returned
+        self._announces = set()
+        # Trackers that responded to an announce, which are told when the
+        # download completed or stopped
+        self.announced = set()
+
+    def _announce_order(self) -> list[str]:
+        """
+        The announce URLs in the order to try them: by tier, and within a
+        tier the trackers that failed the least first, then the fastest
+        """
+        ranked = [(tier_index, self.health[url].failures,
+                   self.health[url].latency, position, url)
+                  for tier_index, tier in enumerate(self.tiers)
+                  for position, url in enumerate(tier)]
+        return [url for *_, url in sorted(ranked)]
 
     async def connect(self,
                       first: bool | None = None,
                       uploaded: int = 0,
-                      downloaded: int = 0):
-        """Connects to the tracker and announces the client's status."""
+                      downloaded: int = 0,
+                      on_response=None,
+                      event: str | None = None,
+                      num_want: int | None = None):
+        """
+        Connects to the trackers and announces the client's status.
+
+        Returns as soon as a tracker responds. The announces already in flight
+        to other trackers are left running, their responses are passed to
+        `on_response` (if given) to add their peers.
+
+        :param first: Send the started event
+        :param event: The event to send ('started', 'completed' or 'stopped')
+        :param num_want: The number of peers to ask for, else the tracker
+                         default
+        """
+        params = self._announce_params(uploaded, downloaded,
+                                       'started' if first else event, num_want)
+
         tracker_errors = []
-        # Encode every byte (safe='') so tracker compares exact 20-byte values.
-        info_hash_q = quote_from_bytes(self.torrent.info_hash, safe='')
-        peer_id_q = quote_from_bytes(self.peer_id.encode('utf-8'), safe='')
+        semaphore = asyncio.Semaphore(self.max_concurrent_announces)
+        responded = False
 
-        other_params = {
-            'port': 6889,
+        async def announce(url):
+            nonlocal responded
+            async with semaphore:
+                # Trackers not tried yet are left alone once one responded
+                if responded:
+                    return None
+                try:
+                    response = await self._announce(url, params)
+                except ConnectionError as exc:
+                    tracker_errors.append(f'{url}: {exc}')
+                    return None
+            if responded:
+                if on_response is not None:
+                    on_response(response)
+                return None
+            responded = True
+            return response
+
+        tasks = [asyncio.create_task(announce(url))
+                 for url in self._announce_order()]
+        for task in tasks:
+            self._announces.add(task)
+            task.add_done_callback(self._announces.discard)
+        for next_done in asyncio.as_completed(tasks):
+            response = await next_done
+            if response is not None:
+                return response
+
+        details = '; '.join(tracker_errors) if tracker_errors else 'No trackers available'
+        raise ConnectionError(f'Unable to connect to tracker: {details}')
+
+    async def scrape(self, info_hashes: list[bytes] | None = None) -> dict:
+        """
+        Scrape the trackers of the torrent, in announce order, until one of
+        them responds.
+
+        :param info_hashes: The torrents to scrape, the torrent of this
+                            tracker by default. Any number of them can be
+                            given, they are sent in batches.
+        :return: The ScrapeStats by info hash
+        :raises ConnectionError: If no tracker responded
+        """
+        if info_hashes is None:
+            info_hashes = [self.torrent.info_hash]
+        errors = []
+        for url in self._announce_order():
+            try:
+                return await self.scrape_tracker(url, info_hashes)
+            except ConnectionError as exc:
+                errors.append(f'{url}: {exc}')
+        details = '; '.join(errors) if errors else 'No trackers available'
+        raise ConnectionError(f'Unable to scrape tracker: {details}')
+
+    async def scrape_tracker(self, url: str, info_hashes: list[bytes]) -> dict:
+        """
+        Scrape a tracker, the stats scraped in the last `scrape_cache.ttl`
+        seconds are taken from the cache.
+
+        :param url: The announce URL of the tracker
+        :return: The ScrapeStats by info hash, of the torrents the tracker
+                 knows about
+        :raises ConnectionError: If the tracker failed to respond
+        """
+        stats = {}
+        missing = []
+        for info_hash in dict.fromkeys(info_hashes):
+            cached = scrape_cache.get(url, info_hash)
+            if cached is None:
+                missing.append(info_hash)
+            else:
+                stats[info_hash] = cached
+        batches = [missing[i:i + SCRAPE_BATCH]
+                   for i in range(0, len(missing), SCRAPE_BATCH)]
+        for scraped in await asyncio.gather(
+                *(self._scrape_batch(url, batch) for batch in batches)):
+            for info_hash, torrent_stats in scraped.items():
+                scrape_cache.put(url, info_hash, torrent_stats)
+                stats[info_hash] = torrent_stats
+        return stats
+
+    async def _scrape_batch(self, url: str, info_hashes: list[bytes]) -> dict:
+        try:
+            if url.startswith('udp://'):
+                scraping = self._scrape_udp(url, info_hashes)
+            elif url.startswith(('http://', 'https://')):
+                scraping = self._scrape_http(url, info_hashes)
+            else:
+                raise ConnectionError('unsupported tracker URL scheme')
+            return await asyncio.wait_for(scraping, self.announce_timeout)
+        except TimeoutError as exc:
+            raise ConnectionError(f'no response in {self.announce_timeout} s') from exc
+        except ConnectionError:
+            raise
+        except (UDPTrackerError, ValueError, OSError) as exc:
+            raise ConnectionError(str(exc)) from exc
+
+    async def _scrape_udp(self, url: str, info_hashes: list[bytes]) -> dict:
+        if self.udp_client is None:
+            self.udp_client = UDPTrackerClient()
+        logging.info('Scraping UDP tracker at: %s', url)
+        scraped = await self.udp_client.scrape(url, info_hashes)
+        return {info_hash: ScrapeStats(**stats)
+                for info_hash, stats in zip(info_hashes, scraped)}
+
+    async def _scrape_http(self, announce_url: str, info_hashes: list[bytes]) -> dict:
+        url = http_scrape_url(announce_url)
+        if url is None:
+            raise ConnectionError('tracker does not support scrape')
+        query = '&'.join(f"info_hash={quote_from_bytes(info_hash, safe='')}"
+                         for info_hash in info_hashes)
+        url = f"{url}{'&' if '?' in url else '?'}{query}"
+
+        logging.info('Scraping tracker at: %s', url)
+        try:
+            async with self.http.get(url) as response:
+                data = await response.read()
+                if response.status != 200:
+                    raise ConnectionError(f'HTTP {response.status}')
+                decoded_response = decode(data)
+        except (aiohttp.ClientError, DecodingError) as exc:
+            raise ConnectionError(str(exc)) from exc
+        if not isinstance(decoded_response, dict):
+            raise ConnectionError('invalid scrape response')
+        if b'failure reason' in decoded_response:
+            raise ConnectionError(decoded_response[b'failure reason'].decode(
+                'utf-8', errors='replace'))
+        files = decoded_response.get(b'files')
+        if not isinstance(files, dict):
+            raise ConnectionError('invalid scrape response')
+        return {info_hash: ScrapeStats(stats.get(b'complete', 0),
+                                       stats.get(b'downloaded', 0),
+                                       stats.get(b'incomplete', 0))
+                for info_hash, stats in files.items()
+                if info_hash in info_hashes and isinstance(stats, dict)}
+
+    async def notify(self, event: str, uploaded: int = 0, downloaded: int = 0):
+        """
+        Send the completed or stopped event to all trackers that responded to
+        an announce before. Trackers that do not acknowledge it within
+        `NOTIFY_TIMEOUT` are left alone.
+        """
+        params = self._announce_params(uploaded, downloaded, event, 0)
+        urls = [url for url in self._announce_order() if url in self.announced]
+        if not urls:
+            return
+        results = await asyncio.gather(
+            *(asyncio.wait_for(self._announce(url, params), self.NOTIFY_TIMEOUT)
+              for url in urls),
+            return_exceptions=True)
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                logging.warning('Unable to send %s event to tracker %s: %s',
+                                event, url, result or type(result).__name__)
+        if event == 'stopped':
+            self.announced.clear()
+
+    def _announce_params(self, uploaded: int, downloaded: int,
+                         event: str | None, num_want: int | None) -> dict:
+        params = {
+            'port': LISTEN_PORT,
             'uploaded': uploaded,
             'downloaded': downloaded,
-            'left': self.torrent.total_size - downloaded,
+            'left': max(0, self.torrent.total_size - downloaded),
             'compact': 1
         }
-        if first:
-            other_params['event'] = 'started'
+        if event:
+            params['event'] = event
+        if num_want is not None:
+            params['numwant'] = num_want
+        return params
+
+    async def _announce(self, url: str, params: dict) -> TrackerResponse:
+        """
+        Announce to a single tracker, recording how it went in its health
+
+        :raises ConnectionError: If the tracker failed to respond
+        """
+        health = self.health.setdefault(url, TrackerHealth())
+        start = time.monotonic()
+        try:
+            if url.startswith('udp://'):
+                announcing = self._announce_udp(url, params)
+            elif url.startswith(('http://', 'https://')):
+                announcing = self._announce_http(url, params)
+            else:
+                raise ConnectionError('unsupported tracker URL scheme')
+            response = await asyncio.wait_for(announcing, self.announce_timeout)
+        except TimeoutError:
+            health.record(time.monotonic() - start, success=False)
+            logging.error('Tracker %s did not respond in %d s', url,
+                          self.announce_timeout)
+            raise ConnectionError(f'no response in {self.announce_timeout} s')
+        except ConnectionError:
+            health.record(time.monotonic() - start, success=False)
+            raise
+        health.record(time.monotonic() - start, success=True)
+        self.announced.add(url)
+        return response
 
+    async def _announce_udp(self, url: str, params: dict) -> TrackerResponse:
+        if self.udp_client is None:
+            self.udp_client = UDPTrackerClient()
+        logging.info('Connecting to UDP tracker at: %s', url)
+        try:
+            response = await self.udp_client.announce(
+                url,
+                self.torrent.info_hash,
+                self.peer_id.encode('utf-8'),
+                downloaded=params['downloaded'],
+                left=params['left'],
+                uploaded=params['uploaded'],
+                event=UDP_EVENTS.get(params.get('event'), EVENT_NONE),
+                port=params['port'],
+                num_want=params.get('numwant', -1))
+        except (UDPTrackerError, OSError, TimeoutError, ValueError) as exc:
+            logging.error('Exception while connecting to tracker %s: %s', url, exc)
+            raise ConnectionError(str(exc)) from exc
+        return TrackerResponse(response)
+
+    async def _announce_http(self, announce_url: str, params: dict) -> TrackerResponse:
+        # Encode every byte (safe='') so tracker compares exact 20-byte values.
+        info_hash_q = quote_from_bytes(self.torrent.info_hash, safe='')
+        peer_id_q = quote_from_bytes(self.peer_id.encode('utf-8'), safe='')
         # Build query manually so info_hash/peer_id are encoded correctly
-        query = f"info_hash={info_hash_q}&peer_id={peer_id_q}&" + urlencode(other_params)
+        query = f"info_hash={info_hash_q}&peer_id={peer_id_q}&" + urlencode(params)
 
-        for announce_url in self.torrent.announce_urls:
-            if announce_url.startswith('udp://'):
-                tracker_errors.append(f'{announce_url}: UDP tracker support is not implemented yet')
-                continue
-            if not (announce_url.startswith('http://') or announce_url.startswith('https://')):
-                tracker_errors.append(f'{announce_url}: unsupported tracker URL scheme')
-                continue
+        url = f"{announce_url}?{query}"
 
-            if self.http_client is None:
-                self.http_client = aiohttp.ClientSession()
+        logging.info('Connecting to tracker at: %s', url)
+        logging.debug('Tracker request URL: %s', url)
 
-            url = f"{announce_url}?{query}"
+        try:
+            async with self.http.get(url) as response:
+                # Log response status and headers for debugging
+                logging.debug('Tracker response status: %s', response.status)
+                logging.debug('Tracker response headers: %s', dict(response.headers))
 
-            logging.info('Connecting to tracker at: %s', url)
-            logging.debug('Tracker request URL: %s', url)
+                data = await response.read()
 
-            try:
-                async with self.http_client.get(url) as response:
-                    # Log response status and headers for debugging
-                    logging.debug('Tracker response status: %s', response.status)
-                    logging.debug('Tracker response headers: %s', dict(response.headers))
-
-                    data = await response.read()
-
-                    if response.status != 200:
-                        body_text = data.decode('utf-8', errors='replace')
-                        reason = f'HTTP {response.status} {body_text}'
-                        logging.error('Tracker returned status %s. Body: %s', response.status, body_text)
-                        tracker_errors.append(f'{announce_url}: {reason}')
-                        continue
-
-                    decoded_response = cast(dict[bytes, Any], decode(data))
-                    if b'failure reason' in decoded_response:
-                        reason = decoded_response[b'failure reason'].decode('utf-8', errors='replace')
-                        tracker_errors.append(f'{announce_url}: {reason}')
-                        logging.warning('Tracker announce rejected by %s: %s', announce_url, reason)
-                        continue
-
-                    logging.debug('Tracker returned %d bytes', len(data))
-                    return TrackerResponse(decoded_response)
-            except (aiohttp.ClientError, OSError, TimeoutError) as exc:
-                logging.error('Exception while connecting to tracker %s: %s', announce_url, exc)
-                tracker_errors.append(f'{announce_url}: {exc}')
-                continue
-
-        # Ensure session is closed if no tracker succeeded.
-        if self.http_client is not None:
-            with suppress(aiohttp.ClientError, OSError, RuntimeError):
-                await self.http_client.close()
-            self.http_client = None
+                if response.status != 200:
+                    body_text = data.decode('utf-8', errors='replace')
+                    logging.error('Tracker returned status %s. Body: %s', response.status, body_text)
+                    raise ConnectionError(f'HTTP {response.status} {body_text}')
 
-        details = '; '.join(tracker_errors) if tracker_errors else 'No trackers available'
-        raise ConnectionError(f'Unable to connect to tracker: {details}')
+                decoded_response = cast(dict[bytes, Any], decode(data))
+                if b'failure reason' in decoded_response:
+                    reason = decoded_response[b'failure reason'].decode('utf-8', errors='replace')
+                    logging.warning('Tracker announce rejected by %s: %s', announce_url, reason)
+                    raise ConnectionError(reason)
+
+                logging.debug('Tracker returned %d bytes', len(data))
+                return TrackerResponse(decoded_response)
+        except (aiohttp.ClientError, DecodingError, TimeoutError) as exc:
+            logging.error('Exception while connecting to tracker %s: %s', announce_url, exc)
+            raise ConnectionError(str(exc)) from exc
+        except ConnectionError:
+            raise
+        except OSError as exc:
+            logging.error('Exception while connecting to tracker %s: %s', announce_url, exc)
+            raise ConnectionError(str(exc)) from exc
 
     async def close(self):
-        if self.http_client:
-            await self.http_client.close()
-            self.http_client = None
+        for task in list(self._announces):
+            task.cancel()
+        if self.udp_client and self._owns_udp_client:
+            self.udp_client.close()
+            self.udp_client = None
 
     def raise_for_error(self, tracker_response):
         pass
@@ -198,7 +601,7 @@ class Tracker:
         return {
             'info_hash': self.torrent.info_hash,
             'peer_id': self.peer_id,
-            'port': 6889,
+            'port': LISTEN_PORT,
             'uploaded': 0,
             'downloaded': 0,
             'left': 0,
@@ -0,0 +1,284 @@
+"""
+UDP tracker protocol (BEP 15) client.
+
+All trackers are talked to over a single UDP socket. Every request carries a
+random transaction id that its response is matched by. Before announcing
+(or scraping) the client gets a connection id from the tracker, which can
+be reused for a minute, so usually only the first announce to a tracker
+costs an extra round trip.
+
+Lost requests are retransmitted after 15 * 2 ^ n seconds, n starting at 0
+and increasing up to 8, as described in BEP 15.
+"""
+import asyncio
+import ipaddress
+import logging
+import random
+import socket
+import struct
+import time
+from urllib.parse import urlsplit
+
+PROTOCOL_ID = 0x41727101980
+
+ACTION_CONNECT = 0
+ACTION_ANNOUNCE = 1
+ACTION_SCRAPE = 2
+ACTION_ERROR = 3
+
+# Announce events
+EVENT_NONE = 0
+EVENT_COMPLETED = 1
+EVENT_STARTED = 2
+EVENT_STOPPED = 3
+
+# Seconds a connection id can be used for
+CONNECTION_ID_LIFETIME = 60
+
+# Seconds a tracker host name lookup is cached for
+DNS_CACHE_TTL = 300
+
+# (address, expiry time) by (host name, port), shared by all clients
+_resolved = {}
+
+
+class UDPTrackerError(Exception):
+    """
+    The tracker responded with an error
+    """
+
+
+class UDPTrackerProtocol(asyncio.DatagramProtocol):
+    """
+    Matches the received datagrams to the requests waiting for them by
+    their transaction id.
+    """
+    def __init__(self):
+        self.transport = None
+        # Futures waiting for a response, by transaction id
+        self.waiting = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 8:
+            logging.debug('Ignoring short datagram from %s', addr)
+            return
+        action, transaction_id = struct.unpack_from('>II', data)
+        future = self.waiting.pop(transaction_id, None)
+        if future is None or future.done():
+            logging.debug('Ignoring unexpected response from %s', addr)
+            return
+        if action == ACTION_ERROR:
+            message = data[8:].decode('utf-8', errors='replace')
+            future.set_exception(UDPTrackerError(message))
+        else:
+            future.set_result((action, data))
+
+    def error_received(self, exc):
+        # E.g. ICMP port unreachable, the request is retransmitted as if it
+        # was lost.
+        logging.debug('UDP tracker socket error: %s', exc)
+
+    def connection_lost(self, exc):
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(
+                    exc or ConnectionError('UDP tracker socket closed'))
+        self.waiting.clear()
+
+
+class UDPTrackerClient:
+    """
+    Announces to and scrapes UDP trackers
+    """
+    BASE_TIMEOUT = 15
+    MAX_RETRANSMITS = 8
+
+    def __init__(self, base_timeout: float = BASE_TIMEOUT,
+                 max_retransmits: int = MAX_RETRANSMITS):
+        self.base_timeout = base_timeout
+        self.max_retransmits = max_retransmits
+        self.transport = None
+        self.protocol = None
+        # (connection id, time obtained) by tracker address
+        self.connection_ids = {}
+        # Connect requests in flight by tracker address, shared by the
+        # requests to the tracker waiting for a connection id
+        self.connecting = {}
+        # Number of requests sent, including retransmits, for statistics
+        self.requests_sent = 0
+
+    async def _ensure_socket(self):
+        if self.transport is None or self.transport.is_closing():
+            loop = asyncio.get_running_loop()
+            self.transport, self.protocol = await loop.create_datagram_endpoint(
+                UDPTrackerProtocol, local_addr=('0.0.0.0', 0),
+                family=socket.AF_INET)
+
+    async def _resolve(self, url: str) -> tuple[str, int]:
+        parts = urlsplit(url)
+        if not parts.hostname or not parts.port:
+            raise ValueError(f'Invalid UDP tracker URL {url!r}')
+        try:
+            ipaddress.IPv4Address(parts.hostname)
+            return parts.hostname, parts.port
+        except ValueError:
+            pass
+        key = (parts.hostname, parts.port)
+        cached = _resolved.get(key)
+        if cached and cached[1] > time.monotonic():
+            return cached[0]
+        loop = asyncio.get_running_loop()
+        infos = await loop.getaddrinfo(parts.hostname, parts.port,
+                                       family=socket.AF_INET,
+                                       type=socket.SOCK_DGRAM)
+        if not infos:
+            raise OSError(f'Unable to resolve {parts.hostname}')
+        addr = infos[0][4][:2]
+        _resolved[key] = (addr, time.monotonic() + DNS_CACHE_TTL)
+        return addr
+
+    async def _send(self, addr, build, attempt: int) -> tuple[int, bytes]:
+        """
+        Send a request once and wait for its response
+
+        :param build: Called with the transaction id to get the datagram
+        :param attempt: The n of the 15 * 2 ^ n timeout
+        """
+        await self._ensure_socket()
+        transaction_id = random.getrandbits(32)
+        while transaction_id in self.protocol.waiting:
+            transaction_id = random.getrandbits(32)
+        future = asyncio.get_running_loop().create_future()
+        self.protocol.waiting[transaction_id] = future
+        self.transport.sendto(build(transaction_id), addr)
+        self.requests_sent += 1
+        try:
+            return await asyncio.wait_for(
+                future, self.base_timeout * 2 ** attempt)
+        finally:
+            self.protocol.waiting.pop(transaction_id, None)
+
+    async def _connection_id(self, addr, attempt: int) -> int:
+        cached = self.connection_ids.get(addr)
+        if cached and time.monotonic() - cached[1] < CONNECTION_ID_LIFETIME:
+            return cached[0]
+        connecting = self.connecting.get(addr)
+        if connecting is None:
+            connecting = asyncio.ensure_future(self._connect(addr, attempt))
+            self.connecting[addr] = connecting
+            connecting.add_done_callback(
+                lambda future: self._connected(addr, future))
+        return await asyncio.shield(connecting)
+
+    def _connected(self, addr, future: asyncio.Future):
+        self.connecting.pop(addr, None)
+        # Retrieve the exception, in case every waiter was cancelled
+        if not future.cancelled():
+            future.exception()
+
+    async def _connect(self, addr, attempt: int) -> int:
+        action, data = await self._send(
+            addr,
+            lambda tid: struct.pack('>QII', PROTOCOL_ID, ACTION_CONNECT, tid),
+            attempt)
+        if action != ACTION_CONNECT or len(data) < 16:
+            raise UDPTrackerError('Invalid connect response')
+        connection_id = struct.unpack_from('>Q', data, 8)[0]
+        self.connection_ids[addr] = (connection_id, time.monotonic())
+        return connection_id
+
+    async def _request(self, url: str, build, action: int) -> bytes:
+        """
+        Send a request that needs a connection id, retransmitting it (and
+        reconnecting if the connection id expired) until a response is
+        received.
+
+        :param build: Called with the connection id and the transaction id
+                      to get the datagram
+        """
+        addr = await self._resolve(url)
+        for attempt in range(self.max_retransmits + 1):
+            try:
+                received, data = await self._send_connected(
+                    addr, build, attempt)
+            except asyncio.TimeoutError:
+                logging.debug('No response from %s, retransmitting', url)
+                continue
+            if received != action:
+                raise UDPTrackerError(f'Unexpected action {received}')
+            return data
+        raise TimeoutError(f'No response from UDP tracker {url}')
+
+    async def _send_connected(self, addr, build, attempt: int):
+        """
+        Send a request with the connection id to the tracker. If the tracker
+        responds with an error, e.g. as the cached connection id expired
+        early or the tracker restarted, connect again and send it once more.
+        """
+        connection_id = await self._connection_id(addr, attempt)
+        try:
+            return await self._send(
+                addr, lambda tid: build(connection_id, tid), attempt)
+        except UDPTrackerError as exc:
+            logging.debug('Error from %s, connecting again: %s', addr, exc)
+        cached = self.connection_ids.get(addr)
+        if cached is not None and cached[0] == connection_id:
+            # Unless another request has connected again already
+            del self.connection_ids[addr]
+        connection_id = await self._connection_id(addr, attempt)
+        return await self._send(
+            addr, lambda tid: build(connection_id, tid), attempt)
+
+    async def announce(self, url: str, info_hash: bytes, peer_id: bytes,
+                       downloaded: int, left: int, uploaded: int,
+                       event: int = EVENT_NONE, port: int = 6889,
+                       num_want: int = -1, key: int = 0) -> dict:
+        """
+        Announce to a UDP tracker
+
+        :return: The response in the same form as a decoded response from a
+                 HTTP tracker (with compact peers)
+        """
+        def build(connection_id, transaction_id):
+            return struct.pack('>QII20s20sQQQIIIiH', connection_id,
+                               ACTION_ANNOUNCE, transaction_id, info_hash,
+                               peer_id, downloaded, max(0, left), uploaded, event,
+                               0, key, num_want, port)
+
+        data = await self._request(url, build, ACTION_ANNOUNCE)
+        if len(data) < 20:
+            raise UDPTrackerError('Invalid announce response')
+        interval, leechers, seeders = struct.unpack_from('>III', data, 8)
+        peers = data[20:]
+        return {b'interval': interval,
+                b'incomplete': leechers,
+                b'complete': seeders,
+                b'peers': peers[:len(peers) - len(peers) % 6]}
+
+    async def scrape(self, url: str, info_hashes: list[bytes]) -> list[dict]:
+        """
+        Scrape a UDP tracker (at most about 74 info hashes fit in a request)
+
+        :return: For each info hash a dict with the number of seeders
+                 (complete), completed downloads (downloaded) and leechers
+                 (incomplete)
+        """
+        def build(connection_id, transaction_id):
+            return struct.pack('>QII', connection_id, ACTION_SCRAPE,
+                               transaction_id) + b''.join(info_hashes)
+
+        data = await self._request(url, build, ACTION_SCRAPE)
+        if len(data) < 8 + 12 * len(info_hashes):
+            raise UDPTrackerError('Invalid scrape response')
+        return [{'complete': complete, 'downloaded': downloaded,
+                 'incomplete': incomplete}
+                for complete, downloaded, incomplete
+                in struct.iter_unpack('>III', data[8:8 + 12 * len(info_hashes)])]
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
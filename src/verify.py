@@ -0,0 +1,129 @@
+"""
+Hashing of the pieces of a torrent from the files on disk, e.g. to find out
+which pieces of an earlier download are already there.
+
+The files are read through `mmap` and the pieces are hashed on a pool of
+threads. hashlib releases the GIL while hashing (and while the mapped pages
+are faulted in from disk), so the threads keep all cores and the disk busy.
+"""
+import mmap
+import os
+
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from hashlib import sha1
+
+# Pieces being hashed (or waiting for a worker) per worker
+IN_FLIGHT_PER_WORKER = 4
+
+
+def file_segments(files: list, resolve=None) -> list:
+    """
+    Map each file of a torrent to its global torrent byte range
+
+    :param files: The `TorrentFile`s of the torrent
+    :param resolve: Maps the path of a file in the torrent to the path it
+                    is written to (e.g. `OutputPaths.resolve`), if given
+    :return: Tuples of (global_start, global_end, path)
+    """
+    segments = []
+    offset = 0
+    for torrent_file in files:
+        path = resolve(torrent_file.name) if resolve else torrent_file.name
+        segments.append((offset, offset + torrent_file.length, path))
+        offset += torrent_file.length
+    return segments
+
+
+def piece_chunks(file_segments: list, piece_length: int, total_size: int):
+    """
+    Walk the files in torrent order, splitting them into pieces.
+
+    :param file_segments: Tuples of (global_start, global_end, path) for
+                          each file, in torrent order
+    :return: For each piece a list of (path, file_offset, length) tuples,
+             the parts of the files that make up the piece
+    """
+    segments = iter(file_segments)
+    file_start, file_end, path = next(segments, (0, 0, None))
+    for piece_start in range(0, total_size, piece_length):
+        piece_end = min(piece_start + piece_length, total_size)
+        chunks = []
+        position = piece_start
+        while position < piece_end:
+            while file_end <= position:
+                file_start, file_end, path = next(segments)
+            end = min(piece_end, file_end)
+            chunks.append((path, position - file_start, end - position))
+            position = end
+        yield chunks
+
+
+def hash_piece(chunks: list) -> bytes | None:
+    """
+    Hash a piece from the files it is made of
+
+    :return: The SHA1 digest, or None if the files are too short to hold
+             the piece (or could not be read)
+    """
+    hasher = sha1()
+    for path, offset, length in chunks:
+        try:
+            with open(path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < offset + length:
+                    return None
+                # A mapping starts at a multiple of the allocation granularity
+                start = offset - offset % mmap.ALLOCATIONGRANULARITY
+                with mmap.mmap(f.fileno(), offset + length - start,
+                               access=mmap.ACCESS_READ, offset=start) as mapped:
+                    if hasattr(mapped, 'madvise'):
+                        mapped.madvise(mmap.MADV_WILLNEED)
+                    with memoryview(mapped) as view:
+                        hasher.update(view[offset - start:])
+        except OSError:
+            return None
+    return hasher.digest()
+
+
+def verify_pieces(file_segments: list, piece_length: int, total_size: int,
+                  piece_hashes: list, workers: int | None = None,
+                  executor: Executor | None = None):
+    """
+    Hash every piece of the torrent from the files on disk and compare it to
+    its hash from the torrent meta-info.
+
+    :param workers: The number of hashing threads, defaults to the number of
+                    CPUs
+    :param executor: The pool to hash on (e.g. shared by several torrents),
+                     with `workers` threads. A pool is created for the
+                     call if not given.
+    :return: A generator of (piece index, bool) in piece order, True if the
+             piece is on disk
+    """
+    workers = workers or os.cpu_count() or 1
+    if executor is None:
+        with ThreadPoolExecutor(workers, thread_name_prefix='verify') as executor:
+            yield from _verify_pieces(executor, workers, file_segments,
+                                      piece_length, total_size, piece_hashes)
+    else:
+        yield from _verify_pieces(executor, workers, file_segments,
+                                  piece_length, total_size, piece_hashes)
+
+
+def _verify_pieces(executor: Executor, workers: int, file_segments: list,
+                   piece_length: int, total_size: int, piece_hashes: list):
+    pending = deque()
+    try:
+        chunks = piece_chunks(file_segments, piece_length, total_size)
+        for index, piece in enumerate(chunks):
+            pending.append(executor.submit(hash_piece, piece))
+            if len(pending) >= workers * IN_FLIGHT_PER_WORKER:
+                done = index - len(pending) + 1
+                yield done, pending.popleft().result() == piece_hashes[done]
+        first = len(piece_hashes) - len(pending)
+        for done in range(first, len(piece_hashes)):
+            yield done, pending.popleft().result() == piece_hashes[done]
+    finally:
+        # Do not leave work behind on a shared pool
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,85 @@
+"""
+Measures how long the first announce of a torrent takes to get peers when
+the trackers tried first in its first tier are dead (they never respond),
+announcing to one tracker at a time compared to several at once. The second
+announce shows the dead trackers moved down their tier.
+
+The trackers are stand-in UDP trackers from `testing.udp_test`, the dead
+ones are sockets that drop every request.
+
+Run from the project root:
+    python -m testing.announce_bench
+"""
+import asyncio
+import logging
+import socket
+import time
+from types import SimpleNamespace
+
+from src.tracker import Tracker
+from src.udp_tracker import UDPTrackerClient
+from testing.udp_test import start_tracker
+
+DEAD_TRACKERS = 6
+LIVE_TRACKERS = 2
+# Seconds for a dead tracker to time out
+TIMEOUT = 0.5
+
+
+def dead_tracker() -> tuple[socket.socket, str]:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    return sock, f'udp://127.0.0.1:{sock.getsockname()[1]}/announce'
+
+
+async def run(concurrency: int):
+    dead = [dead_tracker() for _ in range(DEAD_TRACKERS)]
+    live = [await start_tracker() for _ in range(LIVE_TRACKERS)]
+    # The dead trackers first in the first tier, with a live one after
+    # them, the other live trackers in the tiers after it
+    tiers = [[url for _, url in dead] + [live[0][2]]] + \
+        [[url] for *_, url in live[1:]]
+    torrent = SimpleNamespace(info_hash=bytes(20), total_size=1,
+                              announce_tiers=tiers)
+    for transport, tracker, _ in live:
+        # A peer for the announces to return
+        tracker.swarms[torrent.info_hash] = {
+            b'S' * 20: ('127.0.0.1', 7001, 0)}
+
+    tracker = Tracker(torrent)
+    # Tried in this order rather than shuffled within the tier
+    tracker.tiers = tiers
+    tracker.udp_client = UDPTrackerClient(base_timeout=TIMEOUT,
+                                          max_retransmits=0)
+    tracker.max_concurrent_announces = concurrency
+    merged = []
+    try:
+        timings = []
+        for _ in range(2):
+            start = time.perf_counter()
+            await tracker.connect(first=True, on_response=merged.append)
+            timings.append(time.perf_counter() - start)
+            # Let the announces in flight finish, for the health scores
+            while tracker._announces:
+                await asyncio.sleep(0.01)
+    finally:
+        await tracker.close()
+        for sock, _ in dead:
+            sock.close()
+        for transport, *_ in live:
+            transport.close()
+    print(f'{concurrency} at a time: first announce {timings[0]:5.2f} s,'
+          f' second {timings[1]:5.2f} s, {len(merged)} more responses merged')
+
+
+async def main():
+    # The dead trackers are logged as errors
+    logging.disable(logging.ERROR)
+    print(f'{DEAD_TRACKERS} dead trackers ({TIMEOUT} s timeout) before'
+          f' {LIVE_TRACKERS} live ones, the first of them in the same tier')
+    for concurrency in (1, Tracker.MAX_CONCURRENT_ANNOUNCES, 8):
+        await run(concurrency)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
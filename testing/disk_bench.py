@@ -0,0 +1,91 @@
+"""
+Measures how much the event loop is held up by writing and hashing the
+received blocks, with the work done on the event loop (no disk workers)
+compared to on the `DiskIO` workers.
+
+Blocks of a number of in-flight pieces are fed to the `PieceManager` from a
+coroutine, as they would be by the peer connections, while another coroutine
+ticks every millisecond and records how late each tick is.
+
+Run from the project root:
+    python -m testing.disk_bench
+"""
+import asyncio
+import hashlib
+import os
+import random
+import tempfile
+import time
+
+from src.bitfield import CompactBitfield
+from src.client import PieceManager
+from src.disk import DiskIO
+from testing.synthetic import SyntheticTorrent
+
+PIECE_LENGTH = 4 * 2**20
+PIECES = 64
+TICK = 0.001
+
+
+async def ticker(delays: list, done: asyncio.Event):
+    while not done.is_set():
+        expected = time.perf_counter() + TICK
+        await asyncio.sleep(TICK)
+        delays.append(time.perf_counter() - expected)
+
+
+async def feed(manager: PieceManager, piece: bytes, rng: random.Random):
+    view = memoryview(piece)
+    blocks = []
+    while (block := manager.next_request(b'peer')):
+        blocks.append(block)
+    # Blocks arrive in batches, slightly out of order
+    for start in range(0, len(blocks), 64):
+        batch = blocks[start:start + 64]
+        rng.shuffle(batch)
+        for block in batch:
+            data = bytes(view[block.offset:block.offset + block.length])
+            manager.block_received(b'peer', block.piece, block.offset, data)
+        await asyncio.sleep(0)
+        if manager.disk.backlogged:
+            await manager.disk.wait_for_room()
+    while not manager.complete:
+        await asyncio.sleep(TICK)
+
+
+async def run(name: str, disk: DiskIO):
+    piece = random.Random(1).randbytes(PIECE_LENGTH)
+    torrent = SyntheticTorrent(f'{name}.bin', PIECE_LENGTH,
+                               PIECES * PIECE_LENGTH)
+    torrent.pieces = [hashlib.sha1(piece).digest()] * PIECES
+    manager = PieceManager(torrent, disk)
+    manager.add_peer(b'peer', CompactBitfield.full(PIECES))
+
+    delays = []
+    done = asyncio.Event()
+    tick = asyncio.ensure_future(ticker(delays, done))
+    start = time.perf_counter()
+    await feed(manager, piece, random.Random(2))
+    elapsed = time.perf_counter() - start
+    done.set()
+    await tick
+    manager.close()
+
+    delays.sort()
+    p99 = delays[int(len(delays) * 0.99)]
+    print(f'{name:<10} {PIECES * PIECE_LENGTH / elapsed / 2**20:8.1f} MB/s'
+          f'   loop delay p99 {p99 * 1000:6.2f} ms'
+          f' max {delays[-1] * 1000:6.2f} ms'
+          f'   disk queue peak {disk.peak_queued:3}'
+          f' latency max {disk.max_latency * 1000:7.2f} ms')
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+    print(f'{PIECES} pieces of {PIECE_LENGTH // 2**20} MiB')
+    asyncio.run(run('on loop', DiskIO(workers=0)))
+    asyncio.run(run('workers', DiskIO()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+"""
+Benchmark of the tail of a download, from a local synthetic swarm with fast
+and slow seeders (`testing.swarm.Seeder`), without and with endgame mode.
+
+Without endgame mode the blocks requested from the slow seeders last are
+waited for at their rate, with it they are requested from the fast seeders
+too and cancelled at the slow ones once received.
+
+Run from the project root:
+    python -m testing.endgame_bench
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+from src import client as client_module
+from src.client import TorrentClient
+from testing.swarm import Seeder
+from testing.synthetic import SyntheticTorrent
+from testing.udp_test import start_tracker
+
+TOTAL_SIZE = 16 * 2**20
+PIECE_LENGTH = 256 * 2**10
+FAST_SEEDERS = 2
+SLOW_SEEDERS = 4
+# Bytes per second of each slow seeder
+SLOW_RATE = 16 * 2**10
+# The share of the pieces after which the download is in its tail
+TAIL = 0.9
+# Seconds to wait for a download
+TIMEOUT = 120
+
+
+async def run(name: str, endgame_requests: int, torrent: SyntheticTorrent,
+              seeders: list[Seeder]):
+    client_module.ENDGAME_REQUESTS = endgame_requests
+    client = TorrentClient(torrent)
+    manager = client.piece_manager
+    task = asyncio.create_task(client.start())
+    start = time.perf_counter()
+    tail_start = None
+    deadline = start + TIMEOUT
+    while not manager.complete and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+        if tail_start is None and \
+                manager.have_pieces.count() >= TAIL * manager.total_pieces:
+            tail_start = time.perf_counter()
+    finished = time.perf_counter()
+    duplicates = manager.duplicate_bytes
+    client.stop()
+    await asyncio.gather(task, return_exceptions=True)
+    assert manager.complete, f'{name}: not complete after {TIMEOUT} s'
+    # The blocks received twice are not counted twice
+    assert manager.bytes_downloaded == torrent.total_size
+    with open(torrent.output_file, 'rb') as f:
+        assert f.read() == torrent.data
+    cancelled = sum(seeder.cancelled for seeder in seeders)
+    for seeder in seeders:
+        seeder.cancelled = 0
+    print(f'{name:<12} total {finished - start:6.2f} s,'
+          f' last {1 - TAIL:.0%} of the pieces {finished - tail_start:6.2f} s,'
+          f' {duplicates // 1024} KiB received twice,'
+          f' {cancelled} requests cancelled')
+    os.remove(torrent.output_file)
+    os.remove(torrent.output_file + '.fastresume')
+
+
+async def main():
+    directory = tempfile.mkdtemp()
+    torrent = SyntheticTorrent.with_random_data(
+        os.path.join(directory, 'endgame.bin'), PIECE_LENGTH, TOTAL_SIZE)
+    transport, tracker, url = await start_tracker()
+    torrent.announce_tiers = [[url]]
+    seeders = [Seeder([torrent], b'-FAST-' + bytes([i]) * 14)
+               for i in range(FAST_SEEDERS)]
+    seeders += [Seeder([torrent], b'-SLOW-' + bytes([i]) * 14, SLOW_RATE)
+                for i in range(SLOW_SEEDERS)]
+    tracker.swarms[torrent.info_hash] = {
+        seeder.peer_id: ('127.0.0.1', await seeder.start(), 0)
+        for seeder in seeders}
+    print(f'{TOTAL_SIZE // 2**20} MiB from {FAST_SEEDERS} fast seeders and'
+          f' {SLOW_SEEDERS} seeders at {SLOW_RATE // 1024} KiB/s')
+    endgame_requests = client_module.ENDGAME_REQUESTS
+    try:
+        # A block is requested from one peer at a time
+        await run('no endgame', 1, torrent, seeders)
+        await run('endgame', endgame_requests, torrent, seeders)
+    finally:
+        client_module.ENDGAME_REQUESTS = endgame_requests
+        for seeder in seeders:
+            seeder.close()
+        transport.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
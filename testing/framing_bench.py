@@ -0,0 +1,127 @@
+"""
+Microbenchmark of the receive path: how many MB/s of `Piece` messages can be
+parsed from a stream, and how many small `Have` messages per second can be
+parsed when they arrive all at once in one large buffer.
+
+Compares the previous framing (appending to an immutable `bytes` buffer and
+copying each block through `struct.unpack`) against the `MessageFramer` used
+by `PeerStreamIterator`.
+
+Run from the project root:
+    python -m testing.framing_bench
+"""
+import asyncio
+import struct
+import time
+
+from src.protocol import (REQUEST_SIZE, Have, Piece, PeerMessage,
+                          PeerStreamIterator)
+
+BLOCKS = 10_000
+HAVES = 20_000
+
+
+class FakeReader:
+    """
+    Stands in for a `StreamReader`, returning the stream in chunks, of at
+    most `chunk` bytes if given whatever the size asked for.
+    """
+    def __init__(self, stream: bytes, chunk: int = None):
+        self.stream = memoryview(stream)
+        self.offset = 0
+        self.chunk = chunk
+
+    async def read(self, size: int) -> bytes:
+        size = self.chunk or size
+        chunk = bytes(self.stream[self.offset:self.offset + size])
+        self.offset += len(chunk)
+        return chunk
+
+
+class LegacyStreamIterator:
+    """
+    The framing as it was done before `MessageFramer`, restricted to the
+    `Piece` and `Have` messages used by this benchmark.
+    """
+    CHUNK_SIZE = 10*1024
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.buffer = b''
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            data = await self.reader.read(LegacyStreamIterator.CHUNK_SIZE)
+            if data:
+                self.buffer += data
+            message = self.parse()
+            if message:
+                return message
+            if not data:
+                raise StopAsyncIteration()
+
+    def parse(self):
+        if len(self.buffer) < 4:
+            return None
+        length = struct.unpack('>I', self.buffer[0:4])[0]
+        if len(self.buffer) < length + 4:
+            return None
+        data = self.buffer[:length + 4]
+        self.buffer = self.buffer[length + 4:]
+        if data[4] == PeerMessage.Have:
+            return Have.decode(data)
+        parts = struct.unpack('>IbII' + str(length - Piece.length) + 's', data)
+        return Piece(parts[2], parts[3], parts[4])
+
+
+def build_stream() -> bytes:
+    block = bytes(range(256)) * (REQUEST_SIZE // 256)
+    return b''.join(Piece(i // 16, (i % 16) * REQUEST_SIZE, block).encode()
+                    for i in range(BLOCKS))
+
+
+def build_haves() -> bytes:
+    return b''.join(Have(i).encode() for i in range(HAVES))
+
+
+async def run(name: str, iterator_type, stream: bytes):
+    iterator = iterator_type(FakeReader(stream))
+    received = 0
+    start = time.perf_counter()
+    async for message in iterator:
+        received += len(message.block)
+    elapsed = time.perf_counter() - start
+    assert received == BLOCKS * REQUEST_SIZE
+    print(f'{name:<10} {received / elapsed / 2**20:10.1f} MB/s')
+
+
+async def run_haves(name: str, iterator_type, stream: bytes):
+    # The whole stream is returned by the first read
+    iterator = iterator_type(FakeReader(stream, len(stream)))
+    received = 0
+    start = time.perf_counter()
+    async for message in iterator:
+        assert message.index == received
+        received += 1
+    elapsed = time.perf_counter() - start
+    assert received == HAVES
+    print(f'{name:<10} {received / elapsed / 1e6:10.3f} M messages/s')
+
+
+async def main():
+    stream = build_stream()
+    print(f'Parsing {BLOCKS} Piece messages ({len(stream) / 2**20:.1f} MB)')
+    await run('before', LegacyStreamIterator, stream)
+    await run('after', PeerStreamIterator, stream)
+    stream = build_haves()
+    print(f'Parsing {HAVES} Have messages from one buffer'
+          f' ({len(stream) / 2**10:.0f} KB)')
+    await run_haves('before', LegacyStreamIterator, stream)
+    await run_haves('after', PeerStreamIterator, stream)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
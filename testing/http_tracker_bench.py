@@ -0,0 +1,80 @@
+"""
+Benchmark of announcing many torrents to the same HTTP tracker: each
+`Tracker` with an HTTP session of its own (as before the session was
+shared) compared to all of them sharing one `HTTPSessionManager`.
+
+The tracker is a stand-in aiohttp application on localhost that returns a
+few compact peers.
+
+Run from the project root:
+    python -m testing.http_tracker_bench
+"""
+import asyncio
+import struct
+import time
+from types import SimpleNamespace
+
+from aiohttp import web
+from bencodepy import encode
+
+from src.http_session import HTTPSessionManager
+from src.tracker import Tracker
+
+TORRENTS = 50
+ROUNDS = 5
+PEERS = b''.join(bytes([127, 0, 0, 1]) + struct.pack('>H', 7000 + i)
+                 for i in range(50))
+
+
+async def announce(request):
+    return web.Response(body=encode({b'interval': 1800, b'peers': PEERS}))
+
+
+async def start_tracker() -> tuple[web.AppRunner, str]:
+    app = web.Application()
+    app.router.add_get('/announce', announce)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    return runner, f'http://localhost:{port}/announce'
+
+
+async def run(name: str, url: str, shared: bool):
+    managers = [HTTPSessionManager()] if shared else \
+        [HTTPSessionManager() for _ in range(TORRENTS)]
+    trackers = []
+    for i in range(TORRENTS):
+        torrent = SimpleNamespace(info_hash=i.to_bytes(20, 'big'),
+                                  total_size=1, announce_tiers=[[url]])
+        trackers.append(Tracker(torrent, http=managers[i % len(managers)]))
+    start = time.perf_counter()
+    for first in [True] + [False] * (ROUNDS - 1):
+        await asyncio.gather(*(tracker.connect(first=first)
+                               for tracker in trackers))
+    elapsed = time.perf_counter() - start
+    created = sum(manager.connections_created for manager in managers)
+    reused = sum(manager.connections_reused for manager in managers)
+    lookups = sum(manager.dns_misses for manager in managers)
+    for tracker in trackers:
+        await tracker.close()
+    for manager in managers:
+        await manager.close()
+    print(f'{name:<18} {TORRENTS * ROUNDS / elapsed:7.0f} announces/s,'
+          f' {created:3} connections opened, {reused:3} reused'
+          f' ({reused / (created + reused):.0%}), {lookups:3} DNS lookups')
+
+
+async def main():
+    runner, url = await start_tracker()
+    print(f'{TORRENTS} torrents announcing {ROUNDS} times to {url}')
+    try:
+        await run('session per torrent', url, shared=False)
+        await run('shared session', url, shared=True)
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
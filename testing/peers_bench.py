@@ -0,0 +1,63 @@
+"""
+Benchmark of decoding the peers of tracker responses with 10k peers: the
+compact IPv4 `peers`, the compact IPv6 `peers6` and the dictionary model.
+Decoding compact peers by slicing out each peer (as it used to be done) is
+the baseline.
+
+Run from the project root:
+    python -m testing.peers_bench
+"""
+import random
+import socket
+import struct
+import time
+
+from bencodepy import decode, encode
+
+from src.tracker import TrackerResponse
+
+PEERS = 10_000
+ROUNDS = 20
+
+
+def sliced_peers(peers: bytes) -> list:
+    peers = [peers[i:i+6] for i in range(0, len(peers), 6)]
+    return [(socket.inet_ntoa(p[:4]), struct.unpack('>H', p[4:])[0])
+            for p in peers]
+
+
+def responses() -> dict:
+    rng = random.Random(1)
+    ipv4 = [(rng.randbytes(4), rng.randrange(1, 65536)) for _ in range(PEERS)]
+    ipv6 = [(rng.randbytes(16), rng.randrange(1, 65536)) for _ in range(PEERS)]
+    compact = b''.join(ip + struct.pack('>H', port) for ip, port in ipv4)
+    compact6 = b''.join(ip + struct.pack('>H', port) for ip, port in ipv6)
+    dictionary = [{b'peer id': rng.randbytes(20),
+                   b'ip': socket.inet_ntoa(ip).encode(),
+                   b'port': port} for ip, port in ipv4]
+    return {'peers': encode({b'interval': 1800, b'peers': compact}),
+            'peers6': encode({b'interval': 1800, b'peers6': compact6}),
+            'dictionary': encode({b'interval': 1800, b'peers': dictionary})}
+
+
+def run(name: str, decode_peers, data: bytes):
+    # Decoding the bencoded response is part of the work
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        peers = decode_peers(decode(data))
+    elapsed = (time.perf_counter() - start) / ROUNDS
+    print(f'{name:<20} {elapsed * 1000:7.2f} ms per response,'
+          f' {len(peers) / elapsed / 1e6:5.2f} M peers/s')
+
+
+def main():
+    data = responses()
+    print(f'{PEERS} peers per response')
+    run('peers (sliced)', lambda r: sliced_peers(r[b'peers']), data['peers'])
+    run('peers', lambda r: TrackerResponse(r).peers, data['peers'])
+    run('peers6', lambda r: TrackerResponse(r).peers, data['peers6'])
+    run('dictionary', lambda r: TrackerResponse(r).peers, data['dictionary'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Replays a synthetic download of a 100k piece torrent through the
+`PieceManager` bookkeeping: requesting blocks for a number of peers and
+receiving them (in random order) until the download is complete.
+
+Hashing and writing to disk are left out, only the bookkeeping is measured.
+
+Run from the project root:
+    python -m testing.piece_manager_bench
+"""
+import os
+import random
+import tempfile
+import time
+
+from src import client
+from src.bitfield import CompactBitfield
+from src.client import Piece, PieceManager, REQUEST_SIZE
+from src.disk import DiskIO
+from testing.synthetic import SyntheticTorrent
+
+PIECES = 100_000
+PIECE_LENGTH = 4 * REQUEST_SIZE
+PEERS = 40
+
+
+class NullHash:
+    def update(self, data):
+        pass
+
+    def digest(self):
+        return b''
+
+
+class ReplayPieceManager(PieceManager):
+    def _write_block(self, piece_index, offset, data):
+        pass
+
+    def _read_block(self, block):
+        return b''
+
+
+def main():
+    client.sha1 = NullHash
+    Piece.is_hash_matching = lambda self, read_block: True
+    torrent = SyntheticTorrent('replay.bin', PIECE_LENGTH,
+                               PIECES * PIECE_LENGTH - 1000)
+    payload = memoryview(bytes(REQUEST_SIZE))
+
+    os.chdir(tempfile.mkdtemp())
+    start = time.perf_counter()
+    manager = ReplayPieceManager(torrent, DiskIO(workers=0))
+    setup = time.perf_counter() - start
+
+    peers = [f'peer-{i:02}'.encode() for i in range(PEERS)]
+    for peer_id in peers:
+        manager.add_peer(peer_id, CompactBitfield.full(PIECES))
+
+    blocks = 0
+    start = time.perf_counter()
+    while not manager.complete:
+        in_flight = []
+        for peer_id in peers:
+            for _ in range(manager.request_window(peer_id)):
+                block = manager.next_request(peer_id)
+                if not block:
+                    break
+                in_flight.append((peer_id, block))
+        random.shuffle(in_flight)
+        for peer_id, block in in_flight:
+            manager.block_received(peer_id, block.piece, block.offset,
+                                   payload[:block.length])
+        blocks += len(in_flight)
+    elapsed = time.perf_counter() - start
+    manager.close()
+
+    print(f'{PIECES} pieces, {blocks} blocks, {PEERS} peers')
+    print(f'setup    {setup:8.2f} s')
+    print(f'download {elapsed:8.2f} s ({blocks / elapsed:,.0f} blocks/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""
+Measures the peak memory used per in-flight piece while receiving and
+verifying large pieces, using `tracemalloc`.
+
+Compares the previous way of verifying (keeping every block of the piece,
+joining them and hashing the joined copy before writing it) against
+the `PieceManager`, which writes blocks as they arrive and hashes them in
+offset order.
+
+The blocks of the in-flight pieces arrive interleaved and somewhat out of
+order, as they would from several peers. Each block is a new buffer, as
+when it is read from a connection.
+
+Run from the project root:
+    python -m testing.piece_memory_bench
+"""
+import hashlib
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from src.bitfield import CompactBitfield
+from src.client import PieceManager, REQUEST_SIZE
+from src.disk import DiskIO
+from testing.synthetic import SyntheticTorrent
+
+IN_FLIGHT = 8
+PIECE_LENGTHS = [4 * 2**20, 16 * 2**20]
+# How far (in blocks) a block may arrive ahead of its turn
+REORDER = 16
+
+
+class LegacyVerifier:
+    """
+    Keeps the blocks of each piece until it is complete, then joins, hashes
+    and writes the joined piece.
+    """
+    def __init__(self, torrent, fd):
+        self.torrent = torrent
+        self.fd = fd
+        self.blocks = {}
+
+    def block_received(self, piece_index, block_offset, data):
+        blocks = self.blocks.setdefault(piece_index, {})
+        blocks[block_offset] = data
+        if len(blocks) * REQUEST_SIZE < self.torrent.piece_length:
+            return
+        piece_data = b''.join(blocks[offset] for offset in sorted(blocks))
+        del self.blocks[piece_index]
+        assert hashlib.sha1(piece_data).digest() == \
+            self.torrent.pieces[piece_index]
+        start = piece_index * self.torrent.piece_length
+        os.lseek(self.fd, start, os.SEEK_SET)
+        os.write(self.fd, piece_data)
+
+
+def arrivals(piece_length: int, rng: random.Random):
+    """
+    The (piece index, block offset) of every block of the in-flight pieces
+    in the order they arrive.
+    """
+    order = []
+    for offset in range(0, piece_length, REQUEST_SIZE):
+        for index in range(IN_FLIGHT):
+            order.append((index, offset))
+    # Let each block arrive up to REORDER blocks early
+    keys = [position + rng.uniform(0, REORDER * IN_FLIGHT)
+            for position in range(len(order))]
+    return [arrival for _, arrival in sorted(zip(keys, order))]
+
+
+def synthetic_torrent(piece_length: int) -> tuple[SyntheticTorrent, bytes]:
+    # Every piece has the same content so no full copy of the torrent is
+    # needed to feed the blocks
+    piece = random.Random(piece_length).randbytes(piece_length)
+    torrent = SyntheticTorrent('memory.bin', piece_length,
+                               IN_FLIGHT * piece_length)
+    torrent.pieces = [hashlib.sha1(piece).digest()] * IN_FLIGHT
+    return torrent, piece
+
+
+def feed(receive, order, view: memoryview) -> float:
+    """
+    Feed the blocks in order
+
+    :return: The seconds taken
+    """
+    start = time.perf_counter()
+    for index, offset in order:
+        receive(index, offset, bytes(view[offset:offset + REQUEST_SIZE]))
+    return time.perf_counter() - start
+
+
+def run(name: str, receiver, order, piece: bytes):
+    """
+    Measure the peak memory of receiving the pieces with `tracemalloc`, and
+    the throughput in a separate run without it (tracemalloc slows down the
+    Python code per block far more than the hashing and writing)
+
+    :param receiver: Returns the function to receive the blocks with, and
+                     a function to call once they are received
+    """
+    view = memoryview(piece)
+    receive, done = receiver()
+    elapsed = feed(receive, order, view)
+    done()
+    receive, done = receiver()
+    tracemalloc.start()
+    feed(receive, order, view)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    done()
+    print(f'  {name:<8} peak {peak / IN_FLIGHT / 2**20:8.2f} MiB per piece'
+          f' {len(piece) * IN_FLIGHT / elapsed / 2**20:8.1f} MB/s')
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+    for piece_length in PIECE_LENGTHS:
+        print(f'{piece_length // 2**20} MiB pieces, {IN_FLIGHT} in flight')
+        torrent, piece = synthetic_torrent(piece_length)
+        order = arrivals(piece_length, random.Random(1))
+
+        def legacy():
+            fd = os.open('legacy.bin', os.O_RDWR | os.O_CREAT)
+            return LegacyVerifier(torrent, fd).block_received, \
+                lambda: os.close(fd)
+
+        def streaming():
+            manager = PieceManager(torrent, DiskIO(workers=0))
+            # The write cache is a fixed cost, not per piece
+            manager.storage.cache_size = 0
+            manager.add_peer(b'peer', CompactBitfield.full(IN_FLIGHT))
+            while manager.next_request(b'peer'):
+                pass
+
+            def done():
+                assert manager.complete
+                manager.close()
+                os.remove(torrent.output_file)
+                os.remove(torrent.output_file + '.fastresume')
+            return lambda *block: manager.block_received(b'peer', *block), \
+                done
+
+        run('before', legacy, order, piece)
+        run('after', streaming, order, piece)
+
+
+if __name__ == '__main__':
+    main()
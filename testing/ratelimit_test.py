@@ -0,0 +1,175 @@
+"""
+Checks of the rate limits in a local synthetic swarm: the download rate over
+all torrents, of each torrent and from each peer, and the upload rate to the
+leechers of a seeding torrent, measured once past the initial burst, must be
+within 5% of their limit.
+
+The seeders and leechers are the stand-ins of `testing.swarm`, the peers
+are handed out by the stand-in UDP tracker of `testing.udp_test`.
+
+Run from the project root:
+    python -m testing.ratelimit_test
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+
+from src.client import TorrentClient
+from src.session import Session
+from testing.swarm import Leecher, Seeder
+from testing.synthetic import SyntheticTorrent
+from testing.udp_test import start_tracker
+
+TOTAL_SIZE = 48 * 2**20
+PIECE_LENGTH = 64 * 2**10
+# Seconds to wait for the initial burst of the buckets to be used up, and
+# to measure the rates over
+WARMUP = 2
+DURATION = 8
+TOLERANCE = 0.05
+
+
+def _downloaded(client: TorrentClient) -> int:
+    return sum(peer.download_meter.total for peer in client.peers)
+
+
+def _uploaded(client: TorrentClient) -> int:
+    return sum(peer.upload_meter.total for peer in client.peers)
+
+
+async def _measure(counters: dict) -> dict:
+    """
+    The rates of the byte counters given by name, between the end of the
+    warmup and `DURATION` seconds later
+    """
+    await asyncio.sleep(WARMUP)
+    start = {name: counter() for name, counter in counters.items()}
+    await asyncio.sleep(DURATION)
+    return {name: (counter() - start[name]) / DURATION
+            for name, counter in counters.items()}
+
+
+async def _connected(client: TorrentClient, count: int) -> list:
+    """
+    Wait for `count` peers of the client to be connected
+
+    :return: The connections of those peers
+    """
+    for _ in range(50):
+        peers = [peer for peer in client.peers if peer.remote_id is not None]
+        if len(peers) >= count:
+            return peers
+        await asyncio.sleep(0.1)
+    raise AssertionError(f'{len(peers)} of {count} peers connected')
+
+
+def _check(name: str, rate: float, limit: float):
+    error = rate / limit - 1
+    print(f'{name}: {"ok" if abs(error) <= TOLERANCE else "FAILED"}'
+          f' ({rate / 2**20:.3f} MiB/s, limit {limit / 2**20:.3f},'
+          f' {error:+.1%})')
+    assert abs(error) <= TOLERANCE, (name, rate, limit)
+
+
+async def download(directory: str, url: str, tracker, seeders: int,
+                   torrents: int, **limits) -> tuple[Session, list, list]:
+    """
+    Start downloading `torrents` torrents each served by `seeders` seeders
+    in a `Session` with the limits given
+
+    :return: The session, the clients of the torrents and the seeders
+    """
+    session = Session(**limits)
+    clients = []
+    servers = []
+    for i in range(torrents):
+        torrent = SyntheticTorrent.with_random_data(
+            os.path.join(directory, f'download_{len(tracker.swarms)}.bin'),
+            PIECE_LENGTH, TOTAL_SIZE)
+        torrent.announce_tiers = [[url]]
+        swarm = tracker.swarms.setdefault(torrent.info_hash, {})
+        for j in range(seeders):
+            peer_id = b'-SEED-' + bytes([j]) * 14
+            seeder = Seeder([torrent], peer_id)
+            swarm[peer_id] = ('127.0.0.1', await seeder.start(), 0)
+            servers.append(seeder)
+        clients.append(await session.add(torrent))
+    return session, clients, servers
+
+
+async def close(session: Session, servers: list):
+    await session.close()
+    for server in servers:
+        server.close()
+
+
+async def run(use_protocol: bool):
+    print(f'{"protocol" if use_protocol else "stream"} transport')
+    directory = tempfile.mkdtemp()
+    transport, tracker, url = await start_tracker()
+    try:
+        # Over all torrents
+        limit = 4 * 2**20
+        session, clients, servers = await download(
+            directory, url, tracker, 1, 2, download_limit=limit,
+            use_protocol=use_protocol)
+        rates = await _measure(
+            {'all': lambda: sum(map(_downloaded, clients))})
+        await close(session, servers)
+        _check('download limit over all torrents', rates['all'], limit)
+
+        # Of each torrent, within a wider limit over all torrents
+        limit = 1.5 * 2**20
+        session, clients, servers = await download(
+            directory, url, tracker, 1, 2, download_limit=8 * 2**20,
+            torrent_download_limit=limit, use_protocol=use_protocol)
+        rates = await _measure({i: lambda c=c: _downloaded(c)
+                                for i, c in enumerate(clients)})
+        await close(session, servers)
+        for i, rate in rates.items():
+            _check(f'download limit of torrent {i}', rate, limit)
+
+        # From each peer, the torrent having two seeders
+        limit = 1 * 2**20
+        session, clients, servers = await download(
+            directory, url, tracker, 2, 1, peer_download_limit=limit,
+            use_protocol=use_protocol)
+        peers = await _connected(clients[0], 2)
+        rates = await _measure({i: lambda p=p: p.download_meter.total
+                                for i, p in enumerate(peers)})
+        await close(session, servers)
+        for i, rate in rates.items():
+            _check(f'download limit of peer {i}', rate, limit)
+
+        # Seeding to two leechers
+        limit = 2 * 2**20
+        torrent = SyntheticTorrent.with_random_data(
+            os.path.join(directory, 'upload.bin'), PIECE_LENGTH, TOTAL_SIZE)
+        with open(torrent.name, 'wb') as f:
+            f.write(torrent.data)
+        torrent.announce_tiers = [[url]]
+        leechers = [Leecher(torrent) for _ in range(2)]
+        tracker.swarms[torrent.info_hash] = {
+            b'-LEECH-' + bytes([i]) * 13:
+                ('127.0.0.1', await leecher.start(), TOTAL_SIZE)
+            for i, leecher in enumerate(leechers)}
+        session = Session(upload_limit=8 * 2**20,
+                          torrent_upload_limit=limit, seed=True,
+                          use_protocol=use_protocol)
+        client = await session.add(torrent)
+        rates = await _measure({'upload': lambda: _uploaded(client)})
+        await close(session, leechers)
+        _check('upload limit of a torrent', rates['upload'], limit)
+    finally:
+        transport.close()
+        shutil.rmtree(directory)
+
+
+async def main():
+    for use_protocol in (False, True):
+        await run(use_protocol)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
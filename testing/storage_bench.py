@@ -0,0 +1,148 @@
+"""
+Benchmark of writing received blocks to disk: one `lseek` + `write` per
+block (per file it spans) as before, compared to the write-back cache of
+`Storage` that writes adjacent blocks together with `pwritev`.
+
+The blocks of a number of in-flight pieces arrive interleaved, as they do
+when downloading from several peers, and the torrent is split over a few
+files.
+
+Also compares finding the files a block spans by scanning every file (as
+before) against the bisect index of `Storage`, for a torrent with a lot of
+small files.
+
+Run from the project root:
+    python -m testing.storage_bench
+"""
+import os
+import random
+import tempfile
+import time
+
+from src.client import REQUEST_SIZE
+from src.storage import Storage
+
+PIECE_LENGTH = 2**20
+PIECES = 256
+IN_FLIGHT = 8
+FILES = 5
+# Files in the torrent used for the lookup benchmark
+LOOKUP_FILES = 200_000
+LOOKUPS = 200
+
+
+def file_segments(name: str) -> list:
+    total = PIECES * PIECE_LENGTH
+    length = total // FILES + 12345
+    segments = []
+    offset = 0
+    for i in range(FILES):
+        end = min(total, offset + length)
+        segments.append((offset, end, f'{name}_{i}'))
+        offset = end
+    return segments
+
+
+def arrivals(rng: random.Random) -> list:
+    """
+    The global offsets of the blocks in the order they arrive
+    """
+    order = []
+    for first in range(0, PIECES, IN_FLIGHT):
+        batch = []
+        for offset in range(0, PIECE_LENGTH, REQUEST_SIZE):
+            batch.extend(index * PIECE_LENGTH + offset
+                         for index in range(first, first + IN_FLIGHT))
+        # A little reordering within the pieces in flight
+        for start in range(0, len(batch), 32):
+            window = batch[start:start + 32]
+            rng.shuffle(window)
+            batch[start:start + 32] = window
+        order.extend(batch)
+    return order
+
+
+def lseek_write(segments: list, offset: int, data) -> int:
+    calls = 0
+    end = offset + len(data)
+    for file_start, file_end, fd in segments:
+        overlap_start = max(offset, file_start)
+        overlap_end = min(end, file_end)
+        if overlap_start >= overlap_end:
+            continue
+        os.lseek(fd, overlap_start - file_start, os.SEEK_SET)
+        os.write(fd, data[overlap_start - offset:overlap_end - offset])
+        calls += 2
+    return calls
+
+
+def run(name: str, write, order: list, block: bytes):
+    start = time.perf_counter()
+    calls = 0
+    for offset in order:
+        calls += write(offset, block)
+    calls += write(None, None)
+    elapsed = time.perf_counter() - start
+    print(f'{name:<8} {PIECES * PIECE_LENGTH / elapsed / 2**20:8.1f} MB/s'
+          f' {calls:8} syscalls')
+
+
+def main():
+    os.chdir(tempfile.mkdtemp())
+    order = arrivals(random.Random(1))
+    block = memoryview(random.Random(2).randbytes(REQUEST_SIZE))
+    print(f'{PIECES} pieces of {PIECE_LENGTH // 2**20} MiB over {FILES} files'
+          f', {IN_FLIGHT} in flight')
+
+    segments = [(start, end, os.open(path, os.O_RDWR | os.O_CREAT))
+                for start, end, path in file_segments('before')]
+    run('before',
+        lambda offset, data: lseek_write(segments, offset, data) if data else 0,
+        order, block)
+    for _, _, fd in segments:
+        os.close(fd)
+
+    storage = Storage(file_segments('after'))
+
+    def cached_write(offset, data):
+        if data is None:
+            storage.flush()
+            return storage.writes
+        storage.write(offset, data)
+        return 0
+    run('after', cached_write, order, block)
+    storage.close()
+
+    lookups()
+
+
+def lookups():
+    rng = random.Random(3)
+    segments = []
+    offset = 0
+    for i in range(LOOKUP_FILES):
+        length = rng.randrange(0, 3 * REQUEST_SIZE)
+        segments.append((offset, offset + length, f'file_{i}'))
+        offset += length
+    offsets = [rng.randrange(0, offset - PIECE_LENGTH)
+               for _ in range(LOOKUPS)]
+    print(f'Finding the files of a {PIECE_LENGTH // 2**20} MiB piece'
+          f' among {LOOKUP_FILES} files')
+
+    def scan(start, length):
+        end = start + length
+        return [path for file_start, file_end, path in segments
+                if max(start, file_start) < min(end, file_end)]
+
+    storage = Storage(segments)
+    for name, lookup in [('scan', scan),
+                         ('bisect', lambda *args: list(storage._file_ranges(*args)))]:
+        start = time.perf_counter()
+        for offset in offsets:
+            lookup(offset, PIECE_LENGTH)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<8} {elapsed / LOOKUPS * 1e6:10.1f} us/lookup')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+Benchmark of downloading torrents from a local synthetic swarm with the
+torrents sharded over 1, 2, 4 ... worker processes by the `Supervisor`.
+
+Each torrent is served by a seeder (`testing.swarm`), the seeders running in
+processes of their own, and the peers are handed out by the stand-in UDP
+tracker of `testing.udp_test`. The downloads are hashed and written to a
+temporary directory.
+
+The throughput only scales with the processes while there are free cores,
+the seeders need cores too.
+
+Run from the project root:
+    python -m testing.supervisor_bench
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+from src.supervisor import Supervisor
+from testing.swarm import SeederProcesses
+from testing.synthetic import SyntheticTorrent
+from testing.udp_test import start_tracker
+
+TORRENTS = 8
+TOTAL_SIZE = 32 * 2**20
+PIECE_LENGTH = 256 * 2**10
+PROCESSES = [1, 2, 4]
+# Seconds to wait for the downloads of a run
+TIMEOUT = 300
+
+
+async def run(processes: int, torrents: list[SyntheticTorrent]):
+    supervisor = Supervisor(processes, port=None)
+    supervisor.start()
+    try:
+        start = time.perf_counter()
+        for torrent in torrents:
+            await supervisor.add(torrent)
+        await asyncio.wait_for(supervisor.wait(), TIMEOUT)
+        elapsed = time.perf_counter() - start
+    finally:
+        await supervisor.close()
+    stats = supervisor.stats()
+    assert stats['completed'] == len(torrents), stats
+    print(f'{processes} processes {elapsed:7.2f} s,'
+          f' {stats["downloaded"] / elapsed / 2**20:7.1f} MiB/s')
+    for torrent in torrents:
+        os.remove(torrent.output_file)
+        os.remove(torrent.output_file + '.fastresume')
+
+
+async def main():
+    directory = tempfile.mkdtemp()
+    specs = [(os.path.join(directory, f'torrent_{i}.bin'), PIECE_LENGTH,
+              TOTAL_SIZE) for i in range(TORRENTS)]
+    seeders = SeederProcesses(specs, os.cpu_count() or 1)
+    ports = seeders.start()
+    transport, tracker, url = await start_tracker()
+    torrents = []
+    for spec in specs:
+        torrent = SyntheticTorrent.with_random_data(*spec)
+        # The workers only need the piece hashes
+        torrent.data = None
+        torrent.announce_tiers = [[url]]
+        tracker.swarms[torrent.info_hash] = {
+            b'-SEED-' + bytes(14): ('127.0.0.1', ports[torrent.info_hash], 0)}
+        torrents.append(torrent)
+    print(f'{TORRENTS} torrents of {TOTAL_SIZE // 2**20} MiB,'
+          f' {os.cpu_count()} cores')
+    try:
+        for processes in PROCESSES:
+            await run(processes, torrents)
+    finally:
+        transport.close()
+        seeders.close()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,301 @@
+"""
+A local synthetic swarm for the benchmarks: seeders serving `SyntheticTorrent`s
+and leechers downloading them over the peer wire protocol, in this process or
+in worker processes.
+
+A seeder has every piece, unchokes right away and answers every request; it
+never downloads. A seeder given a rate sends its blocks one at a time at
+that rate, and drops the requests cancelled before their turn. A leecher waits for the peer connecting to it to unchoke it
+and then requests every block of the torrent once; it never uploads.
+"""
+import asyncio
+import multiprocessing
+import struct
+import time
+from collections import deque
+
+from src.protocol import (BitField, Cancel, Handshake, Interested,
+                          MessageFramer, PeerMessage, Piece, Request,
+                          REQUEST_SIZE, Unchoke)
+from testing.synthetic import SyntheticTorrent
+
+
+class Seeder:
+    """
+    Serves the pieces of torrents with random data, by info hash
+    """
+    def __init__(self, torrents: list[SyntheticTorrent],
+                 peer_id: bytes = b'-SEED-' + bytes(14),
+                 rate: float | None = None):
+        """
+        :param rate: Bytes per second sent to each peer, no limit if None
+        """
+        self.torrents = {torrent.info_hash: torrent for torrent in torrents}
+        self.peer_id = peer_id
+        self.rate = rate
+        self.bytes_uploaded = 0
+        self.cancelled = 0
+        self.server = None
+
+    def _write_block(self, writer: asyncio.StreamWriter,
+                     torrent: SyntheticTorrent, data: memoryview,
+                     request: tuple):
+        index, begin, length = request
+        offset = index * torrent.piece_length + begin
+        block = data[offset:offset + length]
+        writer.write(struct.pack('>IbII', 9 + len(block), 7, index, begin))
+        writer.write(block)
+        self.bytes_uploaded += len(block)
+
+    async def _send_slowly(self, writer: asyncio.StreamWriter,
+                           torrent: SyntheticTorrent, data: memoryview,
+                           requests: deque, queued: asyncio.Event):
+        try:
+            while True:
+                await queued.wait()
+                while requests:
+                    request = requests.popleft()
+                    self._write_block(writer, torrent, data, request)
+                    await writer.drain()
+                    await asyncio.sleep(request[2] / self.rate)
+                queued.clear()
+        except ConnectionError:
+            pass
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        try:
+            handshake = Handshake.decode(await reader.readexactly(68))
+            torrent = self.torrents.get(handshake.info_hash) if handshake \
+                else None
+            if torrent is None:
+                return
+            data = memoryview(torrent.data)
+            pieces = len(torrent.pieces)
+            bitfield = bytearray(-(-pieces // 8))
+            for index in range(pieces):
+                bitfield[index >> 3] |= 0x80 >> (index & 7)
+            writer.write(Handshake(torrent.info_hash, self.peer_id).encode())
+            writer.write(BitField(bytes(bitfield)).encode())
+            writer.write(struct.pack('>Ib', 1, PeerMessage.Unchoke))
+            framer = MessageFramer()
+            requests = deque()
+            queued = asyncio.Event()
+            if self.rate:
+                sending = asyncio.create_task(self._send_slowly(
+                    writer, torrent, data, requests, queued))
+            while chunk := await reader.read(65536):
+                framer.feed(chunk)
+                while message := framer.next_message():
+                    request = (message.index, message.begin, message.length) \
+                        if isinstance(message, (Request, Cancel)) else None
+                    if isinstance(message, Cancel) and request in requests:
+                        requests.remove(request)
+                        self.cancelled += 1
+                    elif not isinstance(message, Request):
+                        continue
+                    elif self.rate:
+                        requests.append(request)
+                        queued.set()
+                    else:
+                        self._write_block(writer, torrent, data, request)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            if self.rate:
+                sending.cancel()
+            writer.close()
+
+    async def start(self, host: str = '127.0.0.1') -> int:
+        """
+        Start serving on a free port
+
+        :return: The port
+        """
+        self.server = await asyncio.start_server(self._handle, host, 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+class Leecher:
+    """
+    Downloads a torrent from the first peer connecting to it, keeping
+    `window` requests outstanding
+    """
+    def __init__(self, torrent: SyntheticTorrent, window: int = 64,
+                 block_size: int = REQUEST_SIZE):
+        self.torrent = torrent
+        self.window = window
+        self.block_size = block_size
+        self.bytes_received = 0
+        # When the first block was requested and the last one received
+        self.started = None
+        self.finished = None
+        self.done = asyncio.Event()
+        self.server = None
+
+    def _blocks(self):
+        torrent = self.torrent
+        for index in range(len(torrent.pieces)):
+            length = min(torrent.piece_length,
+                         torrent.total_size - index * torrent.piece_length)
+            for begin in range(0, length, self.block_size):
+                yield index, begin, min(self.block_size, length - begin)
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        try:
+            await reader.readexactly(Handshake.length)
+            writer.write(Handshake(self.torrent.info_hash,
+                                   b'-LEECH-' + bytes(13)).encode())
+            writer.write(Interested().encode())
+            blocks = self._blocks()
+            outstanding = 0
+            framer = MessageFramer()
+            while chunk := await reader.read(65536):
+                framer.feed(chunk)
+                requests = []
+                while message := framer.next_message():
+                    if isinstance(message, Piece):
+                        outstanding -= 1
+                        self.bytes_received += len(message.block)
+                    elif not isinstance(message, Unchoke) or self.started:
+                        continue
+                    else:
+                        self.started = time.perf_counter()
+                    while outstanding < self.window:
+                        block = next(blocks, None)
+                        if block is None:
+                            break
+                        requests.append(Request(*block).encode())
+                        outstanding += 1
+                if requests:
+                    writer.write(b''.join(requests))
+                if self.started and not outstanding:
+                    self.finished = time.perf_counter()
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            self.done.set()
+
+    async def start(self, host: str = '127.0.0.1') -> int:
+        """
+        Start waiting for the peer on a free port
+
+        :return: The port
+        """
+        self.server = await asyncio.start_server(self._handle, host, 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+
+
+def _leech(spec: tuple, count: int, window: int, block_size: int,
+           ports: multiprocessing.Queue, results: multiprocessing.Queue):
+    async def leech():
+        # Only the sizes are needed, the data is not verified
+        torrent = SyntheticTorrent(*spec)
+        leechers = [Leecher(torrent, window, block_size)
+                    for _ in range(count)]
+        ports.put([await leecher.start() for leecher in leechers])
+        for leecher in leechers:
+            await leecher.done.wait()
+            leecher.close()
+        results.put([(leecher.bytes_received, leecher.started,
+                      leecher.finished) for leecher in leechers])
+    asyncio.run(leech())
+
+
+class LeecherProcesses:
+    """
+    `count` leechers of the torrent of the `(name, piece_length,
+    total_size)` spec given, in `processes` worker processes
+    """
+    def __init__(self, spec: tuple, count: int, processes: int,
+                 window: int = 64, block_size: int = REQUEST_SIZE):
+        context = multiprocessing.get_context('spawn')
+        self._ports = context.Queue()
+        self._results = context.Queue()
+        processes = min(processes, count)
+        self._workers = [
+            context.Process(target=_leech, daemon=True,
+                            args=(spec, len(range(i, count, processes)),
+                                  window, block_size, self._ports,
+                                  self._results))
+            for i in range(processes)]
+
+    def start(self) -> list[int]:
+        """
+        Start the leechers
+
+        :return: The ports the leechers wait on
+        """
+        for worker in self._workers:
+            worker.start()
+        return [port for _ in self._workers for port in self._ports.get()]
+
+    def results(self) -> list[tuple]:
+        """
+        Wait for the leechers to finish
+
+        :return: The bytes received, and when the download started and
+                 finished (`time.perf_counter`), of each leecher
+        """
+        results = [result for _ in self._workers
+                   for result in self._results.get()]
+        for worker in self._workers:
+            worker.join()
+        return results
+
+
+def _serve(specs: list[tuple], ports: multiprocessing.Queue,
+           stop: multiprocessing.Event):
+    async def serve():
+        seeder = Seeder([SyntheticTorrent.with_random_data(*spec)
+                         for spec in specs])
+        ports.put((list(seeder.torrents), await seeder.start()))
+        await asyncio.to_thread(stop.wait)
+        seeder.close()
+    asyncio.run(serve())
+
+
+class SeederProcesses:
+    """
+    Seeders in `processes` worker processes, serving the torrents of the
+    `(name, piece_length, total_size)` specs given between them
+    """
+    def __init__(self, specs: list[tuple], processes: int):
+        context = multiprocessing.get_context('spawn')
+        self._ports = context.Queue()
+        self._stop = context.Event()
+        self._workers = [context.Process(target=_serve, daemon=True,
+                                         args=(specs[i::processes],
+                                               self._ports, self._stop))
+                         for i in range(min(processes, len(specs)))]
+
+    def start(self) -> dict[bytes, int]:
+        """
+        Start the seeders
+
+        :return: The port serving each torrent, by info hash
+        """
+        for worker in self._workers:
+            worker.start()
+        ports = {}
+        for _ in self._workers:
+            info_hashes, port = self._ports.get()
+            ports.update(dict.fromkeys(info_hashes, port))
+        return ports
+
+    def close(self):
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
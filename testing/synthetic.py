@@ -0,0 +1,56 @@
+"""
+Synthetic torrents for the benchmarks, these stand in for a `Torrent` without
+needing a .torrent file.
+"""
+import hashlib
+import os
+import random
+
+from src.torrent import TorrentFile
+
+
+class SyntheticTorrent:
+    """
+    Has the same attributes as a `Torrent` that the client makes use of.
+
+    When `data` is given the piece hashes are calculated from it, else the
+    piece hashes are random (for benchmarks not verifying pieces).
+    """
+    def __init__(self, name: str, piece_length: int, total_size: int,
+                 data: bytes | None = None, file_lengths: list[int] | None = None):
+        self.name = name
+        self.piece_length = piece_length
+        self.total_size = total_size
+        self.data = data
+        self.info_hash = hashlib.sha1(name.encode('utf-8')).digest()
+        self.announce_urls = ['http://127.0.0.1:6969/announce']
+
+        if file_lengths:
+            self.files = [TorrentFile(os.path.join(name, f'file_{i}'), length)
+                          for i, length in enumerate(file_lengths)]
+        else:
+            self.files = [TorrentFile(name, total_size)]
+
+        if data is not None:
+            self.pieces = [hashlib.sha1(data[i:i + piece_length]).digest()
+                           for i in range(0, total_size, piece_length)]
+        else:
+            count = -(-total_size // piece_length)
+            self.pieces = [random.randbytes(20) for _ in range(count)]
+
+    @classmethod
+    def with_random_data(cls, name: str, piece_length: int, total_size: int,
+                         **kwargs):
+        """
+        Create a torrent with random content that can be verified
+        """
+        data = random.Random(name).randbytes(total_size)
+        return cls(name, piece_length, total_size, data=data, **kwargs)
+
+    @property
+    def output_file(self):
+        return self.name
+
+    @property
+    def multi_file(self) -> bool:
+        return len(self.files) > 1
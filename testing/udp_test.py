@@ -1,46 +1,196 @@
+"""
+An in-process stand-in for a UDP tracker (BEP 15), and checks of the
+`UDPTrackerClient` against it.
+
+Run from the project root:
+    python -m testing.udp_test
+"""
 import asyncio
+import random
+import socket
+import struct
+import time
+
+from src.udp_tracker import (ACTION_ANNOUNCE, ACTION_CONNECT, ACTION_ERROR,
+                             ACTION_SCRAPE, EVENT_STOPPED, PROTOCOL_ID,
+                             UDPTrackerClient, UDPTrackerError)
+
 
 class UDPServerProtocol(asyncio.DatagramProtocol):
+    """
+    A minimal UDP tracker keeping the swarms in memory.
+
+    :param drop: The share of the received requests to ignore, to check the
+                 retransmits of the client
+    """
     transport: asyncio.DatagramTransport | None
+    INTERVAL = 1800
+    CONNECTION_ID_LIFETIME = 120
 
-    def __init__(self):
+    def __init__(self, drop: float = 0.0):
         super().__init__()
         self.transport = None
+        self.drop = drop
+        self.random = random.Random(0)
+        # Connection ids handed out, and when they expire
+        self.connection_ids = {}
+        # Peers by info hash, each swarm is a dict of peer id to
+        # (ip, port, left)
+        self.swarms = {}
+        # Number of requests received by action
+        self.received = {ACTION_CONNECT: 0, ACTION_ANNOUNCE: 0,
+                         ACTION_SCRAPE: 0}
 
     def connection_made(self, transport):
         self.transport = transport
-        print("UDP server listening on 0.0.0.0:5005")
 
     def datagram_received(self, data, addr):
-        print(f"Received {data!r} from {addr}")
+        if self.drop and self.random.random() < self.drop:
+            return
+        if len(data) < 16:
+            return
+        connection_id, action, transaction_id = struct.unpack_from('>QII', data)
+        if action in self.received:
+            self.received[action] += 1
+        if action == ACTION_CONNECT:
+            if connection_id != PROTOCOL_ID:
+                return
+            connection_id = self.random.getrandbits(64)
+            self.connection_ids[connection_id] = \
+                time.monotonic() + self.CONNECTION_ID_LIFETIME
+            self._send(addr, struct.pack('>IIQ', ACTION_CONNECT,
+                                         transaction_id, connection_id))
+        elif self.connection_ids.get(connection_id, 0) < time.monotonic():
+            self._error(addr, transaction_id, 'Connection ID mismatch')
+        elif action == ACTION_ANNOUNCE and len(data) >= 98:
+            self._announce(addr, transaction_id, data)
+        elif action == ACTION_SCRAPE:
+            self._scrape(addr, transaction_id, data[16:])
+        else:
+            self._error(addr, transaction_id, 'Invalid request')
+
+    def _announce(self, addr, transaction_id, data):
+        (info_hash, peer_id, _, left, _, event, _, _, num_want,
+         port) = struct.unpack_from('>20s20sQQQIIIiH', data, 16)
+        swarm = self.swarms.setdefault(info_hash, {})
+        if event == EVENT_STOPPED:
+            swarm.pop(peer_id, None)
+        else:
+            swarm[peer_id] = (addr[0], port, left)
+        if num_want < 0:
+            num_want = 50
+        others = [peer for other_id, peer in swarm.items() if other_id != peer_id]
+        peers = b''.join(socket.inet_aton(ip) + struct.pack('>H', peer_port)
+                         for ip, peer_port, _ in others[:num_want])
+        seeders = sum(1 for _, _, peer_left in swarm.values() if not peer_left)
+        self._send(addr, struct.pack('>IIIII', ACTION_ANNOUNCE, transaction_id,
+                                     self.INTERVAL, len(swarm) - seeders,
+                                     seeders) + peers)
+
+    def _scrape(self, addr, transaction_id, info_hashes):
+        response = [struct.pack('>II', ACTION_SCRAPE, transaction_id)]
+        for i in range(0, len(info_hashes) - 19, 20):
+            swarm = self.swarms.get(info_hashes[i:i + 20], {})
+            seeders = sum(1 for _, _, left in swarm.values() if not left)
+            response.append(struct.pack('>III', seeders, 0,
+                                        len(swarm) - seeders))
+        self._send(addr, b''.join(response))
+
+    def _error(self, addr, transaction_id, message: str):
+        self._send(addr, struct.pack('>II', ACTION_ERROR, transaction_id) +
+                   message.encode('utf-8'))
+
+    def _send(self, addr, data: bytes):
         if self.transport is not None:
-            self.transport.sendto(data, addr)  # Echo back
+            self.transport.sendto(data, addr)
 
     def error_received(self, exc):
         print(f"UDP error received: {exc}")
 
-    def connection_lost(self, exc):
-        print("UDP server closed")
 
-async def main():
+async def start_tracker(drop: float = 0.0):
+    """
+    Start a stand-in tracker on a free local port
+
+    :return: The transport, the protocol and the announce URL
+    """
     loop = asyncio.get_running_loop()
-    transport = None
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: UDPServerProtocol(drop), local_addr=('127.0.0.1', 0))
+    port = transport.get_extra_info('sockname')[1]
+    return transport, protocol, f'udp://127.0.0.1:{port}/announce'
+
+
+async def main():
+    transport, tracker, url = await start_tracker()
+    client = UDPTrackerClient()
+    info_hash = bytes(range(20))
     try:
-        transport, _ = await loop.create_datagram_endpoint(
-            UDPServerProtocol,
-            local_addr=("0.0.0.0", 5005)
-        )
-        await asyncio.sleep(30)  # Run for 30s
-    except asyncio.CancelledError:
-        # Cancellation is expected during shutdown.
-        pass
+        # Announce a seeder and a leecher, the leecher gets the seeder
+        await client.announce(url, info_hash, b'S' * 20, downloaded=0,
+                              left=0, uploaded=0, port=7001)
+        response = await client.announce(url, info_hash, b'L' * 20,
+                                          downloaded=0, left=100,
+                                          uploaded=0, port=7002)
+        assert response[b'complete'] == 1 and response[b'incomplete'] == 1
+        assert response[b'peers'] == socket.inet_aton('127.0.0.1') + \
+            struct.pack('>H', 7001)
+        # The connection id was reused for the second announce
+        assert tracker.received[ACTION_CONNECT] == 1
+        print('announce: ok')
+
+        stats = await client.scrape(url, [info_hash, bytes(20)])
+        assert stats == [{'complete': 1, 'downloaded': 0, 'incomplete': 1},
+                         {'complete': 0, 'downloaded': 0, 'incomplete': 0}]
+        print('scrape: ok')
+
+        # A connection id the tracker no longer knows gets an error, the
+        # client connects again and sends the request once more
+        tracker.connection_ids.clear()
+        stats = await client.scrape(url, [info_hash])
+        assert stats[0]['complete'] == 1
+        assert tracker.received[ACTION_CONNECT] == 2
+        print('expired connection id: ok (connected again)')
+
+        # An error for the new connection id too is raised
+        tracker.CONNECTION_ID_LIFETIME = -1
+        tracker.connection_ids.clear()
+        try:
+            await client.scrape(url, [info_hash])
+            raise AssertionError('expected an error')
+        except UDPTrackerError as e:
+            assert tracker.received[ACTION_CONNECT] == 3
+            print(f'error response: ok ({e})')
     finally:
-        if transport is not None:
-            transport.close()
+        client.close()
+        transport.close()
 
+    # Lost requests are retransmitted
+    transport, tracker, url = await start_tracker(drop=0.5)
+    client = UDPTrackerClient(base_timeout=0.05)
+    try:
+        for i in range(20):
+            await client.announce(url, info_hash, bytes([i]) * 20,
+                                  downloaded=0, left=1, uploaded=0)
+        print(f'retransmits: ok ({client.requests_sent} requests sent for'
+              f' 20 announces with half of them lost)')
+    finally:
+        client.close()
+        transport.close()
 
-if __name__ == "__main__":
+    # Giving up once the retransmits are exhausted
+    client = UDPTrackerClient(base_timeout=0.01, max_retransmits=2)
+    start = time.monotonic()
     try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        print("Stopped by user")
\ No newline at end of file
+        await client.announce(url, info_hash, b'X' * 20, downloaded=0,
+                              left=1, uploaded=0)
+        raise AssertionError('expected a timeout')
+    except TimeoutError:
+        print(f'timeout: ok (after {time.monotonic() - start:.2f} s,'
+              f' {client.requests_sent} requests)')
+    finally:
+        client.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,56 @@
+"""
+Benchmark of announces per second to the stand-in UDP tracker of
+`testing.udp_test`, from a number of concurrent announcers sharing one
+`UDPTrackerClient`, with the connection id cached (one connect round trip
+per tracker) compared to connecting before every announce.
+
+Run from the project root:
+    python -m testing.udp_tracker_bench
+"""
+import asyncio
+import time
+
+from src.udp_tracker import ACTION_CONNECT, UDPTrackerClient
+from testing.udp_test import start_tracker
+
+ANNOUNCES = 5000
+CONCURRENCY = (1, 16, 128)
+
+
+async def announcer(client: UDPTrackerClient, url: str, count: int,
+                    number: int, reconnect: bool):
+    info_hash = number.to_bytes(20, 'big')
+    for i in range(count):
+        if reconnect:
+            client.connection_ids.clear()
+        await client.announce(url, info_hash, i.to_bytes(20, 'big'),
+                              downloaded=0, left=1, uploaded=0, num_want=50)
+
+
+async def run(concurrency: int, reconnect: bool):
+    transport, tracker, url = await start_tracker()
+    client = UDPTrackerClient(base_timeout=1)
+    try:
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            announcer(client, url, ANNOUNCES // concurrency, number, reconnect)
+            for number in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    finally:
+        client.close()
+        transport.close()
+    announces = ANNOUNCES // concurrency * concurrency
+    name = 'reconnect' if reconnect else 'cached id'
+    print(f'{name:<10} {concurrency:>4} concurrent:'
+          f' {announces / elapsed:8.0f} announces/s,'
+          f' {tracker.received[ACTION_CONNECT]:>5} connects')
+
+
+async def main():
+    for reconnect in (True, False):
+        for concurrency in CONCURRENCY:
+            await run(concurrency, reconnect)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+"""
+Benchmark of uploading a torrent to local leecher stand-ins
+(`testing.swarm.Leecher`, in processes of their own): the blocks read
+through the read cache compared to sent with `loop.sendfile`, over the
+stream and the protocol based transports.
+
+Each leecher downloads the whole torrent, from a `PeerConnection` of ours
+per leecher serving it from the files in a temporary directory.
+
+Run from the project root:
+    python -m testing.upload_bench
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+
+from src import protocol
+from src.client import MAX_UPLOAD_REQUEST, PieceManager, PeerQueue
+from src.protocol import PeerConnection, REQUEST_SIZE
+from testing.swarm import LeecherProcesses
+from testing.synthetic import SyntheticTorrent
+
+TOTAL_SIZE = 64 * 2**20
+PIECE_LENGTH = 256 * 2**10
+LEECHERS = 4
+PROCESSES = 2
+# The size of the blocks the leechers request, 16 KiB and the most we serve
+BLOCK_SIZES = [REQUEST_SIZE, MAX_UPLOAD_REQUEST]
+
+
+async def run(name: str, torrent: SyntheticTorrent, sendfile: bool,
+              use_protocol: bool, block_size: int):
+    protocol.SENDFILE = sendfile
+    # Every block is sent with sendfile, to compare
+    protocol.SENDFILE_MIN_LENGTH = 0
+    # A cold read cache for every run
+    manager = PieceManager(torrent)
+    leechers = LeecherProcesses((torrent.name, torrent.piece_length,
+                                 torrent.total_size), LEECHERS, PROCESSES,
+                                block_size=block_size)
+    peers = PeerQueue()
+    for port in leechers.start():
+        peers.add(('127.0.0.1', port))
+    connections = [PeerConnection(peers, torrent.info_hash,
+                                  b'-UPLOAD-' + bytes(12), manager,
+                                  use_protocol=use_protocol)
+                   for _ in range(LEECHERS)]
+    results = await asyncio.to_thread(leechers.results)
+    for connection in connections:
+        connection.stop()
+    await manager.drain()
+    manager.close()
+
+    received = sum(result[0] for result in results)
+    # The leechers run in other processes, perf_counter is system wide
+    elapsed = max(result[2] for result in results) - \
+        min(result[1] for result in results)
+    assert received == LEECHERS * torrent.total_size, received
+    cache = manager.read_cache
+    print(f'{name:<26} {block_size // 1024:4} KiB blocks'
+          f' {received / elapsed / 2**20:7.1f} MiB/s,'
+          f' read cache hits {cache.hits}, misses {cache.misses}')
+
+
+async def main():
+    directory = tempfile.mkdtemp()
+    torrent = SyntheticTorrent.with_random_data(
+        os.path.join(directory, 'upload.bin'), PIECE_LENGTH, TOTAL_SIZE)
+    with open(torrent.name, 'wb') as f:
+        f.write(torrent.data)
+    torrent.data = None
+    print(f'{LEECHERS} leechers downloading {TOTAL_SIZE // 2**20} MiB each,'
+          f' sendfile available: {protocol.SENDFILE}')
+    try:
+        for block_size in BLOCK_SIZES:
+            for use_protocol in (False, True):
+                transport = 'protocol' if use_protocol else 'stream'
+                await run(f'read cache ({transport})', torrent, False,
+                          use_protocol, block_size)
+                if hasattr(os, 'sendfile'):
+                    await run(f'sendfile ({transport})', torrent, True,
+                              use_protocol, block_size)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())